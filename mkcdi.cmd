@@ -25,11 +25,8 @@ goto :eof
 
 :MakeImage
 sfk echo [green]Building Image..
-if exist test.iso del test.iso
 set sort=&&if exist sortfile.str set sort=-sort sortfile.str
-mkisofs -C 0,%lba% -V "%volume%" %sort% -exclude IP.BIN -G data\IP.BIN -l -J -r -o test.iso data
-iso2cdi -i .\test.iso -l %lba% -o .\image.cdi
-if exist image.cdi del test.iso
+mkisofs -C 0,%lba% -V "%volume%" %sort% -exclude IP.BIN -G data\IP.BIN -l -J -r data | iso2cdi -i - -l %lba% -o .\image.cdi
 rem ren image.cdi "%volume%-%build%.tmp"&&del *.cdi&&ren *.tmp *.cdi
 ren image.cdi "%volume%-%build%.tmp"
 if not exist archive mkdir archive
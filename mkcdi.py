@@ -1,25 +1,40 @@
 import os
 import sys
-import subprocess
+import argparse
 import configparser
-import shutil
-from datetime import datetime
-import itertools
+from datetime import datetime, timezone
 import threading
 import time
 
-# Global variable to control the spinner
-spinner_running = False
+# In-process tools live next to the .exe builds in system/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'system'))
+import isowriter
+import buildtrace
+import builder
+import watcher
+import emulator
 
-def spinner():
-    """Display a spinning progress indicator"""
-    for c in itertools.cycle(['|', '/', '-', '\\']):
-        if not spinner_running:
-            break
-        sys.stdout.write(f'\rBuilding image... {c}')
-        sys.stdout.flush()
-        time.sleep(0.1)
-    sys.stdout.write('\rBuilding image... done!   \n')
+BuildCancelled = builder.BuildCancelled
+
+def emulator_exited(returncode):
+    """The emulator closed by itself; show why if it failed"""
+    if returncode != 0:
+        print(f"\rEmulator exited with code {returncode}")
+        for line in emulator_process.tail(5):
+            print(f"  {line}")
+
+# The emulator started after a build, relaunched with every new image
+emulator_process = emulator.EmulatorProcess(on_exit=emulator_exited)
+
+def release_emulator():
+    """Close the emulator before the image it has open is replaced
+    (Windows won't move or rewrite an open file); run_emulator relaunches it"""
+    if emulator_process.close():
+        print("Closed the emulator until the new image is ready")
+
+# Patches, writes and publishes the image; its cancel_build() abandons the
+# running build (watch mode, when data/ changes again)
+image_builder = builder.ImageBuilder(release_image=release_emulator)
 
 def create_default_settings():
     """Create default settings.ini file if it doesn't exist"""
@@ -28,7 +43,11 @@ def create_default_settings():
         'lba': '11702',
         'binary': '0WINCEOS.BIN',
         'volume': 'mygame',
-        'enable_emulator': '0'
+        'enable_emulator': '0',
+        'iso_builder': 'native',
+        'incremental': '0',
+        'source_date_epoch': '',
+        'watch': '0'
     }
     
     with open('settings.ini', 'w') as configfile:
@@ -43,21 +62,26 @@ def load_settings():
     config = configparser.ConfigParser()
     config.read('settings.ini')
     
+    # Unix time that pins every timestamp, for byte-identical rebuilds
+    try:
+        epoch = isowriter.source_date_epoch(config.get('SETTINGS', 'source_date_epoch', fallback=''))
+    except ValueError as e:
+        print(f"Warning: {e}, timestamps are not pinned")
+        epoch = None
+    
     return {
         'lba': config.get('SETTINGS', 'lba', fallback='11702'),
         'binary': config.get('SETTINGS', 'binary', fallback='0WINCEOS.BIN'),
         'volume': config.get('SETTINGS', 'volume', fallback='mygame'),
-        'enable_emulator': config.get('SETTINGS', 'enable_emulator', fallback='0')
+        'enable_emulator': config.get('SETTINGS', 'enable_emulator', fallback='0'),
+        'iso_builder': config.get('SETTINGS', 'iso_builder', fallback='native'),
+        'incremental': config.get('SETTINGS', 'incremental', fallback='0'),
+        'source_date_epoch': epoch,
+        'watch': config.get('SETTINGS', 'watch', fallback='0'),
+        # [SLACK] pattern = size rules, e.g. script/* = 16K or *.txt = 10%
+        'slack': config.items('SLACK', raw=True) if config.has_section('SLACK') else []
     }
 
-def run_command(cmd, check=True):
-    """Run a shell command and return the result"""
-    try:
-        result = subprocess.run(cmd, shell=True, capture_output=True, text=True, check=check)
-        return result.returncode == 0, result.stdout, result.stderr
-    except subprocess.CalledProcessError as e:
-        return False, e.stdout, e.stderr
-
 def verification(settings):
     """Verify files and patch binaries"""
     print("Verificating files and patching binaries..")
@@ -77,143 +101,35 @@ def verification(settings):
         print("Warning: 1ST_READ.BIN not found.")
         return False
     
-    # Remove read-only attributes (Windows only)
-    if os.name == 'nt':
-        for file in os.listdir('data'):
-            filepath = os.path.join('data', file)
-            if os.path.isfile(filepath):
-                os.chmod(filepath, 0o666)  # Remove read-only
-    
-    # Create IP.BIN if it doesn't exist
+    # IP.BIN template; it is copied to the staging area, not into data/
+    settings['ip_bin'] = os.path.join('data', 'IP.BIN')
     if not os.path.exists('data/IP.BIN'):
         print("Warning: IP.BIN not found")
         print("creating generic IP.BIN..")
         if os.path.exists('system/precon/katana.bin'):
-            shutil.copy2('system/precon/katana.bin', 'data/IP.BIN')
+            settings['ip_bin'] = os.path.join('system', 'precon', 'katana.bin')
     
     # Special case for 1NOSDC.BIN
     if settings['binary'] == '1NOSDC.BIN' and os.path.exists('system/precon/lodoss-5167.bin'):
-        shutil.copy2('system/precon/lodoss-5167.bin', 'data/IP.BIN')
+        settings['ip_bin'] = os.path.join('system', 'precon', 'lodoss-5167.bin')
     
     return True
 
-def binhack(settings):
-    """Perform binary hacking operations"""
-    lba = settings['lba']
-    binary = settings['binary']
-    
-    # Run hack4 commands
-    run_command('hack4.exe -w -p data\\*.bin', check=False)
-    run_command(f'hack4.exe -w -n {lba} data\\*.bin', check=False)
-    
-    # Run bincon for 0WINCEOS.BIN
-    if binary == '0WINCEOS.BIN':
-        if os.path.exists('bincon.exe'):
-            success, stdout, stderr = run_command(
-                f'bincon.exe data\\0WINCEOS.BIN data\\0WINCEOS.BIN data\\IP.BIN', 
-                check=False
-            )
-            if success:
-                print()
-    
-    # Run binhack
-    if os.path.exists('binhack.exe'):
-        success, stdout, stderr = run_command(
-            f'binhack.exe "data\\{binary}" "data\\IP.BIN" {lba} --output-dir "./data/" --quiet', 
-            check=False
-        )
-        if success:
-            print()
-    
-    # Run logo for Windows CE
-    if binary == '0WINCEOS.BIN' and os.path.exists('logo.exe'):
-        success, stdout, stderr = run_command(
-            'logo system\\wince.mr data\\IP.BIN', 
-            check=False
-        )
-        if success:
-            print()
-
 def name_generator(settings):
     """Generate name with timestamp"""
-    build = datetime.now().strftime("%Y%m%d")
+    if settings['source_date_epoch'] is not None:
+        build = datetime.fromtimestamp(settings['source_date_epoch'], timezone.utc).strftime("%Y%m%d")
+    else:
+        build = datetime.now().strftime("%Y%m%d")
     settings['build'] = build
     filename = f"{settings['volume']}-{build}.cdi"
     print(f'Name is set as "{filename}"')
     print()
     return filename
 
-def make_image(settings):
-    """Create CDI image"""
-    global spinner_running
-    
-    # Start the spinner in a separate thread
-    spinner_running = True
-    spinner_thread = threading.Thread(target=spinner)
-    spinner_thread.start()
-    
-    try:
-        # Remove test.iso if exists
-        if os.path.exists('test.iso'):
-            os.remove('test.iso')
-        
-        # Prepare sort command
-        sort_cmd = ""
-        if os.path.exists('sortfile.str'):
-            sort_cmd = "-sort sortfile.str"
-        
-        # Build ISO
-        mkisofs_cmd = (
-            f'mkisofs -C 0,{settings["lba"]} -V "{settings["volume"]}" {sort_cmd} '
-            f'-exclude IP.BIN -G data\\IP.BIN -l -J -r -o test.iso data'
-        )
-        
-        success, stdout, stderr = run_command(mkisofs_cmd)
-        if not success:
-            print(f"Error creating ISO: {stderr}")
-            return False
-        
-        # Convert to CDI
-        iso2cdi_cmd = f'iso2cdi -i test.iso -l {settings["lba"]} -o image.cdi'
-        success, stdout, stderr = run_command(iso2cdi_cmd)
-        if not success:
-            print(f"Error converting to CDI: {stderr}")
-            return False
-        
-        # Clean up
-        if os.path.exists('test.iso'):
-            os.remove('test.iso')
-        
-        # Rename and organize files
-        final_filename = f"{settings['volume']}-{settings['build']}.cdi"
-        temp_filename = f"{settings['volume']}-{settings['build']}.tmp"
-        
-        if os.path.exists('image.cdi'):
-            os.rename('image.cdi', temp_filename)
-        
-        # Create archive directory
-        if not os.path.exists('archive'):
-            os.makedirs('archive')
-        
-        # Move existing CDI files to archive
-        for file in os.listdir('.'):
-            if file.endswith('.cdi'):
-                shutil.move(file, os.path.join('archive', file))
-        
-        # Rename temp to final
-        if os.path.exists(temp_filename):
-            os.rename(temp_filename, final_filename)
-        
-        print(f'file "{final_filename}" is created.')
-        print('this window will be closed automatically')
-        return True
-    finally:
-        # Stop the spinner
-        spinner_running = False
-        spinner_thread.join()
-
 def run_emulator(settings):
-    """Run emulator if enabled"""
+    """Start the emulator on the new image if enabled, without waiting for it;
+    an instance that is still running is closed and relaunched"""
     print()
     print("Running Emulator if enabled..")
     
@@ -225,10 +141,68 @@ def run_emulator(settings):
     
     cdi_file = f"{settings['volume']}-{settings['build']}.cdi"
     if os.path.exists(cdi_file):
-        run_command(f'emulator\\redream.exe "{cdi_file}"', check=False)
+        try:
+            if emulator_process.launch(os.path.join('emulator', 'redream.exe'), cdi_file):
+                print(f'Relaunched the emulator with "{cdi_file}"')
+        except OSError as e:
+            print(f"Error starting the emulator: {e}")
+
+def build(settings):
+    """Name, patch and write the image for verified settings; returns True when
+    an image was published. Raises BuildCancelled if cancelled between stages."""
+    name_generator(settings)
+    return image_builder.build(settings)
+
+def watch_build():
+    """One watch-mode build, from a fresh settings.ini and trace"""
+    image_builder.trace = buildtrace.BuildTrace()
+    settings = load_settings()
+    try:
+        with image_builder.trace.stage('verification'):
+            verified = verification(settings)
+        if not verified:
+            print("Verification failed, waiting for changes...")
+            return
+        if build(settings):
+            run_emulator(settings)
+    except BuildCancelled:
+        print("\rBuild cancelled, data/ changed again")
+        return
+    print("Waiting for changes in data/ (Ctrl+C to stop)...")
+
+def watch():
+    """Rebuild whenever data/ changes and settles, until Ctrl+C.
+    Changes arriving during a build cancel it within one sector batch."""
+    if not os.path.exists('data'):
+        os.makedirs('data')
+    data_watcher = watcher.DirectoryWatcher('data')
+    print(f"Watching data/ for changes ({data_watcher.backend.name})")
+    worker = None
+    try:
+        while True:
+            if worker is not None and worker.is_alive():
+                print("\rCancelling the running build...")
+                worker.join()
+            image_builder.cancel_requested.clear()
+            worker = threading.Thread(target=watch_build, daemon=True)
+            worker.start()
+            changed = data_watcher.wait(on_change=lambda paths: image_builder.cancel_build())
+            print(f"\r{len(changed)} change(s) in data/, rebuilding")
+    except KeyboardInterrupt:
+        image_builder.cancel_build()
+        if worker is not None:
+            worker.join()
+    finally:
+        data_watcher.close()
+        emulator_process.close()
 
 def main():
     """Main function"""
+    parser = argparse.ArgumentParser(description='Build a Dreamcast CDI image from data/')
+    parser.add_argument('--watch', action='store_true',
+                        help='Rebuild whenever data/ changes, until Ctrl+C')
+    args = parser.parse_args()
+    
     # Add system directory to PATH
     system_path = os.path.join(os.getcwd(), 'system')
     if system_path not in os.environ['PATH']:
@@ -237,22 +211,36 @@ def main():
     # Load settings
     settings = load_settings()
     
+    if args.watch or settings['watch'] == '1':
+        watch()
+        return
+    
     # Run the process
-    if not verification(settings):
+    with image_builder.trace.stage('verification'):
+        verified = verification(settings)
+    if not verified:
         print("Verification failed. Exiting in 7 seconds...")
         import time
         time.sleep(7)
         sys.exit(1)
     
-    binhack(settings)
-    filename = name_generator(settings)
+    try:
+        built = build(settings)
+    except KeyboardInterrupt:
+        image_builder.cancel_build()
+        print("\rBuild cancelled")
+        sys.exit(1)
     
-    if make_image(settings):
+    if built:
         run_emulator(settings)
+        if emulator_process.running:
+            # The emulator's log pipe closes with this process
+            print("Waiting for the emulator to exit...")
+            emulator_process.wait()
     
     print("Process completed. Exiting in 5 seconds...")
     import time
     time.sleep(5)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
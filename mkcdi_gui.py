@@ -1,25 +1,52 @@
 import os
 import sys
-import subprocess
 import configparser
-import shutil
-from datetime import datetime
+from contextlib import nullcontext
+from datetime import datetime, timezone
 import threading
-import time
+import queue
 import tkinter as tk
 from tkinter import ttk, messagebox
 import re
 
-# Global variable to control the spinner
-spinner_running = False
+# In-process tools live next to the .exe builds in system/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'system'))
+import isowriter
+import buildtrace
+import builder
+import watcher
+import emulator
+import progress
+
+BuildCancelled = builder.BuildCancelled
+
+# Steps of the progress bar
+PROGRESS_STEPS = 1000
 
 class DreamcastImageBuilder:
     def __init__(self):
         self.application_path = self._get_application_path()
         self.config_path = os.path.join(self.application_path, 'settings.ini')
         self.emulator_path = 'emulator/emulator.exe'  # Default emulator path
+        self.iso_builder = 'native'  # 'native' (in-process) or 'mkisofs'
+        self.incremental = False  # update the previous image in place when possible
+        self.slack = []  # [SLACK] growth room rules: (pattern, size)
+        self.source_date_epoch = ''  # pins all image timestamps when set
+        self.build_thread = None
+        self.progress_events = queue.Queue()  # progress.ProgressEvents from the image writer
+        self.last_progress = None
+        self.watch_stop = threading.Event()  # stops the data/ watcher thread
+        self.watch_thread = None
+        # Work the watcher and emulator threads hand to the Tk thread (Tk isn't thread-safe)
+        self.ui_calls = queue.Queue()
+        # Started after a build and relaunched with every new image
+        self.emulator = emulator.EmulatorProcess(on_exit=self.emulator_exited)
+        # Patches, writes and publishes the image; holds the build's trace
+        self.builder = builder.ImageBuilder(log=self.log_message, progress_line=self.progress_reporter,
+                                            release_image=self.release_emulator)
         self.setup_gui()
         self.load_settings()
+        self.run_ui_calls()
 
     @staticmethod
     def _get_application_path() -> str:
@@ -37,6 +64,7 @@ class DreamcastImageBuilder:
         self.enable_emulator_var = tk.BooleanVar(value=False)
         self.enable_binhack_var = tk.BooleanVar(value=True)
         self.noob_mode_var = tk.BooleanVar(value=False)
+        self.watch_var = tk.BooleanVar(value=False)
         
         self.create_widgets()
         self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -84,15 +112,25 @@ class DreamcastImageBuilder:
                                     command=self.toggle_noob_mode)
         noob_check.grid(row=0, column=2)
         
+        watch_check = ttk.Checkbutton(checkbox_frame, text="Rebuild when data/ changes",
+                                     variable=self.watch_var,
+                                     command=self.toggle_watch)
+        watch_check.grid(row=1, column=0, columnspan=3, pady=(2, 0))
+        
         # Center the checkboxes by configuring the checkbox_frame columns
         checkbox_frame.columnconfigure(0, weight=1)
         checkbox_frame.columnconfigure(1, weight=1)
         checkbox_frame.columnconfigure(2, weight=1)
         row += 1
         
-        # Build button centered
-        self.build_button = ttk.Button(main_frame, text="Build Image", command=self.start_build_thread)
-        self.build_button.grid(row=row, column=0, columnspan=2, pady=10)
+        # Build and Cancel buttons centered
+        button_frame = ttk.Frame(main_frame)
+        button_frame.grid(row=row, column=0, columnspan=2, pady=10)
+        self.build_button = ttk.Button(button_frame, text="Build Image", command=self.start_build_thread)
+        self.build_button.grid(row=0, column=0, padx=5)
+        self.cancel_button = ttk.Button(button_frame, text="Cancel", command=self.cancel_build,
+                                        state='disabled')
+        self.cancel_button.grid(row=0, column=1, padx=5)
         row += 1
         
         # Status row - label on left, status text on right
@@ -102,20 +140,27 @@ class DreamcastImageBuilder:
         # Status label on left
         ttk.Label(status_frame, text="Status:").grid(row=0, column=0, sticky=tk.W)
         
-        # Status text and spinner on right
+        # Status text on right
         right_frame = ttk.Frame(status_frame)
         right_frame.grid(row=0, column=1, sticky=tk.E)
         
-        self.spinner_label = ttk.Label(right_frame, text="", width=3)
-        self.spinner_label.grid(row=0, column=0, sticky=tk.W)
-        
         self.progress_label = ttk.Label(right_frame, text="Ready")
-        self.progress_label.grid(row=0, column=1, sticky=tk.W)
+        self.progress_label.grid(row=0, column=0, sticky=tk.W)
         
         # Configure weights for proper alignment
         status_frame.columnconfigure(1, weight=1)
         row += 1
         
+        # Progress bar: moves while the earlier stages run, then fills with
+        # the bytes written; the line below gives size, throughput and ETA
+        self.progress_bar = ttk.Progressbar(main_frame, mode='determinate', maximum=PROGRESS_STEPS)
+        self.progress_bar.grid(row=row, column=0, columnspan=2, sticky=(tk.W, tk.E), pady=2)
+        row += 1
+        
+        self.progress_detail = ttk.Label(main_frame, text="")
+        self.progress_detail.grid(row=row, column=0, columnspan=2, sticky=tk.W)
+        row += 1
+        
         # Status text area
         self.status_text = tk.Text(main_frame, height=10, width=50)
         self.status_text.grid(row=row, column=0, columnspan=2, sticky=(tk.W, tk.E, tk.N, tk.S), pady=2)
@@ -150,27 +195,46 @@ class DreamcastImageBuilder:
             self.binary_entry.config(state='normal')
             self.volume_entry.config(state='normal')
 
-    def start_spinner(self):
-        global spinner_running
-        spinner_running = True
-        self.spinner_thread = threading.Thread(target=self.update_spinner, daemon=True)
-        self.spinner_thread.start()
-
-    def stop_spinner(self):
-        global spinner_running
-        spinner_running = False
-        if hasattr(self, 'spinner_thread'):
-            self.spinner_thread.join(timeout=0.1)
-        self.spinner_label.config(text="")
-
-    def update_spinner(self):
-        spinner_chars = ['|', '/', '-', '\\']
-        index = 0
-        while spinner_running:
-            self.spinner_label.config(text=spinner_chars[index])
-            index = (index + 1) % len(spinner_chars)
-            time.sleep(0.1)
-        self.spinner_label.config(text="")
+    def start_progress(self):
+        """Reset the progress bar for a new build (Tk thread)"""
+        while not self.progress_events.empty():
+            self.progress_events.get_nowait()
+        self.last_progress = None
+        self.progress_detail.config(text="")
+        self.progress_bar.config(mode='indeterminate', value=0)
+        self.progress_bar.start(50)
+
+    def update_progress(self, running=True):
+        """Show the latest event from the image writer (Tk thread)"""
+        while not self.progress_events.empty():
+            self.last_progress = self.progress_events.get_nowait()
+        event = self.last_progress
+        if event is not None and event.fraction is not None:
+            if str(self.progress_bar.cget('mode')) != 'determinate':
+                self.progress_bar.stop()
+                self.progress_bar.config(mode='determinate')
+            self.progress_bar.config(value=event.fraction * PROGRESS_STEPS)
+        if event is not None:
+            # Refreshed even without new events, so a stalled write shows
+            self.progress_detail.config(text=event.format())
+        if not running:
+            self.progress_bar.stop()
+            done = event is not None and event.finished
+            self.progress_bar.config(mode='determinate', value=PROGRESS_STEPS if done else 0)
+
+    def progress_reporter(self, stage):
+        """Reporter of an image stage, drained by update_progress on the Tk thread"""
+        return nullcontext(progress.ProgressReporter(self.progress_events, stage))
+
+    def run_ui_calls(self):
+        """Run what other threads posted to ui_calls, on the Tk thread, every 100 ms"""
+        while not self.ui_calls.empty():
+            self.ui_calls.get_nowait()()
+        self.root.after(100, self.run_ui_calls)
+
+    def post_log(self, message):
+        """log_message from the watcher or emulator thread, queued for the Tk thread"""
+        self.ui_calls.put(lambda: self.log_message(message))
 
     def log_message(self, message):
         self.status_text.insert(tk.END, message + "\n")
@@ -186,7 +250,11 @@ class DreamcastImageBuilder:
             'enable_emulator': '0',
             'enable_binhack': '1',
             'noob_mode': '0',
-            'emulator_path': 'emulator/emulator.exe'  # Default emulator path
+            'emulator_path': 'emulator/emulator.exe',  # Default emulator path
+            'iso_builder': 'native',
+            'incremental': '0',
+            'source_date_epoch': '',
+            'watch': '0'
         }
         with open(self.config_path, 'w') as f:
             config.write(f)
@@ -204,13 +272,22 @@ class DreamcastImageBuilder:
         self.enable_binhack_var.set(config.getboolean('SETTINGS', 'enable_binhack', fallback=True))
         self.noob_mode_var.set(config.getboolean('SETTINGS', 'noob_mode', fallback=False))
         self.emulator_path = config.get('SETTINGS', 'emulator_path', fallback='emulator/emulator.exe')
+        self.iso_builder = config.get('SETTINGS', 'iso_builder', fallback='native')
+        self.incremental = config.getboolean('SETTINGS', 'incremental', fallback=False)
+        self.slack = config.items('SLACK', raw=True) if config.has_section('SLACK') else []
+        self.source_date_epoch = config.get('SETTINGS', 'source_date_epoch', fallback='')
+        self.watch_var.set(config.getboolean('SETTINGS', 'watch', fallback=False))
         
         # Apply noob mode settings if enabled
         if self.noob_mode_var.get():
             self.toggle_noob_mode()
+        if self.watch_var.get():
+            self.toggle_watch()
 
     def save_settings(self):
-        config = configparser.ConfigParser()
+        # Keep other sections ([SLACK] etc.) intact
+        config = configparser.ConfigParser(interpolation=None)
+        config.read(self.config_path)
         config['SETTINGS'] = {
             'lba': self.lba_var.get(),
             'binary': self.binary_var.get(),
@@ -218,7 +295,11 @@ class DreamcastImageBuilder:
             'enable_emulator': '1' if self.enable_emulator_var.get() else '0',
             'enable_binhack': '1' if self.enable_binhack_var.get() else '0',
             'noob_mode': '1' if self.noob_mode_var.get() else '0',
-            'emulator_path': self.emulator_path
+            'emulator_path': self.emulator_path,
+            'iso_builder': self.iso_builder,
+            'incremental': '1' if self.incremental else '0',
+            'source_date_epoch': self.source_date_epoch,
+            'watch': '1' if self.watch_var.get() else '0'
         }
         with open(self.config_path, 'w') as f:
             config.write(f)
@@ -267,17 +348,12 @@ class DreamcastImageBuilder:
         self.log_message("in the 'emulator' directory or specify the path in settings.ini")
         return None
 
-    def run_command(self, cmd, check=True):
-        try:
-            result = subprocess.run(cmd, shell=True, capture_output=True, text=True, check=check)
-            return result.returncode == 0, result.stdout, result.stderr
-        except subprocess.CalledProcessError as e:
-            return False, e.stdout, e.stderr
-
     def verification(self, settings):
         self.log_message("Verifying files and patching binaries...")
         if not os.path.exists('data'):
             os.makedirs('data')
+        # IP.BIN template; it is copied to the staging area, not into data/
+        settings['ip_bin'] = os.path.join('data', 'IP.BIN')
         
         # Check if user-specified binary exists
         user_binary = settings['binary']
@@ -303,100 +379,31 @@ class DreamcastImageBuilder:
         # Update settings with the found binary
         settings['binary'] = found_binary
         
-        if os.name == 'nt':
-            for file in os.listdir('data'):
-                fp = os.path.join('data', file)
-                if os.path.isfile(fp):
-                    os.chmod(fp, 0o666)
-        
         if not os.path.exists('data/IP.BIN'):
             self.log_message("Warning: IP.BIN not found")
             if os.path.exists('system/precon/katana.bin'):
-                shutil.copy2('system/precon/katana.bin', 'data/IP.BIN')
-                self.log_message("Created IP.BIN from katana.bin")
+                settings['ip_bin'] = os.path.join('system', 'precon', 'katana.bin')
+                self.log_message("Using IP.BIN from katana.bin")
         
         if settings['binary'] == '1NOSDC.BIN' and os.path.exists('system/precon/lodoss-5167.bin'):
-            shutil.copy2('system/precon/lodoss-5167.bin', 'data/IP.BIN')
-            self.log_message("Created IP.BIN from lodoss-5167.bin for 1NOSDC.BIN")
+            settings['ip_bin'] = os.path.join('system', 'precon', 'lodoss-5167.bin')
+            self.log_message("Using IP.BIN from lodoss-5167.bin for 1NOSDC.BIN")
         
         return True
 
-    def binhack(self, settings):
-        if not self.enable_binhack_var.get():
-            self.log_message("Binhack disabled, skipping")
-            return
-        
-        lba = settings['lba']
-        binary = settings['binary']
-        self.log_message("Running hack4 commands...")
-        self.run_command('hack4.exe -w -p data\\*.bin', check=False)
-        self.run_command(f'hack4.exe -w -n {lba} data\\*.bin', check=False)
-        
-        if binary == '0WINCEOS.BIN' and os.path.exists('bincon.exe'):
-            self.run_command('bincon.exe data\\0WINCEOS.BIN data\\0WINCEOS.BIN data\\IP.BIN', check=False)
-        
-        if os.path.exists('binhack.exe'):
-            self.log_message("Running binhack...")
-            self.run_command(f'binhack.exe "data\\{binary}" "data\\IP.BIN" {lba} --output-dir "./data/" --quiet', check=False)
-        
-        if binary == '0WINCEOS.BIN' and os.path.exists('logo.exe'):
-            self.run_command('logo system\\wince.mr data\\IP.BIN', check=False)
+    def build_stamp(self, settings):
+        """Build name suffix; fixed when timestamps are pinned"""
+        if settings['source_date_epoch'] is not None:
+            return datetime.fromtimestamp(settings['source_date_epoch'], timezone.utc).strftime("%Y%m%d-%H%M%S")
+        return datetime.now().strftime("%Y%m%d-%H%M%S")
 
     def name_generator(self, settings):
-        build = datetime.now().strftime("%Y%m%d-%H%M%S")
+        build = self.build_stamp(settings)
         filename = f"{settings['volume']}-{build}.cdi"
         settings['build'] = build
         self.log_message(f'Name is set as "{filename}"')
         return filename
 
-    def make_image(self, settings):
-        if os.path.exists('test.iso'):
-            os.remove('test.iso')
-        sort_cmd = "-sort sortfile.str" if os.path.exists('sortfile.str') else ""
-        self.log_message("Building ISO with mkisofs...")
-        mkisofs_cmd = (
-            f'mkisofs -C 0,{settings["lba"]} -V "{settings["volume"]}" {sort_cmd} '
-            f'-exclude IP.BIN -G data\\IP.BIN -l -J -r -o test.iso data'
-        )
-        success, _, stderr = self.run_command(mkisofs_cmd)
-        if not success:
-            self.log_message(f"Error creating ISO: {stderr}")
-            return False
-        self.log_message("Converting ISO to CDI with iso2cdi...")
-        success, _, stderr = self.run_command(f'iso2cdi -i test.iso -l {settings["lba"]} -o image.cdi')
-        if not success:
-            self.log_message(f"Error converting to CDI: {stderr}")
-            return False
-        if os.path.exists('test.iso'):
-            os.remove('test.iso')
-        
-        # Generate final filename with timestamp (old version format)
-        build = datetime.now().strftime("%Y%m%d-%H%M%S")
-        final_filename = f"{settings['volume']}-{build}.cdi"
-        temp_filename = f"{settings['volume']}-{build}.tmp"
-        settings['build'] = build
-        
-        # Create archive directory if it doesn't exist
-        if not os.path.exists('archive'):
-            os.makedirs('archive')
-        
-        # Move any existing .cdi files to archive (except image.cdi)
-        for file in os.listdir('.'):
-            if file.endswith('.cdi') and file != 'image.cdi':
-                shutil.move(file, os.path.join('archive', file))
-        
-        # Rename the newly created image
-        if os.path.exists('image.cdi'):
-            os.rename('image.cdi', temp_filename)
-        
-        # Move the temp file to final filename
-        if os.path.exists(temp_filename):
-            os.rename(temp_filename, final_filename)
-        
-        settings['cdi_file'] = final_filename  # store final output for emulator
-        self.log_message(f'File "{final_filename}" is created.')
-        return True
-
     def run_emulator(self, settings):
         self.log_message("Running Emulator if enabled...")
         if not self.enable_emulator_var.get():
@@ -413,10 +420,28 @@ class DreamcastImageBuilder:
         if cdi_file and os.path.exists(cdi_file):
             abs_path = os.path.abspath(cdi_file)
             self.log_message(f"Starting emulator with {abs_path}")
-            self.run_command(f'"{emulator_path}" "{abs_path}"', check=False)
+            # Runs in the background; a previous instance is closed first
+            try:
+                self.emulator.launch(emulator_path, abs_path)
+            except OSError as e:
+                self.log_message(f"Error starting the emulator: {e}")
         else:
             self.log_message(f"CDI file not found: {cdi_file}")
 
+    def release_emulator(self):
+        """Close the emulator before the image it has open is replaced
+        (Windows won't move or rewrite an open file); run_emulator relaunches it"""
+        if self.emulator.close():
+            self.log_message("Closed the emulator until the new image is ready")
+
+    def emulator_exited(self, returncode):
+        """Called from the emulator's log thread when it closes by itself;
+        the messages go through ui_calls"""
+        if returncode != 0:
+            self.post_log(f"Emulator exited with code {returncode}")
+            for line in self.emulator.tail(5):
+                self.post_log(f"  {line}")
+
     def validate_inputs(self):
         try:
             lba = int(self.lba_var.get())
@@ -435,18 +460,27 @@ class DreamcastImageBuilder:
             self.log_message(f"Warning: Binary '{binary}' not found, will auto-detect")
             binary = ""
         
+        try:
+            epoch = isowriter.source_date_epoch(self.source_date_epoch)
+        except ValueError as e:
+            self.log_message(f"Warning: {e}, timestamps are not pinned")
+            epoch = None
+        
         return {
             'lba': str(lba),
             'binary': binary,
             'volume': volume,
             'enable_emulator': '1' if self.enable_emulator_var.get() else '0',
-            'enable_binhack': '1' if self.enable_binhack_var.get() else '0'
+            'enable_binhack': '1' if self.enable_binhack_var.get() else '0',
+            'iso_builder': self.iso_builder,
+            'incremental': '1' if self.incremental else '0',
+            'slack': self.slack,
+            'source_date_epoch': epoch
         }
 
     def build_image(self):
         self.status_text.delete(1.0, tk.END)
         self.progress_label.config(text="Building...")
-        self.start_spinner()
         
         system_path = os.path.join(os.getcwd(), 'system')
         if system_path not in os.environ['PATH']:
@@ -454,43 +488,99 @@ class DreamcastImageBuilder:
         
         settings = self.validate_inputs()
         self.save_settings()
+        self.builder.trace = buildtrace.BuildTrace()
         
         # Stop if no binary is found
-        if not self.verification(settings):
+        with self.builder.trace.stage('verification'):
+            verified = self.verification(settings)
+        if not verified:
             self.progress_label.config(text="Failed")
-            self.stop_spinner()
             self.log_message("Build process stopped - no binary file found")
             return  # Add this return to exit the function
         
-        if self.enable_binhack_var.get():
-            self.binhack(settings)
-        
-        filename = self.name_generator(settings)
+        self.name_generator(settings)
+        try:
+            built = self.builder.build(settings)
+        except BuildCancelled:
+            self.progress_label.config(text="Cancelled")
+            self.log_message("Build cancelled")
+            return
         
-        if self.make_image(settings):
+        if built:
             self.run_emulator(settings)
             self.progress_label.config(text="Completed")
         else:
             self.progress_label.config(text="Failed")
         
-        self.stop_spinner()
         self.log_message("Process completed.")
 
+    def cancel_build(self):
+        """Stop the running build at the next sector batch and kill the
+        process it is reading from; the builder then removes image.cdi"""
+        self.builder.cancel_build()
+
     def start_build_thread(self):
         self.build_button.config(state='disabled')
+        self.cancel_button.config(state='normal')
+        self.builder.cancel_requested.clear()
+        self.start_progress()
         thread = threading.Thread(target=self.build_image, daemon=True)
+        self.build_thread = thread
         thread.start()
         self.check_thread_status(thread)
 
+    def toggle_watch(self):
+        """Start or stop rebuilding whenever data/ changes"""
+        if self.watch_var.get():
+            if self.watch_thread is not None and self.watch_thread.is_alive():
+                return
+            self.watch_stop.clear()
+            self.watch_thread = threading.Thread(target=self.watch_data, daemon=True)
+            self.watch_thread.start()
+        else:
+            self.watch_stop.set()
+
+    def watch_data(self):
+        """Watcher thread: hand every settled burst of changes to the Tk thread
+        through ui_calls"""
+        if not os.path.exists('data'):
+            os.makedirs('data')
+        data_watcher = watcher.DirectoryWatcher('data')
+        self.post_log(f"Watching data/ for changes ({data_watcher.backend.name})")
+        try:
+            while not self.watch_stop.is_set():
+                # A build still running when files change again is stale: cancel it
+                changed = data_watcher.wait(self.watch_stop, on_change=lambda paths: self.cancel_build())
+                if changed:
+                    self.ui_calls.put(lambda n=len(changed): self.rebuild_after_changes(n))
+        finally:
+            data_watcher.close()
+
+    def rebuild_after_changes(self, count):
+        """Start a rebuild once the cancelled build (if any) has stopped"""
+        if self.build_thread is not None and self.build_thread.is_alive():
+            self.cancel_build()
+            self.root.after(50, lambda: self.rebuild_after_changes(count))
+            return
+        if self.watch_stop.is_set():
+            return
+        self.log_message(f"{count} change(s) in data/, rebuilding")
+        self.start_build_thread()
+
     def check_thread_status(self, thread):
-        if thread.is_alive():
+        running = thread.is_alive()
+        self.update_progress(running)
+        if running:
             self.root.after(100, lambda: self.check_thread_status(thread))
         else:
             self.build_button.config(state='normal')
+            self.cancel_button.config(state='disabled')
 
     def on_closing(self):
         self.save_settings()
-        self.stop_spinner()
+        self.watch_stop.set()
+        self.cancel_build()
+        self.emulator.close()
         self.root.destroy()
 
     def run(self):
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+"""
+benchmark.py - Throughput benchmarks for the mkcdi toolchain
+
+usage: benchmark.py [--iso-sizes 10,100] [--save baseline.json] [--compare baseline.json]
+
+Generates synthetic fixtures (Katana and WinCE boot binaries with an embedded
+CD001 block, IP.BIN templates from precon/, and ISO images of the requested
+sizes) and times the hot paths of the tools on them:
+
+  iso2cdi.create_cdi_image          ISO -> CDI framing
+  binhack.search_hack_offset        CD001 signature scan
+  binhack.hack_bootstrap            IP.BIN bootstrap patch
+  hack4.DreamcastPatcher.find_pattern / find_uint32_value / build_patch_plan
+  bincon.convert_binary             0WINCEOS.BIN conversion
+
+Every benchmark reports its median latency, throughput (MB/s) and peak
+Python memory; baselines are compared on the best of the timed runs.
+
+--save writes the results as a baseline; --compare checks them against one
+and exits with 1 when anything got slower than the tolerance allows.
+
+Fixtures are kept in tmp/bench next to this script (ignored by git) and
+reused between runs.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import statistics
+import struct
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import binhack
+import bincon
+import hack4
+import iso2cdi
+
+BASELINE_VERSION = 1
+MB = 1024 * 1024
+
+# Shortest timed sample; quick calls are repeated until it is reached
+MIN_SAMPLE_TIME = 0.05
+MAX_LOOPS = 10000
+
+# Katana binaries keep the LBA 8 bytes before the CD001 volume descriptor
+KATANA_LBA_OFFSET = 8
+DEFAULT_LBA = 45000
+
+
+# -----------------------------------------------------------------------------
+# Fixtures
+# -----------------------------------------------------------------------------
+
+def _noise(size: int, seed: int) -> bytearray:
+    """Deterministic incompressible filler; one random MB repeated"""
+    n = min(size, MB)
+    block = random.Random(seed).getrandbits(8 * n).to_bytes(n, 'little')
+    data = bytearray(block * (size // len(block) + 1))
+    del data[size:]
+    return data
+
+
+def _scrub(data: bytearray, patterns: List[bytes]) -> None:
+    """Remove accidental matches of the signatures we plant ourselves"""
+    for pattern in patterns:
+        pos = data.find(pattern)
+        while pos != -1:
+            data[pos] ^= 0xFF
+            pos = data.find(pattern, pos)
+
+
+def make_katana_binary(size: int, seed: int = 1) -> bytearray:
+    """1ST_READ.BIN-like binary with a CD001 block near the end (worst case scan),
+    plus a sprinkling of hack4 unprotect patterns and old LBA references"""
+    data = _noise(size, seed)
+    _scrub(data, [binhack.BOOT_SIGN_REF, bytes([0xCD, 0xE4, 0x43, 0x6A]), struct.pack('<I', DEFAULT_LBA)])
+    sign = size - 0x1000
+    data[sign - KATANA_LBA_OFFSET:sign - KATANA_LBA_OFFSET + 4] = struct.pack('<I', DEFAULT_LBA)
+    data[sign:sign + len(binhack.BOOT_SIGN_REF)] = binhack.BOOT_SIGN_REF
+    rng = random.Random(seed + 1)
+    for _ in range(16):
+        pos = rng.randrange(0, sign - 0x100) & ~1
+        data[pos:pos + 4] = bytes([0xCD, 0xE4, 0x43, 0x6A])
+        pos = rng.randrange(0, sign - 0x100) & ~3
+        data[pos:pos + 4] = struct.pack('<I', DEFAULT_LBA + 150)
+    return data
+
+
+def make_wince_binary(size: int, seed: int = 2) -> bytearray:
+    """0WINCEOS.BIN-like binary: the Katana fixture with the WinCE check bytes
+    in place of the LBA in front of CD001"""
+    data = make_katana_binary(size, seed)
+    sign = data.find(binhack.BOOT_SIGN_REF)
+    data[sign - KATANA_LBA_OFFSET:sign - KATANA_LBA_OFFSET + 4] = binhack.WINCE_CHECK_REF
+    return data
+
+
+def make_iso(size: int, seed: int = 3) -> bytearray:
+    """Sector-aligned ISO-sized payload with a PVD at sector 16"""
+    sectors = size // iso2cdi.SECTOR_SIZE
+    data = _noise(sectors * iso2cdi.SECTOR_SIZE, seed)
+    # Some all-zero runs so the sparse paths get exercised as well
+    data[:16 * iso2cdi.SECTOR_SIZE] = bytes(16 * iso2cdi.SECTOR_SIZE)
+    data[16 * iso2cdi.SECTOR_SIZE:16 * iso2cdi.SECTOR_SIZE + 6] = b'\x01CD001'
+    return data
+
+
+def ensure_fixture(path: str, size: int, factory: Callable[[int], bytearray]) -> str:
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        with open(path, 'wb') as f:
+            f.write(factory(size))
+    return path
+
+
+def precon_templates(precon_dir: str) -> Dict[str, bytes]:
+    templates = {}
+    if os.path.isdir(precon_dir):
+        for name in sorted(os.listdir(precon_dir)):
+            with open(os.path.join(precon_dir, name), 'rb') as f:
+                templates[name] = f.read(binhack.BOOTSECTOR_SIZE)
+    if not templates:
+        # No templates shipped: a blank 32 KB boot sector still exercises the patch
+        templates['blank.bin'] = bytes(binhack.BOOTSECTOR_SIZE)
+    return templates
+
+
+# -----------------------------------------------------------------------------
+# Measurement
+# -----------------------------------------------------------------------------
+
+def measure(fn: Callable[[], object], size: int, repeat: int) -> dict:
+    """Median/best wall time over repeat runs, then one traced run for peak memory.
+
+    Fast calls are looped so every sample lasts at least MIN_SAMPLE_TIME.
+    """
+    times = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        fn()
+        first = time.perf_counter() - start
+        loops = max(1, min(MAX_LOOPS, int(MIN_SAMPLE_TIME / max(first, 1e-9))))
+
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(loops):
+                fn()
+            times.append((time.perf_counter() - start) / loops)
+
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+    median = statistics.median(times)
+    return {
+        'size': size,
+        'median_s': median,
+        'best_s': min(times),
+        'mb_s': (size / MB) / median if median > 0 else 0.0,
+        'peak_bytes': peak,
+    }
+
+
+def run_benchmarks(workdir: str, iso_sizes: List[int], binary_size: int, repeat: int,
+                   only: Optional[List[str]] = None) -> Dict[str, dict]:
+    os.makedirs(workdir, exist_ok=True)
+    results = {}
+
+    def bench(name: str, fn: Callable[[], object], size: int) -> None:
+        if only and not any(o in name for o in only):
+            return
+        result = measure(fn, size, repeat)
+        results[name] = result
+        print(f"{name:<40} {result['median_s'] * 1000:10.3f} ms {result['mb_s']:10.1f} MB/s "
+              f"{result['peak_bytes'] / MB:8.1f} MB peak")
+
+    katana_path = ensure_fixture(os.path.join(workdir, f'katana-{binary_size}.bin'), binary_size,
+                                 make_katana_binary)
+    wince_path = ensure_fixture(os.path.join(workdir, f'wince-{binary_size}.bin'), binary_size,
+                                make_wince_binary)
+
+    # binhack
+    for label, path in (('katana', katana_path), ('wince', wince_path)):
+        def scan(path=path):
+            with open(path, 'rb') as f:
+                return binhack.search_hack_offset(f, binary_size)
+        bench(f'binhack.search_hack_offset[{label}]', scan, binary_size)
+
+    with open(katana_path, 'rb') as f:
+        katana = f.read()
+    for name, template in precon_templates(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                        'precon')).items():
+        def bootstrap(template=template):
+            binhack.hack_bootstrap(io.BytesIO(template), len(katana), io.BytesIO(katana), quiet=True)
+        bench(f'binhack.hack_bootstrap[{name}]', bootstrap, len(template))
+
+    # hack4
+    patcher = hack4.DreamcastPatcher(hack4.Config())
+    bench('hack4.find_pattern[unprotect]',
+          lambda: patcher.find_pattern(katana, bytes([0xCD, 0xE4, 0x43, 0x6A])), len(katana))
+    bench('hack4.find_uint32_value[lba+150]',
+          lambda: patcher.find_uint32_value(katana, DEFAULT_LBA + 150), len(katana))
+    config = hack4.Config()
+    config.old_pos = DEFAULT_LBA
+    config.hack0 = config.hack3 = config.unprotect = True
+    planner = hack4.DreamcastPatcher(config)
+    bench('hack4.build_patch_plan[-0 -3 -p]', lambda: planner.build_patch_plan(katana), len(katana))
+    config.literal_pools = True
+    pool_planner = hack4.DreamcastPatcher(config)
+    bench('hack4.build_patch_plan[-0 -3 -p -l]', lambda: pool_planner.build_patch_plan(katana), len(katana))
+
+    # bincon
+    bincon_out = os.path.join(workdir, 'bincon.out')
+    bench('bincon.convert_binary', lambda: bincon.convert_binary(wince_path, bincon_out), binary_size)
+
+    # iso2cdi
+    for size in iso_sizes:
+        iso_path = ensure_fixture(os.path.join(workdir, f'image-{size // MB}M.iso'), size, make_iso)
+        cdi_path = os.path.join(workdir, 'image.cdi')
+        bench(f'iso2cdi.create_cdi_image[{size // MB}M]',
+              lambda iso_path=iso_path: iso2cdi.create_cdi_image(iso_path, cdi_path, 11702), size)
+        if os.path.exists(cdi_path):
+            os.remove(cdi_path)
+
+    if os.path.exists(bincon_out):
+        os.remove(bincon_out)
+    return results
+
+
+# -----------------------------------------------------------------------------
+# Baselines
+# -----------------------------------------------------------------------------
+
+def save_baseline(path: str, results: Dict[str, dict]) -> None:
+    with open(path, 'w') as f:
+        json.dump({'version': BASELINE_VERSION, 'python': platform.python_version(),
+                   'platform': platform.platform(), 'results': results}, f, indent=1, sort_keys=True)
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """Benchmarks that are slower than baseline * (1 + tolerance).
+
+    Compares best times, which are far less sensitive to background load
+    than medians.
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        old = baseline.get(name)
+        if not old or old['best_s'] <= 0:
+            continue
+        ratio = result['best_s'] / old['best_s']
+        marker = ''
+        if ratio > 1 + tolerance:
+            marker = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:<40} {old['best_s'] * 1000:10.3f} -> {result['best_s'] * 1000:10.3f} ms "
+              f"({ratio:5.2f}x){marker}")
+    return regressions
+
+
+def parse_sizes(value: str) -> List[int]:
+    try:
+        return [int(float(v) * MB) for v in value.split(',') if v.strip()]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size list: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the mkcdi tools on synthetic Dreamcast fixtures',
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python benchmark.py --save baseline.json
+  python benchmark.py --compare baseline.json --tolerance 0.2
+  python benchmark.py --iso-sizes 10,100,700 --only iso2cdi
+        """
+    )
+    parser.add_argument('--workdir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tmp', 'bench'),
+                        help='Where fixtures are generated and kept (default: tmp/bench)')
+    parser.add_argument('--iso-sizes', type=parse_sizes, default=parse_sizes('10,100'),
+                        help='ISO fixture sizes in MB, comma separated (default: 10,100)')
+    parser.add_argument('--binary-size', type=float, default=2, help='Boot binary fixture size in MB (default: 2)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs per benchmark (default: 3)')
+    parser.add_argument('--only', action='append', help='Run only benchmarks whose name contains this')
+    parser.add_argument('--save', help='Write the results to this baseline JSON')
+    parser.add_argument('--compare', help='Compare against this baseline JSON')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed slowdown before failing, as a fraction (default: 0.25)')
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        try:
+            with open(args.compare, 'r') as f:
+                baseline = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"Error reading baseline: {e}")
+            return 1
+        if baseline.get('version') != BASELINE_VERSION:
+            print(f"Error: unsupported baseline version in {args.compare}")
+            return 1
+
+    results = run_benchmarks(args.workdir, args.iso_sizes, int(args.binary_size * MB),
+                             max(1, args.repeat), args.only)
+
+    if args.save:
+        save_baseline(args.save, results)
+        print(f"Baseline saved: {args.save}")
+
+    if baseline:
+        print()
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than baseline by more than {args.tolerance:.0%}")
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -20,22 +20,75 @@ import sys
 import os
 import argparse
 
+# IP.BIN byte holding the WINCE flag, and its value without the flag
+WINCE_FLAG_OFFSET = 0x3E
+WINCE_FLAG_OFF = b'\x30'
+
+# The WinCE header that gets dropped, and the tail block that gets repeated
+HEADER_SIZE = 0x800
+TAIL_SIZE = 0x800
+
+# -----------------------------------------------------------------------------
+# Library functions: raise OSError on failure, never print
+# -----------------------------------------------------------------------------
+
+def clear_wince_flag(bootsector_path):
+    """Set byte 0x3E of IP.BIN to 0x30; returns False if it already was"""
+    with open(bootsector_path, 'r+b') as bootsector_file:
+        bootsector_file.seek(WINCE_FLAG_OFFSET)
+        if bootsector_file.read(1) == WINCE_FLAG_OFF:
+            return False
+        bootsector_file.seek(WINCE_FLAG_OFFSET)
+        bootsector_file.write(WINCE_FLAG_OFF)
+        return True
+
+def is_converted(binary_path):
+    """A converted binary ends with the same 2 KB block twice"""
+    with open(binary_path, 'rb') as binary_in:
+        lsize = binary_in.seek(0, os.SEEK_END)
+        if lsize < 2 * TAIL_SIZE:
+            return False
+        binary_in.seek(lsize - 2 * TAIL_SIZE)
+        tail = binary_in.read(2 * TAIL_SIZE)
+    return tail[:TAIL_SIZE] == tail[TAIL_SIZE:]
+
+def convert_file(input_path, output_path):
+    """Drop the 2 KB WinCE header and append the last 2 KB again.
+    output_path may be input_path. Returns the size of the converted binary."""
+    with open(input_path, 'rb') as binary_in:
+        binary_in.seek(HEADER_SIZE)
+        binary_data = binary_in.read()
+    with open(output_path, 'wb') as binary_out:
+        binary_out.write(binary_data)
+        binary_out.write(binary_data[-TAIL_SIZE:])
+    return len(binary_data) + TAIL_SIZE
+
+def bincon(binary_path, output_path, bootsector_path=None):
+    """What bincon.exe <binary> <output> <IP.BIN> does: convert the binary and
+    clear the WINCE flag, or leave both alone if it is already converted.
+    Without bootsector_path IP.BIN is left to the caller (see ipbin.py).
+    Returns {'converted': bool, 'flag_cleared': bool, 'size': int}."""
+    result = {'converted': False, 'flag_cleared': False, 'size': os.path.getsize(binary_path)}
+    if is_converted(binary_path):
+        return result
+    result['size'] = convert_file(binary_path, output_path)
+    result['converted'] = True
+    if bootsector_path:
+        result['flag_cleared'] = clear_wince_flag(bootsector_path)
+    return result
+
+# -----------------------------------------------------------------------------
+# Command line helpers
+# -----------------------------------------------------------------------------
+
 def remove_wince_flag(bootsector_path):
     """Remove WINCE flag from IP.BIN by setting byte 0x3E to 0x30"""
     try:
-        with open(bootsector_path, 'r+b') as bootsector_file:
-            bootsector_file.seek(0x3E)
-            current_byte = bootsector_file.read(1)
-            
-            if current_byte == b'\x30':
-                print(f"WINCE flag already removed from {bootsector_path}")
-                return True
-                
-            bootsector_file.seek(0x3E)
-            bootsector_file.write(b'\x30')
+        if clear_wince_flag(bootsector_path):
             print(f"Removed WINCE flag from {bootsector_path} (set byte 0x3E to 0x30)")
-            return True
-            
+        else:
+            print(f"WINCE flag already removed from {bootsector_path}")
+        return True
     except Exception as e:
         print(f"Error modifying {bootsector_path}: {e}")
         return False
@@ -43,35 +96,12 @@ def remove_wince_flag(bootsector_path):
 def convert_binary(input_path, output_path):
     """Convert 0WINCEOS.BIN to 1ST_READ.BIN format"""
     try:
-        with open(input_path, 'rb') as binary_in:
-            # Get file size
-            binary_in.seek(0, os.SEEK_END)
-            lsize = binary_in.tell()
-            binary_in.seek(0)
-            
-            # Check if already converted
-            binary_in.seek(lsize - 0x1000)
-            chunk1 = binary_in.read(0x800)
-            
-            binary_in.seek(lsize - 0x800)
-            chunk2 = binary_in.read(0x800)
-            
-            if chunk1 == chunk2:
-                print(f"{input_path} is already in converted format")
-                return False
-                
-            # Read and convert the binary
-            binary_in.seek(0x800)
-            binary_data = binary_in.read(lsize - 0x800)
-            
-            # Write converted binary
-            with open(output_path, 'wb') as binary_out:
-                binary_out.write(binary_data)
-                binary_out.write(binary_data[-0x1000:-0x800])  # Append last 2k again
-            
-            print(f"Successfully converted {input_path} to {output_path}")
-            return True
-            
+        if is_converted(input_path):
+            print(f"{input_path} is already in converted format")
+            return False
+        convert_file(input_path, output_path)
+        print(f"Successfully converted {input_path} to {output_path}")
+        return True
     except Exception as e:
         print(f"Error converting {input_path}: {e}")
         return False
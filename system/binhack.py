@@ -13,9 +13,11 @@ import os
 import sys
 import argparse
 import shutil
-from typing import BinaryIO
+from typing import BinaryIO, Optional
 from io import BytesIO
 
+import sigscan
+
 # -----------------------------------------------------------------------------
 # Constants
 # -----------------------------------------------------------------------------
@@ -45,6 +47,9 @@ BOOTSECTOR_OS_FLAG = b"0"
 BOOTSECTOR_HACK_BOOTSIZE_OFFSET = 0x639C
 BOOTSECTOR_HACK_OFFSET = 0x3704
 
+# Linux ioctl to share a file's extents (btrfs, XFS, ...)
+FICLONE = 0x40049409
+
 # Bootstrap hack data (truncated for brevity, full data would go here)
 BOOTSECTOR_HACK_DATA = bytes([
 	0x46, 0x6F, 0x72, 0x20, 0x4A, 0x41, 0x50, 0x41, 0x4E, 0x2C, 0x54, 0x41, 0x49, 0x57, 0x41, 0x4E,
@@ -807,15 +812,9 @@ def is_bincon(boot_file: BinaryIO) -> bool:
 
 def search_hack_offset(boot_file: BinaryIO, boot_size: int) -> int:
     """Search for the CD001 offset in the boot file"""
-    boot_file.seek(0)
-    boot_data = boot_file.read(boot_size)
-    
-    # Search for the CD001 signature
-    for i in range(boot_size - BOOT_HACK_SIGNATURE_SIZE):
-        if boot_data[i:i+BOOT_HACK_SIGNATURE_SIZE] == BOOT_SIGN_REF:
-            return i - 8  # Return the position 8 bytes before the signature
-    
-    return -1  # Not found
+    # Returns the position 8 bytes before the first signature, -1 if not found
+    with sigscan.file_buffer(boot_file) as boot_data:
+        return sigscan.scan_boot_binary(boot_data, boot_size).hack_offset
 
 def hack_katana_boot_binary(boot_file: BinaryIO, hack_offset: int, lba: int, output_path: str) -> bool:
     """Hack the Katana boot binary with the new LBA and save to output path"""
@@ -836,6 +835,61 @@ def hack_katana_boot_binary(boot_file: BinaryIO, hack_offset: int, lba: int, out
     
     return True
 
+def copy_boot_binary(src: str, dst: str) -> str:
+    """Make dst a copy of src without reading it into memory; returns the method used.
+    
+    Tries a copy-on-write reflink, then an in-kernel copy_file_range, then
+    shutil's copy (sendfile on Linux). Never a hardlink: dst gets patched.
+    Nothing is copied when dst already is src.
+    """
+    if os.path.exists(dst):
+        if os.path.samefile(src, dst):
+            return 'in place'
+        # Don't write through a hardlink into some other file
+        os.remove(dst)
+    if os.name != 'nt':
+        try:
+            import fcntl
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return 'reflink'
+        except (ImportError, OSError):
+            pass
+    if hasattr(os, 'copy_file_range'):
+        try:
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                remaining = os.fstat(s.fileno()).st_size
+                while remaining > 0:
+                    copied = os.copy_file_range(s.fileno(), d.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            if remaining == 0:
+                return 'copy_file_range'
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return 'copy'
+
+def write_at(path: str, offset: int, data: bytes) -> None:
+    """Overwrite len(data) bytes of an existing file in place"""
+    fd = os.open(path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+    try:
+        os.lseek(fd, offset, os.SEEK_SET)
+        if os.write(fd, data) != len(data):
+            raise IOError(f"short write to {path}")
+    finally:
+        os.close(fd)
+
+def hack_katana_boot_file(boot_path: str, hack_offset: int, lba: int, output_path: str) -> str:
+    """Copy the Katana boot binary to output path and patch the LBA with a 4-byte write.
+    Returns the copy method used, or '' if there is no hack offset."""
+    if hack_offset == -1:
+        return ''
+    method = copy_boot_binary(boot_path, output_path)
+    write_at(output_path, hack_offset, struct.pack('<I', lba))
+    return method
+
 def hack_bootstrap(iphak_file: BinaryIO, boot_size: int, boot_file: BinaryIO, quiet: bool = False):
     """Hack the IP.BIN bootstrap"""
     # Set all region flags
@@ -861,6 +915,99 @@ def hack_bootstrap(iphak_file: BinaryIO, boot_size: int, boot_file: BinaryIO, qu
     iphak_file.seek(BOOTSECTOR_HACK_BOOTSIZE_OFFSET)
     iphak_file.write(struct.pack('<I', boot_size))
 
+class BinhackError(Exception):
+    """A binhack step failed; code is the command line exit status"""
+    
+    def __init__(self, code: int, message: str, details: str = ''):
+        super().__init__(f"{message}: {details}" if details else message)
+        self.code = code
+        self.message = message
+        self.details = details
+
+class BinhackResult:
+    """What hack_files did"""
+    
+    def __init__(self, scan: sigscan.BootScan, boot_output: str, ip_output: str,
+                 real_lba: int, copy_method: str):
+        self.scan = scan                  # signatures found in the boot binary
+        self.boot_output = boot_output
+        self.ip_output = ip_output
+        self.real_lba = real_lba          # LBA written to a Katana binary, -1 for WinCE
+        self.copy_method = copy_method    # how the boot binary was copied
+
+def hack_files(boot_path: str, ip_path: Optional[str], lba: int, output_dir: str) -> BinhackResult:
+    """Patch a boot binary and IP.BIN into output_dir (which may be their own directory).
+    
+    With ip_path None only the boot binary is patched, for callers that
+    compose IP.BIN themselves (see ipbin.py). Nothing is printed; raises
+    BinhackError on failure.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    boot_output = os.path.join(output_dir, os.path.basename(boot_path))
+    ip_output = os.path.join(output_dir, os.path.basename(ip_path)) if ip_path else ''
+    
+    # Open source IP.BIN
+    iphackbuf = b''
+    try:
+        if ip_path:
+            with open(ip_path, 'rb') as ipbin:
+                iphackbuf = ipbin.read(BOOTSECTOR_SIZE)
+    except IOError as e:
+        raise BinhackError(-1, f"Error opening source bootsector file: {ip_path}", str(e))
+    
+    # Open BOOT.BIN for reading only; it is scanned through mmap, never loaded
+    try:
+        with open(boot_path, 'rb') as boot, sigscan.file_buffer(boot) as boot_data:
+            # Getting the CD001 offset (all candidates, in one pass)
+            scan = sigscan.scan_boot_binary(boot_data)
+            # The bincon check only needs the first bytes
+            boot_head = bytes(boot_data[:BOOT_HACK_BINCON_CHECK_SIZE])
+    except IOError as e:
+        raise BinhackError(-2, f"Error opening binary file: {boot_path}", str(e))
+    
+    # -------------------------------------------------------------------------
+    # HACKING THE BOOT.BIN
+    # -------------------------------------------------------------------------
+    
+    real_lba = -1
+    if scan.is_wince:
+        # WinCE Executable - just copy the file without modification
+        try:
+            method = copy_boot_binary(boot_path, boot_output)
+        except (IOError, OSError) as e:
+            raise BinhackError(-2, f"Error copying binary file to: {boot_output}", str(e))
+    else:
+        # Katana Executable - patch the LBA
+        real_lba = lba + 166
+        try:
+            method = hack_katana_boot_file(boot_path, scan.hack_offset, real_lba, boot_output)
+        except (IOError, OSError) as e:
+            raise BinhackError(-2, f"Error writing binary file: {boot_output}", str(e))
+        if not method:
+            if scan.too_close:
+                raise BinhackError(-3, f"Invalid binary file - CD001 signature at 0x{scan.too_close[0]:x} "
+                                       f"is too close to the file start for the LBA field before it")
+            raise BinhackError(-3, "Invalid binary file - CD001 signature not found")
+    
+    # -------------------------------------------------------------------------
+    # HACKING THE IP.BIN
+    # -------------------------------------------------------------------------
+    
+    if not ip_path:
+        return BinhackResult(scan, boot_output, ip_output, real_lba, method)
+    
+    # Create the output bootsector file
+    try:
+        with open(ip_output, 'wb') as iphak:
+            # Write the output file with the original content of the source IP.BIN
+            iphak.write(iphackbuf)
+            # Hack the bootstrap
+            hack_bootstrap(iphak, scan.size, BytesIO(boot_head), quiet=True)
+    except IOError as e:
+        raise BinhackError(-4, f"Error creating output bootsector file: {ip_output}", str(e))
+    
+    return BinhackResult(scan, boot_output, ip_output, real_lba, method)
+
 # -----------------------------------------------------------------------------
 # Main Program
 # -----------------------------------------------------------------------------
@@ -886,7 +1033,8 @@ Output Files:
   - Modified boot binary (same filename as input) in output directory
   - Modified IP.BIN (same filename) in output directory
 
-Note: Original files are never modified - only copies in output directory are changed.
+Note: Original files are never modified - only copies in output directory are changed
+(when the output directory is the input directory, the LBA is patched in place).
         """
     )
     
@@ -943,82 +1091,41 @@ Note: Original files are never modified - only copies in output directory are ch
         print(f"[DEBUG] Output directory: {output_dir}")
         print(f"[DEBUG] LBA value: {lba_value}")
     
-    # Open source IP.BIN
     try:
-        with open(ipname, 'rb') as ipbin:
-            iphackbuf = ipbin.read(BOOTSECTOR_SIZE)
-    except IOError as e:
-        print(f"Error opening source bootsector file: {ipname}")
-        print(f"Error details: {e}")
-        return -1
-    
-    # Open BOOT.BIN for reading only
-    try:
-        with open(bootname, 'rb') as boot:
-            boot_data = boot.read()
-            bootsize = len(boot_data)
-    except IOError as e:
-        print(f"Error opening binary file: {bootname}")
-        print(f"Error details: {e}")
-        return -2
-    
-    # Create a temporary file-like object for the boot data
-    boot_file_obj = BytesIO(boot_data)
+        result = hack_files(bootname, ipname, lba_value, output_dir)
+    except BinhackError as e:
+        print(e.message)
+        if e.details:
+            print(f"Error details: {e.details}")
+        return e.code
+    scan = result.scan
     
-    # Getting the CD001 offset
-    hackoffset = search_hack_offset(boot_file_obj, bootsize)
-    boot_file_obj.seek(0)  # Reset position
+    if scan.ambiguous:
+        candidates = ', '.join(f"0x{c:x}" for c in scan.candidates)
+        print(f"Warning: {len(scan.candidates)} CD001 signatures found ({candidates}), using 0x{scan.hack_offset:x}")
+    for s in scan.too_close:
+        print(f"Warning: CD001 signature at 0x{s:x} is too close to the file start, ignored")
     
     # Debug information (only show if debug enabled and not quiet)
     if args.debug and not args.quiet:
-        print(f"[DEBUG] Boot filesize: {bootsize}")
-        print(f"[DEBUG] Hack Offset: {hackoffset}")
+        print(f"[DEBUG] Boot filesize: {scan.size}")
+        print(f"[DEBUG] Hack Offset: {scan.hack_offset}")
+        print(f"[DEBUG] Scan: {scan.describe()}")
         print(f"[DEBUG] Output binary: {boot_output_path}")
         print(f"[DEBUG] Output bootsector: {ip_output_path}")
+        if scan.is_wince:
+            print(f"[DEBUG] Binary copied ({result.copy_method})")
+        else:
+            print(f"[DEBUG] Binary copied ({result.copy_method}), LBA written at 0x{scan.hack_offset:x}")
     
-    # -------------------------------------------------------------------------
-    # HACKING THE BOOT.BIN
-    # -------------------------------------------------------------------------
-    
-    if is_wince(boot_file_obj, hackoffset):
-        # WinCE Executable - just copy the file without modification
-        with open(boot_output_path, 'wb') as out_boot:
-            out_boot.write(boot_data)
-        if not args.quiet:
+    if not args.quiet:
+        if scan.is_wince:
             print(f"Windows CE binary detected: {boot_basename} copied to output directory")
-    else:
-        # Katana Executable - patch the LBA
-        real_lba = lba_value + 166
-        
-        # Hacking the Katana Binary!
-        if hack_katana_boot_binary(boot_file_obj, hackoffset, real_lba, boot_output_path):
-            if not args.quiet:
-                print(f"Katana binary {boot_basename} successfully hacked with LBA {real_lba}")
         else:
-            print("Invalid binary file - CD001 signature not found")
-            return -3
-    
-    # -------------------------------------------------------------------------
-    # HACKING THE IP.BIN
-    # -------------------------------------------------------------------------
-    
-    # Create the output bootsector file
-    try:
-        with open(ip_output_path, 'wb') as iphak:
-            # Write the output file with the original content of the source IP.BIN
-            iphak.write(iphackbuf)
-            
-            # Reset boot file object position for bincon check
-            boot_file_obj.seek(0)
-            # Hack the bootstrap
-            hack_bootstrap(iphak, bootsize, boot_file_obj, args.quiet)
-            
-        if not args.quiet:
-            print(f"Bootsector {ip_basename} successfully created in output directory")
-    except IOError as e:
-        print(f"Error creating output bootsector file: {ip_output_path}")
-        print(f"Error details: {e}")
-        return -4
+            print(f"Katana binary {boot_basename} successfully hacked with LBA {result.real_lba}")
+        if scan.bincon:
+            print("Bincon detected, OS flag set to 0.")
+        print(f"Bootsector {ip_basename} successfully created in output directory")
     
     # Finishing...
     if not args.quiet:
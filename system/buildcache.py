@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+"""
+buildcache.py - Content-hash build cache for mkcdi
+
+A build is identified by the content hashes of every file in data/, the tool
+files in system/ and the build settings (LBA, volume, binary, ...). When the
+same key was built before and its CDI still exists, the image is reused
+(reflink, hardlink or, as a last resort, a copy) instead of rebuilt. Each
+build records the size and mtime its CDI had; an image changed since (e.g.
+updated in place by cdiupdate for a later build) no longer counts as that
+build.
+
+File hashes are cached by size and mtime in archive/buildcache.json and
+missing ones are computed in parallel, so a no-op build only has to stat
+the tree.
+
+usage: buildcache.py <data directory> [--cache archive/buildcache.json]
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+CACHE_FILE = 'buildcache.json'
+CACHE_VERSION = 2
+
+# Read size while hashing; hashlib releases the GIL for large updates
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Linux FICLONE ioctl (_IOW(0x94, 9, int))
+FICLONE = 0x40049409
+
+
+def hash_file(path: str) -> str:
+    """Content hash of one file"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def list_files(root: str) -> List[str]:
+    """All regular files below root, sorted, with '/' separators"""
+    result = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for name in sorted(filenames):
+            result.append(os.path.join(dirpath, name).replace('\\', '/'))
+    return result
+
+
+def clone_file(src: str, dst: str) -> str:
+    """Make dst share src's data; returns the method used.
+
+    Tries a copy-on-write reflink first, then a hardlink, then a plain copy.
+    """
+    if os.name != 'nt':
+        try:
+            import fcntl
+            with open(src, 'rb') as s, open(dst, 'wb') as d:
+                fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            return 'reflink'
+        except (ImportError, OSError):
+            if os.path.exists(dst):
+                os.remove(dst)
+    try:
+        os.link(src, dst)
+        return 'hardlink'
+    except OSError:
+        shutil.copy2(src, dst)
+        return 'copy'
+
+
+class BuildCache:
+    """File hash cache plus build key -> (CDI, size, mtime) index, stored as one JSON file"""
+
+    def __init__(self, path: str, workers: Optional[int] = None):
+        self.path = path
+        self.workers = workers or min(32, (os.cpu_count() or 1) + 4)
+        self.hashes: Dict[str, Tuple[int, int, str]] = {}
+        self.builds: Dict[str, list] = {}
+        self._dirty = False
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != CACHE_VERSION:
+            return
+        self.hashes = {p: tuple(v) for p, v in data.get('hashes', {}).items()}
+        self.builds = data.get('builds', {})
+
+    def save(self) -> None:
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'hashes': self.hashes, 'builds': self.builds}, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def file_hashes(self, paths: Iterable[str]) -> Dict[str, str]:
+        """Content hashes, reusing cached ones whose size and mtime still match"""
+        result = {}
+        todo = []
+        for path in paths:
+            st = os.stat(path)
+            cached = self.hashes.get(path)
+            if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+                result[path] = cached[2]
+            else:
+                todo.append((path, st.st_size, st.st_mtime_ns))
+
+        if todo:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                for (path, size, mtime_ns), digest in zip(todo, pool.map(hash_file, [t[0] for t in todo])):
+                    self.hashes[path] = (size, mtime_ns, digest)
+                    result[path] = digest
+            self._dirty = True
+        return result
+
+    def key(self, data_dir: str, tool_files: Iterable[str] = (), settings: Optional[dict] = None) -> str:
+        """Build key over data_dir contents, tool files and settings"""
+        data_files = list_files(data_dir)
+        tools = sorted(p.replace('\\', '/') for p in tool_files if os.path.isfile(p))
+        hashes = self.file_hashes(data_files + tools)
+
+        h = hashlib.blake2b(digest_size=20)
+        for path in data_files:
+            rel = os.path.relpath(path, data_dir).replace('\\', '/')
+            h.update(f"data:{rel}:{hashes[path]}\n".encode('utf-8'))
+        for path in tools:
+            h.update(f"tool:{os.path.basename(path)}:{hashes[path]}\n".encode('utf-8'))
+        h.update(json.dumps(settings or {}, sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, key: str, search_dirs: Iterable[str] = ('.', 'archive')) -> Optional[str]:
+        """Path of a previously built CDI for key, if it still exists unchanged.
+        An entry whose image is gone or was modified since is dropped."""
+        entry = self.builds.get(key)
+        if not entry:
+            return None
+        path, size, mtime_ns = entry
+        # Images move to archive/ when the next build is made
+        candidates = [path] + [os.path.join(d, os.path.basename(path)) for d in search_dirs]
+        for candidate in candidates:
+            try:
+                st = os.stat(candidate)
+            except OSError:
+                continue
+            if st.st_size == size and st.st_mtime_ns == mtime_ns:
+                return candidate
+        # Gone, or the name now holds a different image
+        del self.builds[key]
+        self._dirty = True
+        return None
+
+    def store(self, key: str, cdi_path: str) -> None:
+        """Record cdi_path, as it is now, as the image built for key"""
+        st = os.stat(cdi_path)
+        self.builds[key] = [cdi_path.replace('\\', '/'), st.st_size, st.st_mtime_ns]
+        self._dirty = True
+
+    def forget_missing(self, paths: Iterable[str]) -> None:
+        """Drop hash entries for files that no longer exist"""
+        for path in list(paths):
+            if path in self.hashes and not os.path.exists(path):
+                del self.hashes[path]
+                self._dirty = True
+
+
+def tool_files(system_dir: str) -> List[str]:
+    """Tool executables and scripts whose version affects the output"""
+    try:
+        names = os.listdir(system_dir)
+    except OSError:
+        return []
+    return [os.path.join(system_dir, n) for n in names
+            if n.lower().endswith(('.py', '.exe', '.bin', '.mr'))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the mkcdi build cache key for a data directory')
+    parser.add_argument('data', help='Data directory')
+    parser.add_argument('--cache', default=os.path.join('archive', CACHE_FILE), help='Cache file')
+    parser.add_argument('--system', default='system', help='Tool directory')
+    args = parser.parse_args()
+
+    cache = BuildCache(args.cache)
+    key = cache.key(args.data, tool_files(args.system))
+    cache.forget_missing(list(cache.hashes))
+    cache.save()
+    print(key)
+    hit = cache.lookup(key)
+    if hit:
+        print(f"cached build: {hit}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+"""
+builder.py - The image build shared by mkcdi.py and mkcdi_gui.py
+
+Everything between a verified settings dict and a published CDI: the build
+cache lookup, the patch chain on staged copies (hack4, bincon, binhack,
+IP.BIN), the image writer (built-in, in-place update or mkisofs piped into
+iso2cdi) and moving the result to its build name. The front ends only
+collect the settings, name the build and show what ImageBuilder reports.
+
+All paths are relative to the current directory: data/ is read, image.cdi
+and image.map are written next to it, older images go to archive/.
+
+The settings dict holds lba, volume, binary, ip_bin, iso_builder,
+incremental ('1' to update the previous image in place), slack ([SLACK]
+rules), source_date_epoch (int or None) and build (the name suffix);
+enable_binhack is optional and defaults to '1'. The published file name is
+stored under cdi_file.
+
+usage: builder.py [--lba LBA] [--volume NAME] [--binary FILE] [--mkisofs]
+                  build image.cdi from data/ in the current directory
+"""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import threading
+from typing import Callable, ContextManager, Dict, List, Optional, Tuple
+
+import binhack as binhack_tool
+import bincon
+import buildcache
+import buildtrace
+import cdiupdate
+import emulator
+import hack4
+import ipbin
+import iso2cdi
+import isowriter
+import progress
+import staging
+
+# Per-stage timings of the last build
+TRACE_FILE = os.path.join('archive', 'build-trace.json')
+# hack4 patch plans of data\*.bin, so unchanged binaries aren't scanned again
+HACK4_CACHE_FILE = os.path.join('archive', 'hack4cache.json')
+# Patched copies of the few files the build changes; data/ is never written
+STAGE_DIR = os.path.join('archive', 'stage')
+
+BuildCancelled = iso2cdi.Cancelled
+
+
+class ImageBuilder:
+    """Builds, caches and publishes the image for one front end.
+
+    log is called with every message. progress_line(stage) returns a
+    context manager yielding the progress.ProgressReporter of an image
+    stage. release_image is called right before an image the emulator may
+    have open is rewritten or moved (Windows won't do either to an open
+    file), so the emulator keeps running until the new image is ready and
+    when the build fails.
+    """
+
+    def __init__(self, log: Callable[[str], None] = print,
+                 progress_line: Callable[[str], ContextManager[progress.ProgressReporter]]
+                 = progress.progress_line,
+                 release_image: Optional[Callable[[], None]] = None):
+        self.log = log
+        self.progress_line = progress_line
+        self.release_image = release_image or (lambda: None)
+        self.trace = buildtrace.BuildTrace()
+        # Set to abandon the running build; checked between stages and by
+        # the CDI writer between sector batches
+        self.cancel_requested = threading.Event()
+        # Child processes of the running build, killed when it is cancelled
+        self.child_processes = set()
+
+    def check_cancelled(self) -> None:
+        if self.cancel_requested.is_set():
+            raise BuildCancelled()
+
+    def cancel_build(self) -> None:
+        """Cancel the running build and kill the process it is reading from"""
+        self.cancel_requested.set()
+        # The whole group: the shell's children hold the pipe open too
+        for process in list(self.child_processes):
+            emulator.signal_process_group(process, True)
+
+    @staticmethod
+    def remove_partial_image() -> None:
+        """Delete what a failed or cancelled build left behind"""
+        for file in ('image.cdi', 'image.map'):
+            if os.path.exists(file):
+                os.remove(file)
+
+    def run_pipeline(self, producer_cmd: str, consume: Callable) -> Tuple[bool, str]:
+        """Run a shell command and feed its stdout to consume(stream) in-process"""
+        producer = subprocess.Popen(producer_cmd, shell=True,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    **emulator.process_group_options())
+        self.child_processes.add(producer)
+        # Drain the producer's stderr on the side so a chatty producer can't
+        # block on a full stderr pipe while the consumer waits for data
+        producer_err = []
+        err_thread = threading.Thread(target=lambda: producer_err.append(producer.stderr.read()))
+        err_thread.start()
+        error = ''
+        try:
+            consume(producer.stdout)
+        except (OSError, ValueError) as e:
+            error = str(e)
+            emulator.signal_process_group(producer, True)
+        except BaseException:
+            # Cancelled: don't wait for the producer to finish its output
+            emulator.signal_process_group(producer, True)
+            raise
+        finally:
+            producer.stdout.close()
+            producer.wait()
+            err_thread.join()
+            self.child_processes.discard(producer)
+        stderr = producer_err[0].decode(errors='replace') + error
+        return producer.returncode == 0 and not error, stderr
+
+    # -- patch chain ----------------------------------------------------------
+
+    def run_hack4(self, config: hack4.Config, directory: str) -> List[dict]:
+        """Run hack4 in-process over directory\\*.bin; returns the per-file results"""
+        config.cache_file = HACK4_CACHE_FILE
+        results, _ = hack4.patch_files(hack4.find_binaries(directory), config)
+        for r in results:
+            if r['error']:
+                self.log(f"hack4: {r['file']}: {r['error']}")
+        return results
+
+    def stage_targets(self, settings: dict) -> Dict[str, str]:
+        """Files the patch chain changes: {name in the image: file to stage}"""
+        binary = settings['binary']
+        targets = {binary: os.path.join('data', binary), 'IP.BIN': settings['ip_bin']}
+        # Read-only pass: the other binaries hack4 finds something to unprotect in
+        config = hack4.Config()
+        config.unprotect = True
+        for r in self.run_hack4(config, 'data'):
+            if r['matches']:
+                targets.setdefault(os.path.basename(r['file']), r['file'])
+        return targets
+
+    def binhack(self, settings: dict) -> bool:
+        """Perform binary hacking operations on staged copies of the files they change.
+        Returns False, after logging why, when a file could not be staged or
+        patched: an image built then would be unpatched or half-patched."""
+        lba = int(settings['lba'])
+        binary = settings['binary']
+
+        overlay = staging.StagingOverlay('data', STAGE_DIR)
+        settings['overlay'] = overlay
+        inputs = hack4.find_binaries('data') + [settings['ip_bin']] + buildcache.tool_files('system')
+        fingerprint = overlay.fingerprint(inputs, {'lba': lba, 'binary': binary, 'ip_bin': settings['ip_bin']})
+        if overlay.is_current(fingerprint):
+            self.log(f"Patched files in {STAGE_DIR} are up to date")
+            return True
+
+        with self.trace.stage('staging') as info:
+            try:
+                info['methods'] = overlay.stage(self.stage_targets(settings))
+                info['success'] = True
+            except OSError as e:
+                self.log(f"staging: {e}")
+                info['success'] = False
+                return False
+        staged = overlay.path(binary)
+        self.check_cancelled()
+
+        # hack4, bincon and binhack run in-process, on the staged copies
+        self.log("Running hack4...")
+        with self.trace.stage('hack4 unprotect') as info:
+            config = hack4.Config()
+            config.unprotect = True
+            config.write_mode = True
+            info['success'] = not any(r['error'] for r in self.run_hack4(config, STAGE_DIR))
+        if not info['success']:
+            return False
+        self.check_cancelled()
+        with self.trace.stage('hack4 LBA') as info:
+            # Same options as the former "hack4.exe -w -n <lba>" call
+            config = hack4.Config()
+            config.new_pos = lba
+            config.write_mode = True
+            info['success'] = not any(r['error'] for r in self.run_hack4(config, STAGE_DIR))
+        if not info['success']:
+            return False
+        self.check_cancelled()
+
+        # Run bincon for 0WINCEOS.BIN (the binary only, IP.BIN is composed below)
+        converted = False
+        if binary == '0WINCEOS.BIN':
+            with self.trace.stage('bincon') as info:
+                try:
+                    info.update(bincon.bincon(staged, staged))
+                    converted = info['converted']
+                    info['success'] = True
+                except OSError as e:
+                    self.log(f"bincon: {e}")
+                    info['success'] = False
+                    return False
+
+        # Run binhack on the boot binary
+        self.check_cancelled()
+        self.log("Running binhack...")
+        with self.trace.stage('binhack') as info:
+            try:
+                result = binhack_tool.hack_files(staged, None, lba, STAGE_DIR)
+                info['hack_offset'] = result.scan.hack_offset
+                info['success'] = True
+            except binhack_tool.BinhackError as e:
+                self.log(f"binhack: {e}")
+                info['success'] = False
+                return False
+
+        # Write IP.BIN once: OS flag, bootstrap, boot size, and the logo for Windows CE
+        self.check_cancelled()
+        logo = 'system/wince.mr' if binary == '0WINCEOS.BIN' and os.path.exists('system/wince.mr') else None
+        with self.trace.stage('IP.BIN') as info:
+            try:
+                ip_bin = overlay.path('IP.BIN')
+                conflicts = ipbin.compose_ip_bin(ip_bin, ip_bin, staged, logo, converted)
+                info['conflicts'] = len(conflicts)
+                info['success'] = True
+            except (OSError, ValueError) as e:
+                self.log(f"IP.BIN: {e}")
+                info['success'] = False
+                return False
+        for conflict in conflicts:
+            self.log(f"Warning: IP.BIN: {conflict}")
+        overlay.commit(fingerprint)
+        return True
+
+    # -- image writer ---------------------------------------------------------
+
+    @staticmethod
+    def image_sources(settings: dict) -> Tuple[str, Dict[str, str]]:
+        """Boot file and overrides of the merged view: data/ with the staged copies on top"""
+        overlay = settings.get('overlay')
+        if overlay is None:
+            return settings['ip_bin'], {}
+        overrides = overlay.overrides()
+        # IP.BIN is the boot area, not a file in the image
+        overrides.pop('IP.BIN', None)
+        return overlay.lookup('IP.BIN', settings['ip_bin']), overrides
+
+    def mkisofs_sources(self, settings: dict) -> str:
+        """mkisofs -G and path arguments for the merged view: each staged copy is
+        grafted in place of its original, which is excluded"""
+        boot_file, overrides = self.image_sources(settings)
+        if not overrides:
+            return f'-G {boot_file} data'
+        hidden = ' '.join(f'-x data/{rel}' for rel in overrides)
+        grafts = ' '.join(f'"{rel}={path}"' for rel, path in overrides.items())
+        return f'{hidden} -G {boot_file} -graft-points data {grafts}'
+
+    @staticmethod
+    def find_previous_image() -> Optional[str]:
+        """Newest CDI in the current directory that has an extent map next to it"""
+        candidates = [f for f in os.listdir('.')
+                      if f.endswith('.cdi') and f != 'image.cdi'
+                      and os.path.exists(cdiupdate.map_path_for(f))]
+        if not candidates:
+            return None
+        return max(candidates, key=os.path.getmtime)
+
+    @staticmethod
+    def find_previous_plan() -> Optional[dict]:
+        """Extent map of the newest build, in the current directory or archive/"""
+        maps = [f for f in os.listdir('.') if f.endswith('.map') and f != 'image.map']
+        if not maps and os.path.isdir('archive'):
+            maps = [os.path.join('archive', f) for f in os.listdir('archive') if f.endswith('.map')]
+        if not maps:
+            return None
+        return isowriter.load_plan(max(maps, key=os.path.getmtime))
+
+    def update_image_in_place(self, settings: dict) -> bool:
+        """Patch the previous build in place and move it to image.cdi.
+        Returns False when a full rebuild is needed."""
+        previous = self.find_previous_image()
+        if not previous:
+            return False
+        self.log(f"Updating {previous} in place...")
+        boot_file, overrides = self.image_sources(settings)
+        try:
+            with self.trace.stage('cdiupdate') as info:
+                changed = cdiupdate.update_cdi(previous, 'data', boot_file, overrides=overrides,
+                                               before_write=self.release_image, layout={
+                                                   'session_lba': int(settings['lba']),
+                                                   'volume': settings['volume'],
+                                                   'source_date_epoch': settings['source_date_epoch']})
+                info['files'] = len(changed)
+        except cdiupdate.LayoutChanged as e:
+            self.log(f"Full rebuild needed: {e}")
+            return False
+        except (OSError, ValueError, KeyError) as e:
+            self.log(f"In-place update failed, rebuilding: {e}")
+            return False
+        os.rename(previous, 'image.cdi')
+        os.rename(cdiupdate.map_path_for(previous), 'image.map')
+        self.log(f"Updated {len(changed)} file(s) in {previous}")
+        return True
+
+    def build_image_native(self, settings: dict) -> Tuple[bool, str]:
+        """Write the ISO9660 filesystem for data/ straight into image.cdi, in-process"""
+        if settings['incremental'] == '1' and self.update_image_in_place(settings):
+            return True, ''
+
+        self.log("Building image with the built-in ISO writer...")
+        sort_file = 'sortfile.str' if os.path.exists('sortfile.str') else None
+        boot_file, overrides = self.image_sources(settings)
+        try:
+            with self.trace.stage('iso2cdi', builder='native') as info, \
+                    self.progress_line('iso2cdi') as reporter:
+                image = iso2cdi.create_cdi_from_directory(
+                    'data', 'image.cdi', int(settings['lba']), settings['volume'],
+                    boot_file=boot_file, sort_file=sort_file, exclude=['IP.BIN'],
+                    slack=settings['slack'], plan=self.find_previous_plan(),
+                    source_date_epoch=settings['source_date_epoch'], overrides=overrides,
+                    cancel=self.cancel_requested, progress=reporter
+                )
+                info['sectors'] = image.total_sectors
+                # Extent map for the next incremental build (and the next layout plan)
+                cdiupdate.save_extent_map(image, 'image.map')
+        except (OSError, ValueError) as e:
+            return False, str(e)
+        if image.plan_reused:
+            self.log(f"Kept {image.plan_reused} file(s) at their previous LBA")
+        return True, ''
+
+    def build_image_mkisofs(self, settings: dict) -> Tuple[bool, str]:
+        """Build the ISO with mkisofs and stream it straight into the CDI writer"""
+        self.log("Building ISO with mkisofs and streaming it to iso2cdi...")
+        sort_cmd = "-sort sortfile.str" if os.path.exists('sortfile.str') else ""
+        mkisofs_cmd = (
+            f'mkisofs -C 0,{settings["lba"]} -V "{settings["volume"]}" {sort_cmd} '
+            f'-exclude IP.BIN -l -J -r {self.mkisofs_sources(settings)}'
+        )
+        # The ISO size is unknown until mkisofs is done: bytes and rate, no ETA
+        with self.trace.stage('mkisofs | iso2cdi') as info, \
+                self.progress_line('mkisofs | iso2cdi') as reporter:
+            success, stderr = self.run_pipeline(
+                mkisofs_cmd, lambda iso: iso2cdi.convert_stream(
+                    iso, 'image.cdi', int(settings['lba']), cancel=self.cancel_requested,
+                    progress=reporter))
+            info['success'] = success
+        # A killed mkisofs just ends the stream early
+        self.check_cancelled()
+        return success, stderr
+
+    def make_image(self, settings: dict) -> bool:
+        """Write image.cdi and publish it; False (and no image) when it fails"""
+        self.check_cancelled()
+        try:
+            if settings['iso_builder'] == 'mkisofs':
+                success, stderr = self.build_image_mkisofs(settings)
+            else:
+                success, stderr = self.build_image_native(settings)
+            if not success:
+                self.log(f"Error building image: {stderr}")
+                self.remove_partial_image()
+                return False
+
+            with self.trace.stage('archive move'):
+                final_filename = self.publish_image(settings)
+            self.log(f'File "{final_filename}" is created.')
+            return True
+        except (BuildCancelled, KeyboardInterrupt):
+            self.remove_partial_image()
+            raise
+
+    def publish_image(self, settings: dict) -> str:
+        """Archive previous images and rename image.cdi/image.map to the build name"""
+        self.release_image()
+        final_filename = f"{settings['volume']}-{settings['build']}.cdi"
+        temp_filename = f"{settings['volume']}-{settings['build']}.tmp"
+
+        if os.path.exists('image.cdi'):
+            os.rename('image.cdi', temp_filename)
+
+        os.makedirs('archive', exist_ok=True)
+
+        # Move existing CDI files (and their extent maps) to archive; a build
+        # with pinned timestamps reuses its name, so an older copy there is
+        # overwritten
+        for file in os.listdir('.'):
+            if file.endswith('.cdi') or (file.endswith('.map') and file != 'image.map'):
+                os.replace(file, os.path.join('archive', file))
+
+        if os.path.exists(temp_filename):
+            os.rename(temp_filename, final_filename)
+        if os.path.exists('image.map'):
+            os.rename('image.map', cdiupdate.map_path_for(final_filename))
+        settings['cdi_file'] = final_filename
+        return final_filename
+
+    # -- build cache ----------------------------------------------------------
+
+    @staticmethod
+    def build_cache_key(cache: buildcache.BuildCache, settings: dict) -> str:
+        """Key over data/, IP.BIN, the tools and the settings that shape the image"""
+        return cache.key('data', buildcache.tool_files('system') + ['sortfile.str', settings['ip_bin']], {
+            'lba': settings['lba'],
+            'volume': settings['volume'],
+            'binary': settings['binary'],
+            'enable_binhack': settings.get('enable_binhack', '1'),
+            'iso_builder': settings['iso_builder'],
+            'slack': settings['slack'],
+            'source_date_epoch': settings['source_date_epoch']
+        })
+
+    def reuse_cached_image(self, settings: dict, cached: str) -> bool:
+        """Publish a previously built image under this build's name"""
+        final_filename = f"{settings['volume']}-{settings['build']}.cdi"
+        if os.path.abspath(cached) == os.path.abspath(final_filename):
+            settings['cdi_file'] = final_filename
+            self.log(f'Inputs unchanged, "{final_filename}" is up to date.')
+            return True
+
+        try:
+            method = buildcache.clone_file(cached, 'image.cdi')
+            cached_map = cdiupdate.map_path_for(cached)
+            if os.path.exists(cached_map):
+                shutil.copy2(cached_map, 'image.map')
+            self.publish_image(settings)
+        except OSError as e:
+            self.log(f"Error reusing cached image: {e}")
+            self.remove_partial_image()
+            return False
+
+        self.log(f'Inputs unchanged, reused "{cached}" ({method}).')
+        self.log(f'File "{final_filename}" is created.')
+        return True
+
+    # -- the build ------------------------------------------------------------
+
+    def build(self, settings: dict) -> bool:
+        """Patch, write and publish the image for verified, named settings;
+        returns True when an image was published. Raises BuildCancelled if
+        cancelled between stages."""
+        # Skip the build entirely when the same inputs were built before
+        with self.trace.stage('build cache') as info:
+            cache = buildcache.BuildCache(os.path.join('archive', buildcache.CACHE_FILE))
+            key = self.build_cache_key(cache, settings)
+            cached = cache.lookup(key)
+            info['hit'] = bool(cached)
+
+        if cached:
+            with self.trace.stage('cache reuse'):
+                built = self.reuse_cached_image(settings, cached)
+        else:
+            patched = True
+            if settings.get('enable_binhack', '1') == '1':
+                patched = self.binhack(settings)
+            else:
+                self.log("Binhack disabled, skipping")
+            self.check_cancelled()
+            if patched:
+                built = self.make_image(settings)
+            else:
+                self.log("Patching failed, no image was built")
+                built = False
+        if built:
+            cache.store(key, settings['cdi_file'])
+        cache.save()
+
+        self.trace.save(TRACE_FILE)
+        self.log(self.trace.summary())
+        return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build image.cdi from data/ in the current directory')
+    parser.add_argument('--lba', type=int, default=11702, help='LBA of the data track (default 11702)')
+    parser.add_argument('--volume', default='mygame', help='volume name (default mygame)')
+    parser.add_argument('--binary', default='1ST_READ.BIN', help='boot binary in data/ (default 1ST_READ.BIN)')
+    parser.add_argument('--mkisofs', action='store_true', help='build the ISO with mkisofs')
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join('data', args.binary)):
+        print(f"Error: data/{args.binary} not found")
+        return 1
+    ip_bin = os.path.join('data', 'IP.BIN')
+    if not os.path.exists(ip_bin):
+        ip_bin = os.path.join('system', 'precon', 'katana.bin')
+    settings = {
+        'lba': str(args.lba),
+        'volume': args.volume,
+        'binary': args.binary,
+        'ip_bin': ip_bin,
+        'iso_builder': 'mkisofs' if args.mkisofs else 'native',
+        'incremental': '0',
+        'slack': [],
+        'source_date_epoch': None
+    }
+    builder = ImageBuilder()
+    try:
+        if not builder.binhack(settings):
+            return 1
+        if args.mkisofs:
+            success, stderr = builder.build_image_mkisofs(settings)
+        else:
+            success, stderr = builder.build_image_native(settings)
+    except KeyboardInterrupt:
+        builder.cancel_build()
+        builder.remove_partial_image()
+        print("Cancelled")
+        return 1
+    if not success:
+        print(f"Error: {stderr}")
+        builder.remove_partial_image()
+        return 1
+    print(builder.trace.summary())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+buildtrace.py - Per-stage timing for mkcdi builds
+
+Records wall time, CPU time, bytes read/written and peak RSS for every build
+stage and exports them as a Chrome trace (open in chrome://tracing or
+https://ui.perfetto.dev) plus a one-line summary.
+
+CPU time and I/O include child processes (hack4.exe, mkisofs, ...) where the
+OS reports them for finished children: on Linux through getrusage and
+/proc/self/io, on Windows only the builder process itself is counted.
+Peak RSS is the high-water mark reached by the end of the stage.
+
+usage: buildtrace.py <trace.json>     print the summary of a saved trace
+"""
+
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# -----------------------------------------------------------------------------
+# Process counters
+# -----------------------------------------------------------------------------
+
+def _windows_counters() -> Dict[str, int]:
+    import ctypes
+    from ctypes import wintypes
+
+    class IO_COUNTERS(ctypes.Structure):
+        _fields_ = [(name, ctypes.c_ulonglong) for name in (
+            'ReadOperationCount', 'WriteOperationCount', 'OtherOperationCount',
+            'ReadTransferCount', 'WriteTransferCount', 'OtherTransferCount')]
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD)] + [
+            (name, ctypes.c_size_t) for name in (
+                'PeakWorkingSetSize', 'WorkingSetSize', 'QuotaPeakPagedPoolUsage',
+                'QuotaPagedPoolUsage', 'QuotaPeakNonPagedPoolUsage', 'QuotaNonPagedPoolUsage',
+                'PagefileUsage', 'PeakPagefileUsage')]
+
+    kernel32 = ctypes.windll.kernel32
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    process = kernel32.GetCurrentProcess()
+    io = IO_COUNTERS()
+    mem = PROCESS_MEMORY_COUNTERS()
+    mem.cb = ctypes.sizeof(mem)
+    result = {'read': 0, 'written': 0, 'peak_rss': 0}
+    if kernel32.GetProcessIoCounters(process, ctypes.byref(io)):
+        result['read'] = io.ReadTransferCount
+        result['written'] = io.WriteTransferCount
+    if kernel32.K32GetProcessMemoryInfo(process, ctypes.byref(mem), mem.cb):
+        result['peak_rss'] = mem.PeakWorkingSetSize
+    return result
+
+
+def counters() -> Dict[str, float]:
+    """Current CPU seconds, I/O bytes and peak RSS of this process and its children"""
+    t = os.times()
+    result = {'cpu': t.user + t.system + t.children_user + t.children_system,
+              'read': 0, 'written': 0, 'peak_rss': 0}
+
+    if resource is not None:
+        me = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        # ru_maxrss is in KB on Linux, bytes on macOS
+        scale = 1 if sys.platform == 'darwin' else 1024
+        result['peak_rss'] = max(me.ru_maxrss, children.ru_maxrss) * scale
+        # Block I/O of finished children, in 512-byte units
+        result['read'] = children.ru_inblock * 512
+        result['written'] = children.ru_oublock * 512
+        try:
+            with open('/proc/self/io', 'r') as f:
+                io = dict(line.split(':', 1) for line in f)
+            result['read'] += int(io['rchar'])
+            result['written'] += int(io['wchar'])
+        except (OSError, KeyError, ValueError):
+            result['read'] += me.ru_inblock * 512
+            result['written'] += me.ru_oublock * 512
+    elif os.name == 'nt':
+        try:
+            result.update(_windows_counters())
+        except (OSError, AttributeError, ImportError):
+            pass
+    return result
+
+
+# -----------------------------------------------------------------------------
+# Trace
+# -----------------------------------------------------------------------------
+
+class BuildTrace:
+    """Collects build stages; use stage() as a context manager around each one"""
+
+    def __init__(self):
+        self.stages: List[dict] = []
+        self._origin = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str, **args):
+        """Time the enclosed block. Extra keyword args end up in the trace event;
+        the yielded dict can be filled in while the stage runs."""
+        info = dict(args)
+        before = counters()
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            end = time.perf_counter()
+            after = counters()
+            self.stages.append({
+                'name': name,
+                'start': start - self._origin,
+                'wall': end - start,
+                'cpu': after['cpu'] - before['cpu'],
+                'read': max(0, after['read'] - before['read']),
+                'written': max(0, after['written'] - before['written']),
+                'peak_rss': after['peak_rss'],
+                'args': info,
+            })
+
+    def chrome_trace(self) -> dict:
+        """Trace Event Format: one complete ('X') event per stage"""
+        pid = os.getpid()
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': 0,
+                   'args': {'name': 'mkcdi build'}}]
+        for s in self.stages:
+            args = {
+                'cpu_ms': round(s['cpu'] * 1000, 3),
+                'bytes_read': s['read'],
+                'bytes_written': s['written'],
+                'peak_rss': s['peak_rss'],
+            }
+            args.update(s['args'])
+            events.append({'name': s['name'], 'cat': 'build', 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': round(s['start'] * 1e6), 'dur': round(s['wall'] * 1e6),
+                           'args': args})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.chrome_trace(), f, indent=1)
+
+    def summary(self) -> str:
+        return summarize(self.stages)
+
+
+def _mb(n: int) -> str:
+    return f"{n / (1024 * 1024):.1f} MB"
+
+
+def summarize(stages: List[dict]) -> str:
+    """One line: total time, then every stage slowest first (stages that
+    recorded success = False marked as failed)"""
+    total = 0.0
+    if stages:
+        total = max(s['start'] + s['wall'] for s in stages) - min(s['start'] for s in stages)
+    parts = [f"{s['name']} {s['wall']:.2f}s" + (" failed" if s['args'].get('success') is False else "")
+             for s in sorted(stages, key=lambda s: -s['wall'])]
+    io = sum(s['read'] + s['written'] for s in stages)
+    peak = max((s['peak_rss'] for s in stages), default=0)
+    return (f"Build {total:.2f}s (cpu {sum(s['cpu'] for s in stages):.2f}s, io {_mb(io)}, "
+            f"peak {_mb(peak)}): " + ', '.join(parts))
+
+
+def load_stages(path: str) -> List[dict]:
+    """Stages back from a saved Chrome trace"""
+    with open(path, 'r') as f:
+        trace = json.load(f)
+    stages = []
+    for event in trace.get('traceEvents', []):
+        if event.get('ph') != 'X':
+            continue
+        args = event.get('args', {})
+        stages.append({'name': event['name'], 'start': event['ts'] / 1e6, 'wall': event['dur'] / 1e6,
+                       'cpu': args.get('cpu_ms', 0) / 1000, 'read': args.get('bytes_read', 0),
+                       'written': args.get('bytes_written', 0), 'peak_rss': args.get('peak_rss', 0),
+                       'args': args})
+    return stages
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: buildtrace.py <trace.json>")
+        return 1
+    try:
+        stages = load_stages(sys.argv[1])
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error: {e}")
+        return 1
+    print(summarize(stages))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+"""
+cdiupdate.py - Incremental in-place CDI update
+
+usage: cdiupdate.py <image.cdi> <data directory> [-G IP.BIN] [--map image.map] [--stage DIR]
+
+Takes a CDI built by iso2cdi --directory (or mkcdi with the native ISO
+builder) together with the extent map saved next to it. Files that changed
+since that build are rewritten in place: only their own sectors and the
+directory records describing them are touched. When the layout would have to
+change (files added or removed, or a file outgrew the sectors reserved for
+it) nothing is written and a full rebuild is required. Files shadowed by a
+staging overlay are compared and read through their patched copies.
+
+The map is moved aside before the first write and only written back once
+every write succeeded, so an update cut short (disk full, ...) leaves an
+image without a map. Such an image is never updated in place again.
+
+Exit codes: 0 updated, 2 full rebuild needed, 1 error.
+"""
+
+import argparse
+import json
+import os
+import sys
+from typing import Callable, Dict, List, Optional
+
+import iso2cdi
+import isowriter
+import staging
+
+SECTOR_SIZE = iso2cdi.SECTOR_SIZE
+
+
+class LayoutChanged(Exception):
+    """The image can't be updated in place; a full rebuild is needed"""
+
+
+def map_path_for(cdi_path: str) -> str:
+    """Extent map stored next to a CDI image"""
+    return os.path.splitext(cdi_path)[0] + '.map'
+
+
+def save_extent_map(image: isowriter.IsoImage, map_path: str) -> None:
+    """Store the file-to-extent map of a freshly written image"""
+    _write_map(image.extent_map(), map_path)
+
+
+def _write_map(extent_map: dict, map_path: str) -> None:
+    temp = map_path + '.tmp'
+    with open(temp, 'w') as f:
+        json.dump(extent_map, f, indent=1)
+    os.replace(temp, map_path)
+
+
+def load_extent_map(map_path: str) -> dict:
+    with open(map_path, 'r') as f:
+        return json.load(f)
+
+
+def _patch_records(fd: int, session_lba: int, records: List[list], size: int, stamp: float) -> None:
+    """Rewrite the size/date fields of a file's primary and Joliet records"""
+    for sector, offset, length in records:
+        block = bytearray(iso2cdi.read_sectors(fd, sector - session_lba))
+        record = block[offset:offset + length]
+        isowriter.patch_record(record, size, stamp)
+        block[offset:offset + length] = record
+        iso2cdi.overwrite_sectors(fd, sector - session_lba, block)
+
+
+def update_cdi(cdi_path: str, source_dir: str, boot_file: Optional[str] = None,
+               map_path: Optional[str] = None, overrides: Optional[Dict[str, str]] = None,
+               before_write: Optional[Callable[[], None]] = None,
+               layout: Optional[dict] = None) -> List[str]:
+    """Bring cdi_path up to date with source_dir in place.
+    overrides maps relative paths to the files read instead (see isowriter.IsoImage).
+    layout holds what the new image must have been built with (session_lba,
+    volume, source_date_epoch); any that differs from the map's is a layout
+    change, as the session and its trailer can only be written from scratch.
+    before_write is called once the update is known to fit, right before the
+    image is first written (e.g. to close a program that has it open).
+
+    Returns the paths of the files that were rewritten (empty if nothing
+    changed). Raises LayoutChanged, without touching the image, when only a
+    full rebuild can produce the new layout. If a write fails, the OSError
+    propagates and the image is left without its map.
+    """
+    map_path = map_path or map_path_for(cdi_path)
+    if not os.path.exists(map_path):
+        raise LayoutChanged(f"no extent map for {cdi_path}")
+    if os.stat(cdi_path).st_nlink > 1:
+        # Shared with an archived build by the build cache
+        raise LayoutChanged(f"{cdi_path} is hard-linked to another image")
+    extent_map = load_extent_map(map_path)
+    for field, value in (layout or {}).items():
+        if extent_map.get(field) != value:
+            raise LayoutChanged(f"{field} changed from {extent_map.get(field)!r} to {value!r}")
+    session_lba = extent_map['session_lba']
+
+    scan = isowriter.IsoImage(source_dir, extent_map['volume'], session_lba, boot_file,
+                              exclude=tuple(extent_map.get('exclude', ())),
+                              source_date_epoch=extent_map.get('source_date_epoch'),
+                              overrides=overrides)
+    dirs, files = scan.tree()
+    old_files = {f['path']: f for f in extent_map['files']}
+
+    if dirs != extent_map['dirs'] or set(files) != set(old_files):
+        raise LayoutChanged("files or directories were added or removed")
+
+    changed = []
+    for path, (size, mtime) in sorted(files.items()):
+        old = old_files[path]
+        if size == old['size'] and mtime == old['mtime']:
+            continue
+        if (size + SECTOR_SIZE - 1) // SECTOR_SIZE > old['sectors']:
+            raise LayoutChanged(f"{path} no longer fits its extent")
+        changed.append(path)
+
+    if before_write:
+        before_write()
+    # Until every write is done the map no longer describes the image
+    pending = map_path + '.pending'
+    os.replace(map_path, pending)
+    try:
+        fd = os.open(cdi_path, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+        try:
+            if boot_file:
+                iso2cdi.overwrite_sectors(fd, 0, scan.boot_area())
+
+            for path in changed:
+                old = old_files[path]
+                size, mtime = files[path]
+                # Rewrite the whole old extent so stale tail bytes are cleared
+                data = bytearray(old['sectors'] * SECTOR_SIZE)
+                with open(scan.overrides.get(path) or os.path.join(source_dir, path), 'rb') as src:
+                    got = src.readinto(memoryview(data)[:size])
+                if got != size:
+                    raise IOError(f"{path} changed while updating the image")
+                iso2cdi.overwrite_sectors(fd, old['lba'] - session_lba, data)
+                _patch_records(fd, session_lba, old['records'], size, scan.record_time(mtime))
+                old['size'] = size
+                old['mtime'] = mtime
+        finally:
+            os.close(fd)
+    except BaseException:
+        # Cut short: the image stays without a map
+        os.remove(pending)
+        raise
+
+    _write_map(extent_map, map_path)
+    os.remove(pending)
+    return changed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Update a CDI image in place from a changed data directory')
+    parser.add_argument('image', help='CDI image built with the native ISO writer')
+    parser.add_argument('source', help='Data directory the image was built from')
+    parser.add_argument('-G', '--boot', help='Boot area file (IP.BIN) to rewrite')
+    parser.add_argument('--map', help='Extent map (default: <image>.map)')
+    parser.add_argument('--stage', help='Staging overlay whose patched copies replace their originals')
+    args = parser.parse_args()
+
+    try:
+        overrides = staging.StagingOverlay(args.source, args.stage).overrides() if args.stage else None
+        changed = update_cdi(args.image, args.source, args.boot, args.map, overrides)
+    except LayoutChanged as e:
+        print(f"Full rebuild needed: {e}")
+        return 2
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error: {e}")
+        return 1
+
+    for path in changed:
+        print(f"Updated: {path}")
+    print(f"{len(changed)} file(s) updated in {args.image}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+emulator.py - Managed emulator process
+
+Runs the emulator without blocking the builder. The process starts in the
+background and its output is streamed into a bounded buffer (the last
+LOG_LINES lines), so a chatty emulator can't fill memory. Launching a newer
+image closes the running instance first, so each build can hand its CDI
+straight to the emulator.
+
+usage: emulator.py <emulator> <image.cdi>     run it and print its log tail when it exits
+"""
+
+import collections
+import os
+import signal
+import subprocess
+import sys
+import threading
+from typing import Callable, List, Optional
+
+# Lines of emulator output kept
+LOG_LINES = 500
+# Seconds a closing emulator gets to exit before it is killed
+CLOSE_TIMEOUT = 3.0
+
+
+def process_group_options() -> dict:
+    """Popen arguments that start a process in a group of its own, so
+    signal_process_group() reaches the children it starts too"""
+    if os.name == 'nt':
+        # Its own process group, so console Ctrl+C doesn't reach it
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    # Its own session, so its children can be signalled with it
+    return {'start_new_session': True}
+
+
+def signal_process_group(process: subprocess.Popen, kill: bool) -> None:
+    """Terminate (or kill) process and, on POSIX, its process group"""
+    if os.name != 'nt':
+        try:
+            os.killpg(process.pid, signal.SIGKILL if kill else signal.SIGTERM)
+            return
+        except OSError:
+            pass
+    if kill:
+        process.kill()
+    else:
+        process.terminate()
+
+
+class EmulatorProcess:
+    """At most one emulator instance, relaunched with each new image.
+
+    on_exit(returncode) is called from the log reader thread when the
+    emulator exits by itself (not when close() or launch() ends it).
+    """
+
+    def __init__(self, log_lines: int = LOG_LINES,
+                 on_exit: Optional[Callable[[int], None]] = None):
+        self.log = collections.deque(maxlen=log_lines)
+        self.on_exit = on_exit
+        self.process: Optional[subprocess.Popen] = None
+        self.image: Optional[str] = None
+        self._reader: Optional[threading.Thread] = None
+        self._closing = False
+        self._lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def launch(self, emulator: str, image: str) -> bool:
+        """Start emulator on image, closing the instance already running.
+        Returns True if an earlier instance was replaced. Raises OSError."""
+        with self._lock:
+            replaced = self._close()
+            self.log.clear()
+            process = subprocess.Popen([emulator, image], stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       **process_group_options())
+            self.process = process
+            self.image = image
+            self._closing = False
+            self._reader = threading.Thread(target=self._read_log, args=(process,), daemon=True)
+            self._reader.start()
+            return replaced
+
+    def _read_log(self, process: subprocess.Popen) -> None:
+        for line in iter(process.stdout.readline, b''):
+            self.log.append(line.decode(errors='replace').rstrip())
+        process.stdout.close()
+        returncode = process.wait()
+        if self.on_exit and process is self.process and not self._closing:
+            self.on_exit(returncode)
+
+    def _close(self) -> bool:
+        process = self.process
+        if process is None:
+            return False
+        running = process.poll() is None
+        self._closing = True
+        if running:
+            signal_process_group(process, False)
+            try:
+                process.wait(CLOSE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                signal_process_group(process, True)
+                process.wait()
+        if self._reader is not None:
+            # A child left behind may still hold the log pipe open
+            self._reader.join(CLOSE_TIMEOUT)
+        self.process = None
+        self._reader = None
+        return running
+
+    def close(self) -> bool:
+        """Close the running instance, if any; returns True if one was running"""
+        with self._lock:
+            return self._close()
+
+    def wait(self) -> Optional[int]:
+        """Wait for the emulator to exit by itself; returns its exit code"""
+        process, reader = self.process, self._reader
+        if process is None:
+            return None
+        returncode = process.wait()
+        if reader is not None:
+            reader.join()
+        return returncode
+
+    def tail(self, count: int = 20) -> List[str]:
+        """The last count lines of emulator output"""
+        return list(self.log)[-count:]
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: emulator.py <emulator> <image.cdi>")
+        return 1
+    emulator = EmulatorProcess()
+    try:
+        emulator.launch(sys.argv[1], sys.argv[2])
+        returncode = emulator.wait()
+    except OSError as e:
+        print(f"Error: {e}")
+        return 1
+    except KeyboardInterrupt:
+        emulator.close()
+        return 1
+    for line in emulator.tail():
+        print(line)
+    print(f"Emulator exited with code {returncode}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,14 +8,114 @@ particularly useful for homebrew and translation patches.
 """
 
 import argparse
+import array
+import contextlib
+import hashlib
+import io
+import json
+import mmap
+import multiprocessing
 import struct
 import sys
 import glob
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import List, Optional, Tuple
 
 
+# Boot executables mkcdi knows by name
+EXECUTABLE_NAMES = {'1ST_READ.BIN', '0WINCEOS.BIN', '1NOSDC.BIN'}
+
+# Headers of data formats commonly stored as .BIN on Dreamcast discs
+DATA_MAGICS = [
+    (b'AFS\x00', 'AFS archive'),
+    (b'PVRT', 'PVR texture'),
+    (b'GBIX', 'PVR texture'),
+    (b'RIFF', 'RIFF container'),
+    (b'OggS', 'Ogg stream'),
+    (b'MThd', 'MIDI'),
+    (b'\x00\x00\x01\xba', 'MPEG/SFD video'),
+    (b'\x1f\x8b', 'gzip data'),
+    (b'PK\x03\x04', 'zip archive'),
+]
+IP_BIN_MAGIC = b'SEGA SEGAKATANA'
+
+# Bytes of the file sampled to recognise SH-4 code
+SNIFF_SIZE = 256 * 1024
+# SH-4 rts, sts.l pr,@-r15 and lds.l @r15+,pr as little-endian words
+SH4_RTS = 0x000B
+SH4_PUSH_PR = 0x4F22
+SH4_POP_PR = 0x4F26
+# mov.l @(disp,PC),Rn is 1101 nnnn dddd dddd; it loads the longword at
+# (PC & ~3) + 4 + disp * 4, so its literal pool sits at most 1 KB ahead
+SH4_MOVL_PC_OPCODE = 0xD0
+SH4_MOVL_PC_MAX_DISP = 255
+
+# Files larger than this are scanned through mmap instead of read into memory
+MMAP_THRESHOLD = 16 * 1024 * 1024
+
+
+def looks_like_sh4_code(sample: bytes) -> bool:
+    """
+    True if the sample has far more function returns and PR saves/restores
+    than random data would (each word value turns up once per 64K words).
+    """
+    words = array.array('H', sample[:len(sample) & ~1])
+    if sys.byteorder == 'big':
+        words.byteswap()
+    expected = len(words) / 65536
+    needed = max(4, 8 * expected)
+    return (words.count(SH4_RTS) >= needed
+            and words.count(SH4_PUSH_PR) + words.count(SH4_POP_PR) >= needed)
+
+
+def literal_pool_loads(data, offset: int) -> List[int]:
+    """
+    Offsets of the mov.l @(disp,PC),Rn instructions that load the longword
+    at offset, i.e. the evidence that it is a literal pool constant.
+    
+    Literal pool entries are longword aligned: binaries are loaded at 4-byte
+    aligned addresses, so file offsets keep the alignment of the addresses.
+    Only the 512 instruction slots that could reach offset are checked.
+    """
+    loads = []
+    if offset % 4:
+        return loads
+    for disp in range(SH4_MOVL_PC_MAX_DISP + 1):
+        base = offset - 4 - disp * 4
+        if base < 0:
+            break
+        for pc in (base, base + 2):
+            # Little-endian instruction word: displacement first, then 0xDn
+            if data[pc] == disp and data[pc + 1] & 0xF0 == SH4_MOVL_PC_OPCODE:
+                loads.append(pc)
+    return loads
+
+
+def classify_file(filename: str) -> Tuple[str, str]:
+    """
+    Classify a target as ('executable', reason) or ('data', reason) from its
+    name, header and instruction statistics.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(SNIFF_SIZE)
+    
+    if os.path.basename(filename).upper() in EXECUTABLE_NAMES:
+        return 'executable', 'boot executable'
+    if head.startswith(IP_BIN_MAGIC):
+        return 'executable', 'IP.BIN boot sector'
+    for magic, name in DATA_MAGICS:
+        if head.startswith(magic):
+            return 'data', name
+    if b'(c)CRI' in head[:64]:
+        return 'data', 'CRI ADX audio'
+    if looks_like_sh4_code(head):
+        return 'executable', 'SH-4 code'
+    return 'data', 'no SH-4 code found'
+
+
 class Config:
     """Configuration class to hold all patch settings."""
     
@@ -28,13 +128,193 @@ class Config:
         self.hack3: bool = False
         self.unprotect: bool = False
         self.write_mode: bool = False
+        self.all_files: bool = False
+        self.list_only: bool = False
+        self.cache_file: Optional[str] = None
+        self.journal_file: Optional[str] = None
+        self.literal_pools: bool = False
+
+
+PatchPlan = List[Tuple[str, int, bytes, bytes]]
+
+
+def content_hash(data) -> str:
+    """Hash of a file's contents (any buffer: bytes, bytearray, mmap)."""
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+class PlanCache:
+    """
+    On-disk index of patch plans, keyed by file content hash and patch rules.
+    
+    Files are remembered by size and mtime, so an unchanged file is found
+    without reading it; its plan is then verified or applied by touching only
+    the listed offsets. The plan also records the hash the file ends up with
+    once it is applied, so a patched file is recognised on the next run too.
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.files = {}   # absolute path -> [size, mtime_ns, hash or None, kind, reason]
+        self.plans = {}   # "hash:rules" -> {'plan': [[name, offset, old hex, new hex]], 'patched': hash or None}
+        self.updates = {'files': {}, 'plans': {}}
+        if path:
+            self.load()
+    
+    def load(self) -> None:
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') == self.VERSION:
+            self.files = data.get('files', {})
+            self.plans = data.get('plans', {})
+    
+    def save(self) -> None:
+        if not self.path or not (self.updates['files'] or self.updates['plans']):
+            return
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': self.VERSION, 'files': self.files, 'plans': self.plans}, f)
+        os.replace(tmp, self.path)
+        self.updates = {'files': {}, 'plans': {}}
+    
+    def merge(self, updates: dict) -> None:
+        """Take over the changes a worker process made to its own copy."""
+        for path, entry in updates['files'].items():
+            self._set_file(path, entry)
+        for key, entry in updates['plans'].items():
+            self.plans[key] = self.updates['plans'][key] = entry
+    
+    @staticmethod
+    def rules_key(rules: List[Tuple[str, bytes, bytes]], literal_pools: bool = False) -> str:
+        return hashlib.blake2b(repr((rules, literal_pools)).encode(), digest_size=8).hexdigest()
+    
+    def _set_file(self, path: str, entry: Optional[list]) -> None:
+        if entry is None:
+            self.files.pop(path, None)
+        else:
+            self.files[path] = entry
+        self.updates['files'][path] = entry
+    
+    def lookup_file(self, filename: str, st: os.stat_result) -> Optional[list]:
+        """[size, mtime_ns, hash, kind, reason] if the file is unchanged since it was recorded."""
+        entry = self.files.get(os.path.abspath(filename))
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry
+        return None
+    
+    def record_file(self, filename: str, digest: Optional[str], kind: str, reason: str) -> None:
+        st = os.stat(filename)
+        self._set_file(os.path.abspath(filename), [st.st_size, st.st_mtime_ns, digest, kind, reason])
+    
+    def forget_file(self, filename: str) -> None:
+        self._set_file(os.path.abspath(filename), None)
+    
+    def lookup_plan(self, digest: Optional[str], rules: str) -> Optional[Tuple[PatchPlan, Optional[str]]]:
+        """(plan, hash after applying it) for known contents, or None."""
+        entry = self.plans.get(f"{digest}:{rules}") if digest else None
+        if entry is None:
+            return None
+        plan = [(name, offset, bytes.fromhex(old), bytes.fromhex(new))
+                for name, offset, old, new in entry['plan']]
+        return plan, entry['patched']
+    
+    def store_plan(self, digest: str, rules: str, plan: PatchPlan, patched: Optional[str]) -> None:
+        key = f"{digest}:{rules}"
+        self.plans[key] = self.updates['plans'][key] = {
+            'plan': [[name, offset, old.hex(), new.hex()] for name, offset, old, new in plan],
+            'patched': patched,
+        }
+
+
+Write = Tuple[int, bytes, bytes]   # (offset, original bytes, new bytes)
+
+
+def write_at(fd: int, offset: int, data: bytes) -> None:
+    os.lseek(fd, offset, os.SEEK_SET)
+    if os.write(fd, data) != len(data):
+        raise IOError(f"short write at offset 0x{offset:x}")
+
+
+def read_at(fd: int, offset: int, size: int) -> bytes:
+    os.lseek(fd, offset, os.SEEK_SET)
+    return os.read(fd, size)
+
+
+class UndoJournal:
+    """
+    Append-only record of the bytes hack4 overwrote, one JSON line per file.
+    
+    A file's entry is flushed to disk before any of its bytes are written,
+    so even a patch interrupted halfway can be reverted.
+    """
+    
+    def __init__(self, path: str):
+        self.path = path
+    
+    def record(self, filename: str, writes: List[Write]) -> None:
+        line = json.dumps({'file': os.path.abspath(filename),
+                           'writes': [[offset, old.hex(), new.hex()] for offset, old, new in writes]})
+        # One write per line, so parallel workers can share the journal
+        with open(self.path, 'a') as f:
+            f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+    
+    def entries(self) -> List[dict]:
+        with open(self.path, 'r') as f:
+            return [json.loads(line) for line in f if line.strip()]
+    
+    def revert(self) -> Tuple[int, int]:
+        """
+        Put back the original bytes, newest entry first.
+        
+        A word that no longer holds the bytes hack4 wrote is left alone and
+        reported (it was never written, or something else changed it since).
+        Returns (words restored, words left alone); the journal is removed
+        once everything was restored.
+        """
+        restored = 0
+        skipped = 0
+        for entry in reversed(self.entries()):
+            filename = entry['file']
+            try:
+                fd = os.open(filename, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            except OSError as e:
+                print(f"Cannot revert {filename}: {e}", file=sys.stderr)
+                skipped += len(entry['writes'])
+                continue
+            try:
+                for offset, old, new in reversed(entry['writes']):
+                    old, new = bytes.fromhex(old), bytes.fromhex(new)
+                    current = read_at(fd, offset, len(new))
+                    if current == new:
+                        write_at(fd, offset, old)
+                        print(f"Restored {filename} at offset: 0x{offset:x}")
+                        restored += 1
+                    elif current != old:
+                        print(f"Not restoring {filename} at offset 0x{offset:x}: contents changed",
+                              file=sys.stderr)
+                        skipped += 1
+            finally:
+                os.close(fd)
+        if not skipped:
+            os.remove(self.path)
+        return restored, skipped
 
 
 class DreamcastPatcher:
     """Main patcher class for Dreamcast binaries."""
     
-    def __init__(self, config: Config):
+    def __init__(self, config: Config, cache: Optional[PlanCache] = None):
         self.config = config
+        self.cache = cache
+        self.journal = UndoJournal(config.journal_file) if config.journal_file else None
         
     def read_file(self, filename: str) -> bytes:
         """Read binary file and return its contents."""
@@ -44,16 +324,22 @@ class DreamcastPatcher:
         except IOError as e:
             raise RuntimeError(f"Cannot read file {filename}: {e}")
     
-    def write_file(self, filename: str, data: bytes) -> None:
-        """Write binary data to file."""
+    def write_patches(self, filename: str, writes: List[Write]) -> None:
+        """Write only the patched words back in place, journaling the originals first."""
+        if self.journal:
+            self.journal.record(filename, writes)
         try:
-            with open(filename, 'wb') as f:
-                f.write(data)
-        except IOError as e:
+            fd = os.open(filename, os.O_RDWR | getattr(os, 'O_BINARY', 0))
+            try:
+                for offset, _, new in writes:
+                    write_at(fd, offset, new)
+            finally:
+                os.close(fd)
+        except OSError as e:
             raise RuntimeError(f"Cannot write file {filename}: {e}")
     
-    def find_pattern(self, data: bytes, pattern: bytes) -> List[int]:
-        """Find all occurrences of a pattern in data."""
+    def find_pattern(self, data, pattern: bytes) -> List[int]:
+        """Find all occurrences of a pattern in data (bytes, bytearray or mmap)."""
         positions = []
         start = 0
         while True:
@@ -69,117 +355,287 @@ class DreamcastPatcher:
         pattern = struct.pack('<I', value)
         return self.find_pattern(data, pattern)
     
-    def replace_uint32_at_offset(self, data: bytearray, offset: int, new_value: int) -> None:
-        """Replace 32-bit little-endian value at specific offset."""
-        packed_value = struct.pack('<I', new_value)
-        data[offset:offset+4] = packed_value
+    def patch_rules(self) -> List[Tuple[str, bytes, bytes]]:
+        """(name, pattern, replacement) for every enabled patch, in apply order."""
+        rules = []
+        # The copy protection check's interrupt call (CD E4 43 6A) becomes two NOPs
+        if self.config.unprotect:
+            rules.append(('unprotect', bytes([0xCD, 0xE4, 0x43, 0x6A]), bytes([0x09, 0x00, 0x09, 0x00])))
+        # Position references relocated from old_pos to new_pos: the LBA itself
+        # (HACK0), LBA + 166 (HACK1) and LBA + 150 (HACK2); HACK3 is HACK1 + HACK2
+        if self.config.hack0:
+            rules.append(('HACK0', struct.pack('<I', self.config.old_pos),
+                          struct.pack('<I', self.config.new_pos)))
+        if self.config.hack1 or self.config.hack3:
+            rules.append(('HACK1', struct.pack('<I', self.config.old_pos + 166),
+                          struct.pack('<I', self.config.new_pos + 166)))
+        if self.config.hack2 or self.config.hack3:
+            rules.append(('HACK2', struct.pack('<I', self.config.old_pos + 150),
+                          struct.pack('<I', self.config.new_pos + 150)))
+        return rules
     
-    def apply_unprotect_patch(self, data: bytearray) -> bool:
+    def build_patch_plan(self, data) -> List[Tuple[str, int, bytes, bytes]]:
         """
-        Apply unprotect patch: CD E4 43 6A -> 09 00 09 00
+        Find every patch target in data, one find() scan per distinct pattern.
         
-        This patch removes copy protection checks in Dreamcast binaries.
-        The original bytes (CD E4 43 6A) represent an interrupt call,
-        replaced with NOPs (09 00 09 00) to bypass the protection.
-        """
-        unprotect_pattern = bytes([0xCD, 0xE4, 0x43, 0x6A])
-        unprotect_replace = bytes([0x09, 0x00, 0x09, 0x00])
-        
-        positions = self.find_pattern(data, unprotect_pattern)
-        patched = False
-        
-        for pos in positions:
-            print(f"Found unprotect pattern at offset: 0x{pos:x}")
-            if self.config.write_mode:
-                data[pos:pos+4] = unprotect_replace
-                print("Applied unprotect patch")
-                patched = True
-            else:
-                print("Would apply unprotect patch (use -w to write)")
+        Returns (name, offset, pattern, replacement) tuples grouped by rule in
+        apply order, offsets ascending within a rule. When two rules share a
+        pattern the first one claims the match, as it would have patched
+        those bytes before the later rule got to search for them.
         
-        return patched
+        With literal_pools, position matches (HACK0-2) are kept only where a
+        mov.l @(disp,PC) instruction loads them as a constant.
+        """
+        plan = []
+        searched = set()
+        for name, pattern, replacement in self.patch_rules():
+            if pattern in searched:
+                continue
+            searched.add(pattern)
+            for offset in self.find_pattern(data, pattern):
+                if self.config.literal_pools and name != 'unprotect' and not literal_pool_loads(data, offset):
+                    continue
+                plan.append((name, offset, pattern, replacement))
+        return plan
     
-    def apply_position_patches(self, data: bytearray) -> bool:
+    def apply_patch_plan(self, data: bytearray, plan: List[Tuple[str, int, bytes, bytes]],
+                         writes: Optional[List[Write]] = None) -> Tuple[int, int]:
         """
-        Apply position-based patches (HACK0, HACK1, HACK2, HACK3).
+        Report (and in write mode apply) a patch plan; returns (targets found, patches written).
         
-        These patches modify memory addresses in the binary to relocate
-        code or data structures. This is often needed when integrating
-        translation patches or homebrew code that changes the binary layout.
+        Every write made to data is also appended to writes, if given.
         """
-        patched = False
-        
-        # HACK0: Direct position replacement
-        if self.config.hack0:
-            positions = self.find_uint32_value(data, self.config.old_pos)
-            for pos in positions:
-                print(f"Found old position (HACK0) at offset: 0x{pos:x}")
+        found_count = 0
+        applied_count = 0
+        labels = {
+            'unprotect': ('unprotect pattern', 'unprotect patch'),
+            'HACK0': ('old position (HACK0)', 'HACK0 patch'),
+            'HACK1': ('old position + 166 (HACK1)', 'HACK1 patch'),
+            'HACK2': ('old position + 150 (HACK2)', 'HACK2 patch'),
+        }
+        index = 0
+        while index < len(plan):
+            # One rule at a time: a target overwritten by an earlier rule is
+            # no longer there, exactly as with a fresh search per rule
+            name = plan[index][0]
+            group = []
+            while index < len(plan) and plan[index][0] == name:
+                group.append(plan[index])
+                index += 1
+            group = [t for t in group if data[t[1]:t[1] + len(t[2])] == t[2]]
+            found, applied = labels[name]
+            for _, offset, pattern, replacement in group:
+                print(f"Found {found} at offset: 0x{offset:x}")
+                found_count += 1
                 if self.config.write_mode:
-                    self.replace_uint32_at_offset(data, pos, self.config.new_pos)
-                    print("Applied HACK0 patch")
-                    patched = True
+                    if writes is not None:
+                        writes.append((offset, pattern, replacement))
+                    data[offset:offset + len(replacement)] = replacement
+                    print(f"Applied {applied}")
+                    applied_count += 1
                 else:
-                    print("Would apply HACK0 patch (use -w to write)")
-        
-        # HACK1: oldpos + 166 -> newpos + 166
-        if self.config.hack1 or self.config.hack3:
-            target_value = self.config.old_pos + 166
-            replacement_value = self.config.new_pos + 166
-            positions = self.find_uint32_value(data, target_value)
-            for pos in positions:
-                print(f"Found old position + 166 (HACK1) at offset: 0x{pos:x}")
-                if self.config.write_mode:
-                    self.replace_uint32_at_offset(data, pos, replacement_value)
-                    print("Applied HACK1 patch")
-                    patched = True
-                else:
-                    print("Would apply HACK1 patch (use -w to write)")
-        
-        # HACK2: oldpos + 150 -> newpos + 150
-        if self.config.hack2 or self.config.hack3:
-            target_value = self.config.old_pos + 150
-            replacement_value = self.config.new_pos + 150
-            positions = self.find_uint32_value(data, target_value)
-            for pos in positions:
-                print(f"Found old position + 150 (HACK2) at offset: 0x{pos:x}")
-                if self.config.write_mode:
-                    self.replace_uint32_at_offset(data, pos, replacement_value)
-                    print("Applied HACK2 patch")
-                    patched = True
-                else:
-                    print("Would apply HACK2 patch (use -w to write)")
+                    print(f"Would apply {applied} (use -w to write)")
+        return found_count, applied_count
+    
+    def patch_data(self, data, rules: str, writes: List[Write]) -> Tuple[int, int, bool, Optional[str]]:
+        """
+        Plan and apply the patches to data in memory (a bytearray or mmap).
         
-        return patched
+        With a cache the plan is looked up by content hash first, and the
+        plans for the contents before and after patching are both stored.
+        Returns (targets found, patches written, plan came from the cache,
+        hash of the resulting contents or None without a cache).
+        """
+        digest = content_hash(data) if self.cache else None
+        cached = self.cache.lookup_plan(digest, rules) if self.cache else None
+        plan = cached[0] if cached else self.build_patch_plan(data)
+        found, applied = self.apply_patch_plan(data, plan, writes)
+        if self.cache and not cached:
+            patched = None
+            if applied:
+                patched = content_hash(data)
+                remaining = self.build_patch_plan(data)
+                self.cache.store_plan(patched, rules, remaining, None if remaining else patched)
+            elif not plan:
+                patched = digest
+            self.cache.store_plan(digest, rules, plan, patched)
+        if not self.cache:
+            result = None
+        elif not applied:
+            result = digest
+        else:
+            result = cached[1] if cached else patched
+            if result is None:
+                result = content_hash(data)
+        return found, applied, cached is not None, result
     
-    def process_file(self, filename: str) -> None:
-        """Process a single file with the configured patches."""
+    def map_file(self, f) -> mmap.mmap:
+        """
+        Map a file for patching. In write mode the mapping is copy-on-write:
+        patches land in private pages and reach the file via write_patches.
+        """
+        access = mmap.ACCESS_COPY if self.config.write_mode else mmap.ACCESS_READ
+        return mmap.mmap(f.fileno(), 0, access=access)
+    
+    def process_large_file(self, filename: str, rules: str,
+                           writes: List[Write]) -> Tuple[int, int, bool, Optional[str]]:
+        """Patch a large file through mmap so it never has to fit in memory."""
+        with open(filename, 'rb') as f:
+            with self.map_file(f) as data:
+                return self.patch_data(data, rules, writes)
+    
+    def process_planned_file(self, filename: str, plan: PatchPlan, writes: List[Write]) -> Tuple[int, int]:
+        """Verify or apply a cached plan, touching only the pages of its offsets."""
+        if not plan:
+            return 0, 0
+        with open(filename, 'rb') as f:
+            with self.map_file(f) as data:
+                return self.apply_patch_plan(data, plan, writes)
+    
+    def process_file(self, filename: str) -> dict:
+        """
+        Process a single file with the configured patches.
+        
+        Returns the file's statistics: whether it was scanned, its size, the
+        number of targets found and patches applied, and whether the patch
+        plan came from the cache.
+        """
+        stats = {'file': filename, 'scanned': False, 'bytes': 0, 'matches': 0, 'applied': 0,
+                 'cached': False, 'error': None}
         try:
-            print(f"Processing: {filename}")
+            st = os.stat(filename)
+            known = self.cache.lookup_file(filename, st) if self.cache else None
+            kind, reason = (known[3], known[4]) if known else ('executable', '')
+            if not known and (self.cache or not self.config.all_files or self.config.list_only):
+                kind, reason = classify_file(filename)
+            if not self.config.all_files or self.config.list_only:
+                if self.config.list_only:
+                    print(f"{filename}: {kind} ({reason})")
+                    return stats
+                if kind != 'executable':
+                    if self.cache and not known:
+                        self.cache.record_file(filename, None, kind, reason)
+                    print(f"Skipping data file: {filename} ({reason}, use --all to patch it)\n")
+                    return stats
             
-            # Read the file
-            data_bytes = self.read_file(filename)
-            data = bytearray(data_bytes)
+            print(f"Processing: {filename}")
             
-            # Apply patches
-            patched = False
+            stats['bytes'] = st.st_size
+            rules = PlanCache.rules_key(self.patch_rules(), self.config.literal_pools)
+            cached = self.cache.lookup_plan(known[2], rules) if known else None
+            writes: List[Write] = []
+            if cached:
+                # Unchanged since the last run: no need to read or scan it
+                plan, patched = cached
+                found, applied = self.process_planned_file(filename, plan, writes)
+                from_cache = True
+                digest = patched if applied else known[2]
+            elif st.st_size > MMAP_THRESHOLD:
+                found, applied, from_cache, digest = self.process_large_file(filename, rules, writes)
+            else:
+                # Read the file
+                data_bytes = self.read_file(filename)
+                data = bytearray(data_bytes)
+                
+                # Find every target (or take the cached plan), then apply them
+                found, applied, from_cache, digest = self.patch_data(data, rules, writes)
             
-            if self.config.unprotect:
-                if self.apply_unprotect_patch(data):
-                    patched = True
+            # Write back only the patched words
+            if writes:
+                self.write_patches(filename, writes)
             
-            if any([self.config.hack0, self.config.hack1, self.config.hack2, self.config.hack3]):
-                if self.apply_position_patches(data):
-                    patched = True
+            if self.cache:
+                if digest:
+                    self.cache.record_file(filename, digest, kind, reason)
+                else:
+                    self.cache.forget_file(filename)
             
-            # Write back if in write mode and patches were applied
-            if self.config.write_mode and patched:
-                self.write_file(filename, bytes(data))
+            stats.update(scanned=True, matches=found, applied=applied, cached=from_cache)
+            if self.config.write_mode and applied:
                 print(f"Successfully patched: {filename}")
             
             print(f"Finished: {filename}\n")
             
         except Exception as e:
+            stats['error'] = str(e)
             print(f"Error processing {filename}: {e}", file=sys.stderr)
+        return stats
+
+
+def process_file_captured(config: Config, filename: str) -> Tuple[str, str, dict]:
+    """Process one file in a worker process; returns (stdout, stderr, stats)."""
+    out = io.StringIO()
+    err = io.StringIO()
+    cache = PlanCache(config.cache_file) if config.cache_file else None
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        stats = DreamcastPatcher(config, cache).process_file(filename)
+    if cache:
+        stats['cache_updates'] = cache.updates
+    return out.getvalue(), err.getvalue(), stats
+
+
+def process_files(config: Config, filenames: List[str], jobs: int = 1) -> List[dict]:
+    """
+    Process every file, across a pool of jobs processes when jobs > 1.
+    
+    Reports are printed in the order of filenames regardless of which
+    worker finished first, so the output is the same as a serial run.
+    The plan cache, if configured, is saved once at the end.
+    """
+    cache = PlanCache(config.cache_file) if config.cache_file else None
+    if jobs <= 1 or len(filenames) <= 1:
+        patcher = DreamcastPatcher(config, cache)
+        results = [patcher.process_file(filename) for filename in filenames]
+    else:
+        results = []
+        with ProcessPoolExecutor(max_workers=min(jobs, len(filenames))) as pool:
+            for out, err, stats in pool.map(process_file_captured, [config] * len(filenames), filenames):
+                sys.stdout.write(out)
+                sys.stderr.write(err)
+                updates = stats.pop('cache_updates', None)
+                if cache and updates:
+                    cache.merge(updates)
+                results.append(stats)
+    if cache:
+        try:
+            cache.save()
+        except OSError as e:
+            print(f"Warning: cannot save plan cache {config.cache_file}: {e}", file=sys.stderr)
+    return results
+
+
+def patch_files(filenames: List[str], config: Config, jobs: int = 1) -> Tuple[List[dict], str]:
+    """
+    Library entry point: process files exactly as the command line does,
+    without printing. Returns the per-file statistics and the report text.
+    """
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        results = process_files(config, filenames, jobs)
+    return results, out.getvalue()
+
+
+def find_binaries(directory: str) -> List[str]:
+    """The .bin files directly in directory, any case (what data\\*.bin matches on Windows)."""
+    try:
+        names = sorted(os.listdir(directory))
+    except OSError:
+        return []
+    return [os.path.join(directory, name) for name in names
+            if name.lower().endswith('.bin') and os.path.isfile(os.path.join(directory, name))]
+
+
+def summarize(results: List[dict], elapsed: float) -> str:
+    """Aggregate one-line summary of a run."""
+    scanned = [r for r in results if r['scanned']]
+    total = sum(r['bytes'] for r in scanned)
+    rate = total / (1024 * 1024) / elapsed if elapsed > 0 else 0.0
+    errors = sum(1 for r in results if r['error'])
+    return (f"Summary: {len(scanned)} file(s) scanned, {len(results) - len(scanned) - errors} skipped, "
+            f"{errors} error(s), {sum(r['matches'] for r in scanned)} match(es), "
+            f"{sum(r['applied'] for r in scanned)} patch(es) applied, "
+            f"{sum(1 for r in scanned if r['cached'])} plan(s) from cache, "
+            f"{total / (1024 * 1024):.1f} MB in {elapsed:.2f}s ({rate:.1f} MB/s)")
 
 
 def expand_wildcards(patterns: List[str]) -> List[str]:
@@ -216,6 +672,19 @@ Examples:
   python hack4.py -0 -w ip.bin           # Apply HACK0 and write changes
   python hack4.py -3 -p -w *.bin         # Apply HACK3 + unprotect to all .bin files
   python hack4.py -o 0x8000 -n 0x4000 -0 -w binary.bin  # Custom positions
+  python hack4.py --list data/*.bin      # Show which files count as executables
+  python hack4.py -3 -w -j 0 data/*.bin  # Patch on every CPU core
+
+Only files recognised as SH-4 executables (by name, IP.BIN header or
+instruction statistics) are patched unless --all is given; data files such
+as AFS/PVR/ADX archives are skipped. Files over 16 MB are scanned via mmap.
+With --jobs the report is still printed in file order.
+With --cache, files unchanged since the last run are not scanned again: the
+cached plan is verified (or applied) at its offsets only.
+With --literal-pools, HACK0-2 only touch words that SH-4 code actually loads
+as constants (mov.l @(disp,PC),Rn), not every matching byte sequence.
+Only the patched words are written back. With --journal the original bytes
+are recorded first, and --revert FILE puts them back.
         """
     )
     
@@ -243,6 +712,27 @@ Examples:
     parser.add_argument('-w', '--write', action='store_true',
                         help='Write mode - actually apply patches (BE CAREFUL!)')
     
+    parser.add_argument('-l', '--literal-pools', action='store_true',
+                        help='Only patch positions loaded by mov.l @(disp,PC) (SH-4 literal pools)')
+    
+    parser.add_argument('--all', action='store_true',
+                        help='Patch every target file, not only recognised SH-4 executables')
+    
+    parser.add_argument('--list', action='store_true',
+                        help='Only show how each target file is classified')
+    
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Process files in N parallel processes (0 = one per CPU)')
+    
+    parser.add_argument('--cache', metavar='FILE',
+                        help='Keep patch plans in FILE so unchanged files are not scanned again')
+    
+    parser.add_argument('--journal', metavar='FILE',
+                        help='Record the original bytes of every patched word in FILE')
+    
+    parser.add_argument('--revert', metavar='FILE',
+                        help='Undo the patches recorded in journal FILE and exit')
+    
     parser.add_argument('files', nargs='*',
                         help='Target file(s) - wildcards supported')
     
@@ -258,6 +748,15 @@ def main():
     parser = create_parser()
     args = parser.parse_args()
     
+    if args.revert:
+        try:
+            restored, skipped = UndoJournal(args.revert).revert()
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: cannot revert from {args.revert}: {e}", file=sys.stderr)
+            return 1
+        print(f"Reverted {restored} patch(es), {skipped} left alone.")
+        return 1 if skipped else 0
+    
     if not args.files:
         parser.print_help()
         return 1
@@ -272,6 +771,11 @@ def main():
     config.hack3 = args.hack3
     config.unprotect = args.unprotect
     config.write_mode = args.write
+    config.all_files = args.all
+    config.list_only = args.list
+    config.literal_pools = args.literal_pools
+    config.cache_file = args.cache
+    config.journal_file = args.journal
     
     # Expand wildcards
     target_files = expand_wildcards(args.files)
@@ -280,15 +784,19 @@ def main():
         print("Error: No valid target files found", file=sys.stderr)
         return 1
     
-    # Create patcher and process files
-    patcher = DreamcastPatcher(config)
-    
-    for filename in target_files:
-        patcher.process_file(filename)
+    # Process files, in parallel if requested
+    jobs = args.jobs if args.jobs > 0 else (os.cpu_count() or 1)
+    start = time.perf_counter()
+    results = process_files(config, target_files, jobs)
+    elapsed = time.perf_counter() - start
     
     print("Processing complete.")
+    if not config.list_only:
+        print(summarize(results, elapsed))
     return 0
 
 
 if __name__ == "__main__":
+    # Needed for the process pool in a frozen hack4.exe
+    multiprocessing.freeze_support()
     sys.exit(main())
\ No newline at end of file
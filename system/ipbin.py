@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+ipbin.py - Single-pass IP.BIN composer
+
+Builds the final IP.BIN in memory from a template (the user's IP.BIN or one
+of system/precon) and writes the 32 KB result once. The edits that bincon,
+binhack and logo.exe used to make one after another are declared up front:
+
+  0x0030  region flags "JUE"        binhack
+  0x003D  VGA flag                  binhack
+  0x003E  OS flag "0"               bincon / binhack (bincon'd binaries)
+  0x3704  bootstrap hack            binhack
+  0x3820  MR logo (8192 bytes max)  logo
+  0x639C  boot binary size          binhack
+
+Edits are applied in the order given. The bootstrap hack deliberately
+covers the logo and boot size slots, which later edits fill in; any other
+overlap with different bytes, or a write past its own slot (a logo over
+8192 bytes runs into the bootstrap code), is reported as a conflict.
+
+usage: ipbin.py <template IP.BIN> <output IP.BIN> --boot <binary> [--logo image.mr] [--converted]
+"""
+
+import argparse
+import os
+import struct
+import sys
+from typing import List, Optional, Tuple
+
+import binhack
+import bincon
+import sigscan
+
+IP_BIN_SIZE = binhack.BOOTSECTOR_SIZE
+
+LOGO_OFFSET = 0x3820
+LOGO_MAX_SIZE = 8192
+
+
+class Edit:
+    """One declared write: name, bytes, and the slot it may occupy"""
+
+    def __init__(self, name: str, offset: int, data: bytes, limit: Optional[int] = None,
+                 covers: Tuple[str, ...] = ()):
+        self.name = name
+        self.offset = offset
+        self.data = bytes(data)
+        self.limit = limit if limit is not None else len(self.data)   # size of the slot
+        self.covers = covers          # edits allowed to overwrite parts of this one
+
+    @property
+    def end(self) -> int:
+        return self.offset + len(self.data)
+
+
+class IpBinComposer:
+    """Collects edits to an IP.BIN template and applies them in one pass"""
+
+    def __init__(self, template: bytes):
+        if len(template) < IP_BIN_SIZE:
+            raise ValueError(f"IP.BIN template is {len(template)} bytes, expected {IP_BIN_SIZE}")
+        self.template = bytes(template[:IP_BIN_SIZE])
+        self.edits: List[Edit] = []
+
+    def add(self, name: str, offset: int, data: bytes, limit: Optional[int] = None,
+            covers: Tuple[str, ...] = ()) -> None:
+        self.edits.append(Edit(name, offset, data, limit, covers))
+
+    def conflicts(self) -> List[str]:
+        """Every write outside its slot or the image, and every undeclared clash"""
+        problems = []
+        for edit in self.edits:
+            if len(edit.data) > edit.limit:
+                problems.append(f"{edit.name} is {len(edit.data)} bytes, "
+                                f"its slot at 0x{edit.offset:x} holds {edit.limit}")
+            if edit.end > IP_BIN_SIZE:
+                problems.append(f"{edit.name} ends at 0x{edit.end:x}, past the end of IP.BIN")
+        for i, first in enumerate(self.edits):
+            for second in self.edits[i + 1:]:
+                start = max(first.offset, second.offset)
+                end = min(first.end, second.end)
+                if start >= end or second.name in first.covers:
+                    continue
+                if (first.data[start - first.offset:end - first.offset]
+                        == second.data[start - second.offset:end - second.offset]):
+                    continue
+                problems.append(f"{second.name} overwrites {first.name} at 0x{start:x}-0x{end - 1:x}")
+        return problems
+
+    def compose(self) -> bytearray:
+        data = bytearray(self.template)
+        for edit in self.edits:
+            data[edit.offset:edit.end] = edit.data
+        del data[IP_BIN_SIZE:]
+        return data
+
+    def write(self, path: str) -> None:
+        data = self.compose()
+        with open(path, 'wb') as f:
+            f.write(data)
+
+
+def boot_composer(template: bytes, boot_size: int, os_flag: bool = False,
+                  logo: Optional[bytes] = None) -> IpBinComposer:
+    """The edits of the build chain: bincon's OS flag, binhack's bootstrap, the logo"""
+    composer = IpBinComposer(template)
+    composer.add('region flags', binhack.BOOTSECTOR_HACK_REGION_FLAGS_OFFSET, binhack.BOOTSECTOR_REGION_FLAGS)
+    composer.add('VGA flag', binhack.BOOTSECTOR_HACK_VGA_OFFSET, binhack.BOOTSECTOR_VGA_FLAG)
+    if os_flag:
+        composer.add('OS flag', bincon.WINCE_FLAG_OFFSET, bincon.WINCE_FLAG_OFF)
+    composer.add('bootstrap', binhack.BOOTSECTOR_HACK_OFFSET, binhack.BOOTSECTOR_HACK_DATA,
+                 covers=('logo', 'boot size'))
+    if logo is not None:
+        composer.add('logo', LOGO_OFFSET, logo, limit=LOGO_MAX_SIZE)
+    composer.add('boot size', binhack.BOOTSECTOR_HACK_BOOTSIZE_OFFSET, struct.pack('<I', boot_size))
+    return composer
+
+
+def compose_ip_bin(template_path: str, output_path: str, boot_path: str,
+                   logo_path: Optional[str] = None, converted: bool = False) -> List[str]:
+    """Compose IP.BIN for boot_path from a template; output_path may be the template.
+    converted says bincon just converted the binary, which clears the WINCE
+    flag like a bincon'd binary does.
+
+    Returns the conflicts found (the file is written regardless, with later
+    edits winning, as the separate tools did). Raises OSError/ValueError.
+    """
+    with open(template_path, 'rb') as f:
+        template = f.read(IP_BIN_SIZE)
+    with open(boot_path, 'rb') as boot:
+        boot_size = os.fstat(boot.fileno()).st_size
+        os_flag = converted or boot.read(len(sigscan.BINCON_CHECK_REF)) == sigscan.BINCON_CHECK_REF
+    logo = None
+    if logo_path:
+        with open(logo_path, 'rb') as f:
+            logo = f.read()
+    composer = boot_composer(template, boot_size, os_flag, logo)
+    composer.write(output_path)
+    return composer.conflicts()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compose a hacked IP.BIN in one pass')
+    parser.add_argument('template', help="Template IP.BIN (the user's or one from system/precon)")
+    parser.add_argument('output', help='Output IP.BIN (may be the template)')
+    parser.add_argument('--boot', required=True, help='Boot binary (1ST_READ.BIN, 0WINCEOS.BIN, ...)')
+    parser.add_argument('--logo', help='MR logo image to insert at 0x3820')
+    parser.add_argument('--converted', action='store_true', help='The binary was just converted by bincon')
+    args = parser.parse_args()
+
+    try:
+        conflicts = compose_ip_bin(args.template, args.output, args.boot, args.logo, args.converted)
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}")
+        return 1
+    for conflict in conflicts:
+        print(f"Warning: {conflict}")
+    print(f"IP.BIN written: {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,49 +2,385 @@
 
 import sys
 import os
+import mmap
+import stat
 import zlib
 import base64
 import argparse
+import contextlib
 
-def create_cdi_image(input_file, output_file, lba):
+import isowriter
+import progress
+import staging
+
+# ISO sectors are stored as 2336-byte Mode 2 frames: 8 bytes of subheader,
+# 2048 bytes of user data and 280 bytes of (unused) EDC/ECC space.
+SECTOR_SIZE = 0x800
+FRAME_HEAD_SIZE = 8
+FRAME_TAIL_SIZE = 280
+FRAME_SIZE = FRAME_HEAD_SIZE + SECTOR_SIZE + FRAME_TAIL_SIZE
+
+# Leading audio session, written as zeros before the data track pregap
+HEADER_PAD_SIZE = 1063104
+
+# Number of sectors framed per write; 512 sectors is ~1.2 MB of output
+BATCH_SECTORS = 512
+
+_FRAME_HEAD = bytes(FRAME_HEAD_SIZE)
+_FRAME_TAIL = bytes(FRAME_TAIL_SIZE)
+_FRAME_GAP = bytes(FRAME_TAIL_SIZE + FRAME_HEAD_SIZE)
+
+
+class Cancelled(Exception):
+    """The build was cancelled; raised at the next batch boundary"""
+
+
+def _iov_batch_limit():
+    """Largest number of sectors that fit in one writev() call"""
     try:
-        with open(input_file, 'rb') as f:
-            f.seek(0, 2)
-            file_size = f.tell()
-            sector_count = int(file_size / 2048)
-            f.seek(0)
-
-            print(f"Processing file: {input_file}")
-
-            with open(output_file, 'wb') as g:
-                g.write(bytes(1063104))
-                temp = zlib.decompress(base64.b64decode(tdi))
-                g.write(temp)
-
-                for i in range(0, sector_count, 1):
-                    temp = f.read(0x800)
-                    g.write(b'\x00' * 8)
-                    g.write(temp)
-                    g.write(b'\x00' * 280)
-
-                temp = zlib.decompress(base64.b64decode(end))
-                g.write(temp)
-
-                g.seek(-158, 2)
-                g.write(lba.to_bytes(4, 'little'))
-                g.seek(-277, 2)
-                g.write((sector_count + 152).to_bytes(4, 'little'))
-                g.seek(-310, 2)
-                g.write(lba.to_bytes(4, 'little'))
-                g.write((sector_count + 152).to_bytes(4, 'little'))
-                g.seek(-336, 2)
-                g.write((sector_count + 2).to_bytes(4, 'little'))
+        iov_max = os.sysconf('SC_IOV_MAX')
+    except (AttributeError, ValueError, OSError):
+        iov_max = 1024
+    if iov_max <= 0:
+        iov_max = 1024
+    # Each sector takes two iovecs (data + shared gap) plus head and tail
+    return max(1, min(BATCH_SECTORS, (iov_max - 2) // 2))
+
+
+def _write_all(fd, data):
+    """os.write() that retries on short writes"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def _writev_all(fd, buffers):
+    """writev() that retries on short writes"""
+    total = sum(len(b) for b in buffers)
+    written = os.writev(fd, buffers)
+    if written != total:
+        # Short write: flatten whatever is left and push it out
+        _write_all(fd, b''.join(buffers)[written:])
+
+
+def cdi_image_size(sector_count):
+    """Final size in bytes of a CDI image holding sector_count ISO sectors"""
+    return (HEADER_PAD_SIZE + len(_blob(tdi)) + sector_count * FRAME_SIZE
+            + len(_blob(end)))
+
+
+def _blob(data):
+    return zlib.decompress(base64.b64decode(data))
+
+
+def data_track_offset():
+    """Byte offset of the first ISO sector's frame in a CDI image"""
+    return HEADER_PAD_SIZE + len(_blob(tdi))
+
+
+def _frame_into(frames, chunk, n):
+    """Copy n sectors from chunk into the data slots of a frame buffer"""
+    for i in range(n):
+        pos = i * FRAME_SIZE + FRAME_HEAD_SIZE
+        frames[pos:pos + SECTOR_SIZE] = chunk[i * SECTOR_SIZE:(i + 1) * SECTOR_SIZE]
+
+
+def read_sectors(fd, sector, count=1):
+    """Read ISO sectors back out of an open CDI image.
+    sector is relative to the start of the session (the first ISO sector)."""
+    out = bytearray()
+    base = data_track_offset()
+    for i in range(count):
+        os.lseek(fd, base + (sector + i) * FRAME_SIZE + FRAME_HEAD_SIZE, os.SEEK_SET)
+        data = os.read(fd, SECTOR_SIZE)
+        if len(data) != SECTOR_SIZE:
+            raise ValueError(f"sector {sector + i} is past the end of the image")
+        out += data
+    return bytes(out)
+
+
+def overwrite_sectors(fd, sector, data):
+    """Frame whole ISO sectors and write them over an existing CDI image in place.
+    sector is relative to the start of the session (the first ISO sector)."""
+    view = memoryview(data).cast('B')
+    count = len(view) // SECTOR_SIZE
+    if count * SECTOR_SIZE != len(view):
+        raise ValueError("sector data must be a multiple of 2048 bytes")
+    frames = bytearray(min(count, BATCH_SECTORS) * FRAME_SIZE)
+    os.lseek(fd, data_track_offset() + sector * FRAME_SIZE, os.SEEK_SET)
+    for start in range(0, count, BATCH_SECTORS):
+        n = min(BATCH_SECTORS, count - start)
+        _frame_into(frames, view[start * SECTOR_SIZE:(start + n) * SECTOR_SIZE], n)
+        _write_all(fd, memoryview(frames)[:n * FRAME_SIZE])
+
+
+class CdiWriter:
+    """Writes a CDI container around a stream of 2048-byte ISO sectors.
+
+    Sectors are framed in batches: with os.writev() the ISO data is handed
+    to the kernel straight from the caller's buffer between shared zero
+    pads, otherwise it is copied into a reusable pre-zeroed frame buffer.
+
+    With sparse or preallocate set, zero regions (the leading audio session,
+    the pregap and all-zero sectors) are skipped over instead of written.
+    A sparse image is sized up front with truncate() so the skipped regions
+    stay holes; a preallocated one reserves its blocks with fallocate().
+
+    cancel is an optional threading.Event; once it is set, the next batch
+    raises Cancelled instead of being written. progress is an optional
+    progress.ProgressReporter, told the bytes of ISO data written after
+    every batch.
+    """
+
+    def __init__(self, output_file, lba, sector_count=None, sparse=False, preallocate=False,
+                 cancel=None, progress=None):
+        self.output_file = output_file
+        self.cancel = cancel
+        self.progress = progress
+        self.lba = lba
+        self.sector_count = 0
+        self.expected_sectors = sector_count
+        self.sparse = sparse
+        self.preallocate = preallocate
+        self.skip_zeros = sparse or preallocate
+        self._fd = None
+        self._use_writev = hasattr(os, 'writev')
+        self._batch = _iov_batch_limit() if self._use_writev else BATCH_SECTORS
+        self._frames = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        elif self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        return False
+
+    def open(self):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        self._fd = os.open(self.output_file, flags, 0o666)
+        if self.progress is not None:
+            total = self.expected_sectors * SECTOR_SIZE if self.expected_sectors is not None else None
+            self.progress.start(total)
+
+        if self.expected_sectors is not None and self.skip_zeros:
+            self._reserve(cdi_image_size(self.expected_sectors))
+
+        if self.skip_zeros:
+            os.lseek(self._fd, HEADER_PAD_SIZE, os.SEEK_SET)
+            self._write_sparse(_blob(tdi))
+        else:
+            _write_all(self._fd, bytes(HEADER_PAD_SIZE))
+            _write_all(self._fd, _blob(tdi))
+
+    def _reserve(self, size):
+        """Size the output file before any data is written"""
+        if self.preallocate and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self._fd, 0, size)
+                return
+            except OSError:
+                # Filesystem without fallocate support; fall back to truncate
+                pass
+        os.ftruncate(self._fd, size)
+
+    def _write_sparse(self, data):
+        """Write data, seeking over sector-sized runs of zeros"""
+        view = memoryview(data)
+        zero = bytes(SECTOR_SIZE)
+        pos = 0
+        while pos < len(view):
+            block = view[pos:pos + SECTOR_SIZE]
+            if block.tobytes() == zero[:len(block)]:
+                os.lseek(self._fd, len(block), os.SEEK_CUR)
+            else:
+                _write_all(self._fd, block)
+            pos += len(block)
+
+    def write_sectors(self, data):
+        """Frame and write a buffer holding a whole number of ISO sectors"""
+        view = memoryview(data).cast('B')
+        count = len(view) // SECTOR_SIZE
+        if count * SECTOR_SIZE != len(view):
+            raise ValueError("sector data must be a multiple of 2048 bytes")
+
+        for start in range(0, count, self._batch):
+            if self.cancel is not None and self.cancel.is_set():
+                raise Cancelled(f"cancelled after {self.sector_count} sectors of {self.output_file}")
+            n = min(self._batch, count - start)
+            chunk = view[start * SECTOR_SIZE:(start + n) * SECTOR_SIZE]
+            if self.skip_zeros:
+                self._write_batch_sparse(chunk, n)
+            else:
+                self._write_frames(chunk, n)
+            self.sector_count += n
+            if self.progress is not None:
+                self.progress.update(self.sector_count * SECTOR_SIZE)
+
+    def _write_batch_sparse(self, chunk, n):
+        """Write runs of non-zero sectors, seek over runs of zero sectors"""
+        zero = bytes(SECTOR_SIZE)
+        run_start = 0
+        run_zero = None
+        for i in range(n + 1):
+            if i < n:
+                is_zero = chunk[i * SECTOR_SIZE:(i + 1) * SECTOR_SIZE].tobytes() == zero
+                if is_zero == run_zero:
+                    continue
+            if i > run_start:
+                if run_zero:
+                    os.lseek(self._fd, (i - run_start) * FRAME_SIZE, os.SEEK_CUR)
+                else:
+                    self._write_frames(chunk[run_start * SECTOR_SIZE:i * SECTOR_SIZE], i - run_start)
+            if i < n:
+                run_start = i
+                run_zero = is_zero
+
+    def _write_frames(self, chunk, n):
+        if self._use_writev:
+            self._write_batch_vectored(chunk, n)
+        else:
+            self._write_batch_buffered(chunk, n)
+
+    def _write_batch_vectored(self, chunk, n):
+        buffers = [_FRAME_HEAD]
+        for i in range(n):
+            if i:
+                buffers.append(_FRAME_GAP)
+            buffers.append(chunk[i * SECTOR_SIZE:(i + 1) * SECTOR_SIZE])
+        buffers.append(_FRAME_TAIL)
+        _writev_all(self._fd, buffers)
+
+    def _write_batch_buffered(self, chunk, n):
+        if self._frames is None:
+            self._frames = bytearray(self._batch * FRAME_SIZE)
+        _frame_into(self._frames, chunk, n)
+        _write_all(self._fd, memoryview(self._frames)[:n * FRAME_SIZE])
+
+    def close(self):
+        """Append the track/session trailer and finish the image"""
+        if self._fd is None:
+            return
+        trailer = bytearray(_blob(end))
+        size = len(trailer)
+        count = self.sector_count
+
+        trailer[size - 158:size - 154] = self.lba.to_bytes(4, 'little')
+        trailer[size - 277:size - 273] = (count + 152).to_bytes(4, 'little')
+        trailer[size - 310:size - 306] = self.lba.to_bytes(4, 'little')
+        trailer[size - 306:size - 302] = (count + 152).to_bytes(4, 'little')
+        trailer[size - 336:size - 332] = (count + 2).to_bytes(4, 'little')
+
+        _write_all(self._fd, trailer)
+        # Drop any space reserved past the end (short input, fallocate rounding)
+        os.ftruncate(self._fd, os.lseek(self._fd, 0, os.SEEK_CUR))
+        os.close(self._fd)
+        self._fd = None
+        if self.progress is not None:
+            self.progress.finish()
+
+
+def read_sector_stream(stream, batch_sectors=BATCH_SECTORS):
+    """Yield batches of whole sectors read from a pipe or other stream.
+
+    The same buffer is reused for every batch, so each one must be consumed
+    before asking for the next. A trailing partial sector is dropped, the
+    same way the file-based path ignores it.
+    """
+    buf = bytearray(batch_sectors * SECTOR_SIZE)
+    view = memoryview(buf)
+    filled = 0
+    while True:
+        n = stream.readinto(view[filled:])
+        if not n:
+            break
+        filled += n
+        if filled == len(buf):
+            yield view
+            filled = 0
+    whole = filled - filled % SECTOR_SIZE
+    if whole:
+        yield view[:whole]
+
+
+def convert_stream(stream, output_file, lba, sparse=False, preallocate=False, cancel=None,
+                   progress=None):
+    """Frame an ISO read from a binary stream (e.g. mkisofs' stdout) into a CDI.
+    Raises OSError on failure, Cancelled once cancel is set."""
+    _convert_stream(stream, output_file, lba, sparse, preallocate, cancel, progress)
+
+
+def _convert_stream(stream, output_file, lba, sparse, preallocate, cancel=None, progress=None):
+    # The sector count is unknown until the stream ends, so nothing can be
+    # reserved up front; the trailer is patched with the final count.
+    with CdiWriter(output_file, lba, None, sparse, preallocate, cancel, progress) as writer:
+        for chunk in read_sector_stream(stream):
+            writer.write_sectors(chunk)
+
+
+def _convert_file(f, output_file, lba, sparse, preallocate, cancel=None, progress=None):
+    f.seek(0, 2)
+    file_size = f.tell()
+    sector_count = int(file_size / 2048)
+    f.seek(0)
+
+    with CdiWriter(output_file, lba, sector_count, sparse, preallocate, cancel, progress) as writer:
+        if sector_count:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as iso:
+                with memoryview(iso) as view:
+                    writer.write_sectors(view[:sector_count * SECTOR_SIZE])
+
+
+def create_cdi_image(input_file, output_file, lba, sparse=False, preallocate=False, cancel=None,
+                     progress=None):
+    """Convert an ISO to CDI. input_file may be '-' to read the ISO from stdin.
+    Cancelled propagates (leaving a partial output_file) once cancel is set."""
+    try:
+        if input_file == '-':
+            print("Processing stream: <stdin>")
+            _convert_stream(sys.stdin.buffer, output_file, lba, sparse, preallocate, cancel, progress)
+        else:
+            with open(input_file, 'rb') as f:
+                print(f"Processing file: {input_file}")
+                if stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+                    _convert_file(f, output_file, lba, sparse, preallocate, cancel, progress)
+                else:
+                    # Named pipe or device: can't be sized or mapped
+                    _convert_stream(f, output_file, lba, sparse, preallocate, cancel, progress)
 
         print(f"CDI image created: {output_file}")
+        return True
+    except Cancelled:
+        raise
     except FileNotFoundError:
         print(f"Error: Input file '{input_file}' not found.")
     except Exception as e:
         print(f"Error: {e}")
+    return False
+
+
+def create_cdi_from_directory(source_dir, output_file, lba, volume='CDROM', boot_file=None,
+                              sort_file=None, exclude=(), sparse=False, preallocate=False,
+                              slack=(), plan=None, source_date_epoch=None, overrides=None,
+                              cancel=None, progress=None):
+    """Build the ISO9660 filesystem for source_dir in-process and frame it
+    straight into a CDI, without mkisofs or an intermediate ISO.
+    slack, plan, source_date_epoch and overrides are passed on to isowriter.IsoImage;
+    cancel and progress to CdiWriter.
+
+    Raises OSError/ValueError on failure, Cancelled once cancel is set;
+    returns the IsoImage that was written.
+    """
+    image = isowriter.IsoImage(source_dir, volume, lba, boot_file, sort_file, tuple(exclude),
+                               slack=tuple(slack), plan=plan, source_date_epoch=source_date_epoch,
+                               overrides=overrides)
+    with CdiWriter(output_file, lba, image.layout(), sparse, preallocate, cancel, progress) as writer:
+        image.write(writer)
+    return image
 
 tdi=b'''
 eJzt1r+Lz3EcwPHPfWNCKVlMfpQVu8JlMZDBDWeSK4tYXSndopTx/gOD4QxkuY1FGVwd62
@@ -73,15 +409,55 @@ dmEzBackNYMghA1dDcz0E+sZGF6xMWAAkDwLiIFNEu546gcBzH0gd6E4hvwgWGACbGsTAmCT
 8SYUEACGRcNCoB0AWgtNAw=='''
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Create CDI image from an ISO file.")
-    parser.add_argument("-i", "--input", required=True, help="Input ISO file")
+    parser = argparse.ArgumentParser(description="Create CDI image from an ISO file or a directory.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("-i", "--input", help="Input ISO file, or '-' to read it from stdin")
+    source.add_argument("-d", "--directory", help="Build the ISO9660 filesystem from this directory in-process")
     parser.add_argument("-o", "--output", help="Output CDI file (default: <input_filename>.cdi)")
     parser.add_argument("-l", "--lba", type=int, default=11702, help="LBA parameter (default: 11702)")
+    parser.add_argument("--sparse", action="store_true", help="Leave zero regions as holes instead of writing them")
+    parser.add_argument("--preallocate", action="store_true", help="Reserve the full image size up front (fallocate)")
+    parser.add_argument("-V", "--volume", default="CDROM", help="Volume ID (with --directory)")
+    parser.add_argument("-G", "--boot", help="Boot area file, e.g. IP.BIN (with --directory)")
+    parser.add_argument("-x", "--exclude", action="append", default=[], help="Exclude name or pattern (with --directory)")
+    parser.add_argument("--sort", help="mkisofs-style sort file (with --directory)")
+    parser.add_argument("--slack", action="append", default=[], type=isowriter.parse_slack_rule,
+                        help="Growth room after matching files, e.g. 'script/*=16K' (with --directory)")
+    parser.add_argument("--plan", help="Extent map of a previous build to keep file positions stable (with --directory)")
+    parser.add_argument("--source-date-epoch", type=isowriter.source_date_epoch,
+                        default=os.environ.get('SOURCE_DATE_EPOCH') or None,
+                        help="Pin all timestamps to this Unix time (with --directory, default: $SOURCE_DATE_EPOCH)")
+    parser.add_argument("--stage", help="Staging overlay whose patched copies replace their originals (with --directory)")
+    parser.add_argument("--progress", action="store_true", help="Print bytes written, throughput and ETA while writing")
 
     args = parser.parse_args()
 
     input_file = args.input
+    if (args.directory or args.input == '-') and not args.output:
+        parser.error("--output is required when reading from stdin or a directory")
     output_file = args.output or f"{os.path.splitext(args.input)[0]}.cdi"
     lba = args.lba
 
-    create_cdi_image(input_file, output_file, lba)
\ No newline at end of file
+    # The progress line, when asked for, is finished before the result is printed
+    progress_line = progress.progress_line('iso2cdi') if args.progress else contextlib.nullcontext()
+
+    if args.directory:
+        print(f"Processing directory: {args.directory}")
+        try:
+            plan = isowriter.load_plan(args.plan) if args.plan else None
+            overrides = staging.StagingOverlay(args.directory, args.stage).overrides() if args.stage else None
+            with progress_line as reporter:
+                create_cdi_from_directory(args.directory, output_file, lba, args.volume, args.boot,
+                                          args.sort, args.exclude, args.sparse, args.preallocate,
+                                          args.slack, plan, args.source_date_epoch, overrides,
+                                          progress=reporter)
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        print(f"CDI image created: {output_file}")
+        sys.exit(0)
+
+    with progress_line as reporter:
+        created = create_cdi_image(input_file, output_file, lba, args.sparse, args.preallocate,
+                                   progress=reporter)
+    sys.exit(0 if created else 1)
@@ -0,0 +1,912 @@
+#!/usr/bin/env python3
+"""
+isowriter.py - In-process ISO9660 image writer
+Replacement for the mkisofs invocation used by mkcdi:
+
+    mkisofs -C 0,<lba> -V <volume> [-sort <file>] -exclude IP.BIN -G IP.BIN -l -J -r
+
+Builds an ISO9660 filesystem (31-character names, Joliet and Rock Ridge
+extensions) for a single multisession track starting at <lba>, with an
+optional 32 KB boot area (IP.BIN) in the system area. Sectors are handed to
+a sink object with a write_sectors() method, such as iso2cdi.CdiWriter, so
+each game file is read exactly once and written straight into the image.
+"""
+
+import argparse
+import fnmatch
+import json
+import os
+import re
+import struct
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+SECTOR_SIZE = 0x800
+SYSTEM_AREA_SECTORS = 16
+BOOT_AREA_SIZE = SYSTEM_AREA_SECTORS * SECTOR_SIZE
+
+# Trailing padding, as written by mkisofs (-pad)
+PAD_SECTORS = 150
+
+# Sectors read per file chunk
+READ_CHUNK_SECTORS = 64
+
+MAX_RECORD_SIZE = 255
+ISO_NAME_MAX = 31
+JOLIET_NAME_MAX = 64
+
+# Rock Ridge permissions as produced by mkisofs -r
+RR_FILE_MODE = 0o100444
+RR_DIR_MODE = 0o040555
+
+RR_ER_ID = b'RRIP_1991A'
+RR_ER_DESCRIPTOR = b'THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE SYSTEM SEMANTICS'
+RR_ER_SOURCE = (b'PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  '
+                b'SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR CONTACT INFORMATION.')
+
+CE_ENTRY_SIZE = 28
+
+_ISO_ILLEGAL = re.compile(r'[^A-Z0-9_]')
+_JOLIET_ILLEGAL = re.compile(r'[*/:;?\\]')
+
+
+# -----------------------------------------------------------------------------
+# Field encoders
+# -----------------------------------------------------------------------------
+
+def _both16(value: int) -> bytes:
+    return struct.pack('<H', value) + struct.pack('>H', value)
+
+
+def _both32(value: int) -> bytes:
+    return struct.pack('<I', value) + struct.pack('>I', value)
+
+
+def _padded(text: bytes, size: int, fill: bytes = b' ') -> bytes:
+    return (text + fill * size)[:size]
+
+
+def _ucs2(text: str) -> bytes:
+    return ''.join(c if ord(c) < 0x10000 else '_' for c in text).encode('utf-16-be')
+
+
+def _dir_date(stamp: float) -> bytes:
+    """7-byte directory record date (UTC)"""
+    t = time.gmtime(stamp)
+    return bytes([max(0, t.tm_year - 1900), t.tm_mon, t.tm_mday,
+                  t.tm_hour, t.tm_min, t.tm_sec, 0])
+
+
+def _volume_date(stamp: Optional[float]) -> bytes:
+    """17-byte volume descriptor date (UTC); None means 'not specified'"""
+    if stamp is None:
+        return b'0' * 16 + b'\x00'
+    return time.strftime('%Y%m%d%H%M%S', time.gmtime(stamp)).encode('ascii') + b'00\x00'
+
+
+def _sectors(size: int) -> int:
+    return (size + SECTOR_SIZE - 1) // SECTOR_SIZE
+
+
+# -----------------------------------------------------------------------------
+# Name mapping
+# -----------------------------------------------------------------------------
+
+def iso_dir_name(name: str) -> str:
+    return _ISO_ILLEGAL.sub('_', name.upper())[:ISO_NAME_MAX]
+
+
+def iso_file_name(name: str) -> str:
+    base, dot, ext = name.upper().rpartition('.')
+    if not dot:
+        base, ext = ext, ''
+    base = _ISO_ILLEGAL.sub('_', base)
+    ext = _ISO_ILLEGAL.sub('_', ext)
+    if len(base) + 1 + len(ext) > ISO_NAME_MAX:
+        ext = ext[:ISO_NAME_MAX - 2]
+        base = base[:ISO_NAME_MAX - 1 - len(ext)]
+    return f"{base}.{ext}"
+
+
+def joliet_name(name: str) -> str:
+    return _JOLIET_ILLEGAL.sub('_', name)[:JOLIET_NAME_MAX]
+
+
+def _iso_sort_key(node: '_Node') -> Tuple[bytes, bytes]:
+    base, _, ext = node.iso_name.partition('.')
+    return base.encode('ascii'), ext.encode('ascii')
+
+
+def _make_unique(names: List[str], is_file: List[bool], limit: int) -> List[str]:
+    """Resolve name clashes after mapping by numbering the tail of the name"""
+    seen = set()
+    result = []
+    for name, file in zip(names, is_file):
+        if name in seen:
+            base, dot, ext = name.rpartition('.') if file and '.' in name else (name, '', '')
+            for n in range(1000):
+                tag = f"{n:03d}"
+                candidate = base[:max(0, limit - len(dot + ext) - len(tag))] + tag + dot + ext
+                if candidate not in seen:
+                    name = candidate
+                    break
+        seen.add(name)
+        result.append(name)
+    return result
+
+
+# -----------------------------------------------------------------------------
+# Sort file (mkisofs -sort)
+# -----------------------------------------------------------------------------
+
+def load_sort_file(path: str) -> List[Tuple[str, int]]:
+    """Parse a mkisofs sort file: one '<path or pattern> <weight>' per line"""
+    rules = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            pattern, _, weight = line.rpartition(' ')
+            pattern = pattern.strip() or weight
+            try:
+                rules.append((pattern.replace('\\', '/'), int(weight)))
+            except ValueError:
+                continue
+    return rules
+
+
+# -----------------------------------------------------------------------------
+# Growth slack
+# -----------------------------------------------------------------------------
+
+def parse_slack(spec: str, size: int) -> int:
+    """Slack in bytes for a file of the given size.
+    spec is a byte count with optional K/M suffix ('16K') or a percentage ('10%')."""
+    spec = spec.strip().upper()
+    if spec.endswith('%'):
+        return int(size * float(spec[:-1]) / 100 + 0.5)
+    scale = 1
+    if spec.endswith('K'):
+        scale, spec = 1024, spec[:-1]
+    elif spec.endswith('M'):
+        scale, spec = 1024 * 1024, spec[:-1]
+    return int(float(spec) * scale)
+
+
+def _slack_sectors(rules: List[Tuple[str, str]], rel_path: str, size: int) -> int:
+    """Extra sectors reserved after a file; first matching rule wins"""
+    for pattern, spec in rules:
+        if fnmatch.fnmatch(rel_path.lower(), pattern.lower()):
+            return _sectors(parse_slack(spec, size))
+    return 0
+
+
+def _weight_for(rules: List[Tuple[str, int]], candidates: List[str]) -> int:
+    for pattern, weight in rules:
+        for candidate in candidates:
+            if fnmatch.fnmatch(candidate, pattern):
+                return weight
+    return 0
+
+
+# -----------------------------------------------------------------------------
+# Filesystem tree
+# -----------------------------------------------------------------------------
+
+class _Node:
+    """A file or directory in the image"""
+
+    def __init__(self, name: str, path: str, is_dir: bool, size: int, mtime: float,
+                 parent: Optional['_Node']):
+        self.name = name
+        self.path = path
+        self.is_dir = is_dir
+        self.size = size
+        self.mtime = mtime
+        self.parent = parent
+        self.children: List['_Node'] = []
+        self.iso_name = ''
+        self.joliet_name = ''
+        self.weight = 0
+        self.rel = ''
+        # Sectors reserved for file data (size plus growth slack)
+        self.reserved = 0
+        # Assigned during layout (relative sectors until finalized)
+        self.extent = 0
+        self.joliet_extent = 0
+        self.dir_size = 0
+        self.joliet_dir_size = 0
+        self.number = 0
+        self.joliet_number = 0
+        # Rock Ridge continuation areas, keyed by record kind ('.', '..', 'self')
+        self.ce: Dict[str, Tuple[int, int, bytes]] = {}
+
+    @property
+    def depth(self) -> int:
+        return 0 if self.parent is None else self.parent.depth + 1
+
+    def iso_children(self) -> List['_Node']:
+        return sorted(self.children, key=_iso_sort_key)
+
+    def joliet_children(self) -> List['_Node']:
+        return sorted(self.children, key=lambda n: _ucs2(n.joliet_name))
+
+
+class IsoImage:
+    """Lays out and writes an ISO9660 image for one multisession track.
+
+    Call layout() (done implicitly by write()) to assign every extent, then
+    write(sink) to stream the image sector by sector.
+
+    slack is a list of (pattern, size) rules reserving room after matching
+    files so they can grow in place, e.g. ('script/*', '16K') or ('*.TXT', '10%').
+    plan is the extent map of a previous build: files that still fit keep
+    their old extents so the layout stays stable from build to build.
+    source_date_epoch pins every timestamp in the image (volume dates and
+    all directory records) so identical trees give byte-identical images.
+    overrides maps paths relative to source_dir to the files actually read
+    for them (patched copies from a staging overlay); the image lists the
+    source_dir tree either way.
+    """
+
+    def __init__(self, source_dir: str, volume_id: str = 'CDROM', session_lba: int = 0,
+                 boot_file: Optional[str] = None, sort_file: Optional[str] = None,
+                 exclude: Tuple[str, ...] = (), joliet: bool = True, rock_ridge: bool = True,
+                 timestamp: Optional[float] = None, slack: Tuple[Tuple[str, str], ...] = (),
+                 plan: Optional[dict] = None, source_date_epoch: Optional[int] = None,
+                 overrides: Optional[Dict[str, str]] = None):
+        self.source_dir = source_dir
+        self.overrides = dict(overrides or {})
+        self.volume_id = volume_id
+        self.session_lba = session_lba
+        self.boot_file = boot_file
+        self.sort_rules = load_sort_file(sort_file) if sort_file else []
+        self.exclude = tuple(exclude)
+        self.joliet = joliet
+        self.rock_ridge = rock_ridge
+        self.source_date_epoch = source_date_epoch
+        if source_date_epoch is not None:
+            timestamp = source_date_epoch
+        self.timestamp = time.time() if timestamp is None else timestamp
+        self.slack = list(slack)
+        self.plan = plan
+        self.plan_reused = 0
+        self.root: Optional[_Node] = None
+        self.total_sectors = 0
+        self._dirs: List[_Node] = []
+        self._joliet_dirs: List[_Node] = []
+        self._files: List[_Node] = []
+        self._ce_sectors = 0
+        self._ce_start = 0
+        self._path_table_size = 0
+        self._joliet_path_table_size = 0
+        self._path_table_locs: List[int] = []
+        # Directory record locations per file: (absolute sector, offset, length)
+        self._record_locs: Dict[int, List[Tuple[int, int, int]]] = {}
+        self._data_start = 0
+        self._laid_out = False
+
+    # -------------------------------------------------------------------------
+    # Tree scan
+    # -------------------------------------------------------------------------
+
+    def _excluded(self, rel_path: str, name: str) -> bool:
+        return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(rel_path, p) for p in self.exclude)
+
+    def _scan(self) -> None:
+        st = os.stat(self.source_dir)
+        self.root = _Node('', self.source_dir, True, 0, st.st_mtime, None)
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            with os.scandir(node.path) as it:
+                # Directory listing order differs between filesystems
+                entries = sorted(it, key=lambda e: e.name)
+            for entry in entries:
+                rel = os.path.relpath(entry.path, self.source_dir).replace('\\', '/')
+                if self._excluded(rel, entry.name):
+                    continue
+                if entry.is_dir():
+                    st = entry.stat()
+                    child = _Node(entry.name, entry.path, True, 0, st.st_mtime, node)
+                    stack.append(child)
+                elif entry.is_file():
+                    path = self.overrides.get(rel)
+                    st = os.stat(path) if path else entry.stat()
+                    child = _Node(entry.name, path or entry.path, False, st.st_size, st.st_mtime, node)
+                    child.reserved = _sectors(st.st_size) + _slack_sectors(self.slack, rel, st.st_size)
+                    source_rel = os.path.normpath(os.path.join(self.source_dir, rel)).replace('\\', '/')
+                    child.weight = _weight_for(self.sort_rules, [source_rel, rel])
+                else:
+                    continue
+                child.rel = rel
+                node.children.append(child)
+
+            is_file = [not c.is_dir for c in node.children]
+            iso_names = _make_unique([iso_dir_name(c.name) if c.is_dir else iso_file_name(c.name)
+                                      for c in node.children], is_file, ISO_NAME_MAX)
+            joliet_names = _make_unique([joliet_name(c.name) for c in node.children],
+                                        is_file, JOLIET_NAME_MAX)
+            for child, iso, jname in zip(node.children, iso_names, joliet_names):
+                child.iso_name = iso
+                child.joliet_name = jname
+
+    # -------------------------------------------------------------------------
+    # Directory records
+    # -------------------------------------------------------------------------
+
+    def _rr_entries(self, node: _Node, kind: str) -> List[bytes]:
+        """System Use entries for one directory record"""
+        entries = []
+        if kind == '.' and node.parent is None:
+            entries.append(b'SP\x07\x01\xbe\xef\x00')
+        if node.is_dir:
+            nlink = 2 + sum(1 for c in node.children if c.is_dir)
+            mode = RR_DIR_MODE
+        else:
+            nlink = 1
+            mode = RR_FILE_MODE
+        entries.append(b'PX\x24\x01' + _both32(mode) + _both32(nlink) + _both32(0) + _both32(0))
+        if kind == 'self':
+            name = node.name.encode('utf-8')[:250]
+            entries.append(b'NM' + bytes([5 + len(name), 1, 0]) + name)
+        stamp = _dir_date(self._node_time(node))
+        # TF: modification and access times
+        entries.append(b'TF' + bytes([5 + 14, 1, 0x06]) + stamp + stamp)
+        if kind == '.' and node.parent is None:
+            entries.append(b'ER' + bytes([8 + len(RR_ER_ID) + len(RR_ER_DESCRIPTOR) + len(RR_ER_SOURCE), 1,
+                                          len(RR_ER_ID), len(RR_ER_DESCRIPTOR), len(RR_ER_SOURCE), 1])
+                           + RR_ER_ID + RR_ER_DESCRIPTOR + RR_ER_SOURCE)
+        return entries
+
+    def _node_time(self, node: _Node) -> float:
+        return self.record_time(node.mtime)
+
+    def record_time(self, mtime: float) -> float:
+        """Timestamp recorded in the image for an entry with this mtime"""
+        if self.source_date_epoch is not None:
+            return self.source_date_epoch
+        return mtime
+
+    @staticmethod
+    def _record_base_size(identifier: bytes) -> int:
+        size = 33 + len(identifier)
+        return size + (size & 1)
+
+    def _split_su(self, identifier: bytes, entries: List[bytes]) -> Tuple[List[bytes], bytes]:
+        """Split SU entries into inline entries and a continuation area"""
+        room = MAX_RECORD_SIZE - self._record_base_size(identifier)
+        if sum(len(e) for e in entries) <= room and not any(e.startswith(b'ER') for e in entries):
+            return entries, b''
+        inline: List[bytes] = []
+        used = CE_ENTRY_SIZE
+        rest = list(entries)
+        while rest and not rest[0].startswith(b'ER') and used + len(rest[0]) <= room:
+            entry = rest.pop(0)
+            inline.append(entry)
+            used += len(entry)
+        return inline, b''.join(rest)
+
+    def _record(self, identifier: bytes, extent: int, size: int, is_dir: bool,
+                stamp: float, su: bytes = b'') -> bytes:
+        length = self._record_base_size(identifier) + len(su)
+        if length & 1:
+            su += b'\x00'
+            length += 1
+        rec = bytearray()
+        rec += bytes([length, 0])
+        rec += _both32(extent)
+        rec += _both32(size)
+        rec += _dir_date(stamp)
+        rec += bytes([0x02 if is_dir else 0x00, 0, 0])
+        rec += _both16(1)
+        rec += bytes([len(identifier)]) + identifier
+        if len(identifier) % 2 == 0:
+            rec += b'\x00'
+        rec += su
+        return bytes(rec)
+
+    def _dir_records(self, node: _Node, joliet: bool, with_ce: bool) -> List[Tuple[_Node, str, bytes]]:
+        """All records of one directory, in on-disc order, with their targets"""
+        parent = node.parent or node
+        records = []
+        items = [(b'\x00', node, '.'), (b'\x01', parent, '..')]
+        children = node.joliet_children() if joliet else node.iso_children()
+        for child in children:
+            if joliet:
+                ident = _ucs2(child.joliet_name + ('' if child.is_dir else ';1'))
+            else:
+                ident = (child.iso_name + ('' if child.is_dir else ';1')).encode('ascii')
+            items.append((ident, child, 'self'))
+
+        for ident, target, kind in items:
+            su = b''
+            if self.rock_ridge and not joliet:
+                inline, spill = self._split_su(ident, self._rr_entries(target, kind))
+                su = b''.join(inline)
+                if spill:
+                    key = kind if kind != 'self' else 'self:' + target.iso_name
+                    if with_ce:
+                        sector, offset, _ = node.ce[key]
+                        su += (b'CE\x1c\x01' + _both32(self._ce_start + sector + self.session_lba)
+                               + _both32(offset) + _both32(len(spill)))
+                    else:
+                        su += bytes(CE_ENTRY_SIZE)
+                        node.ce[key] = (0, 0, spill)
+            if target.is_dir:
+                extent = target.joliet_extent if joliet else target.extent
+                size = target.joliet_dir_size if joliet else target.dir_size
+            else:
+                extent, size = target.extent, target.size
+            records.append((target, kind, self._record(ident, extent + self.session_lba, size,
+                                                       target.is_dir, self._node_time(target), su)))
+        return records
+
+    @staticmethod
+    def _pack_records(records: List[Tuple[_Node, str, bytes]]) -> Tuple[bytes, List[int]]:
+        """Pack records into sectors; a record never crosses a sector boundary.
+        Returns the directory extent and the byte offset of each record."""
+        out = bytearray()
+        offsets = []
+        for _, _, rec in records:
+            room = SECTOR_SIZE - len(out) % SECTOR_SIZE
+            if len(rec) > room:
+                out += bytes(room)
+            offsets.append(len(out))
+            out += rec
+        return bytes(out) + bytes(-len(out) % SECTOR_SIZE), offsets
+
+    # -------------------------------------------------------------------------
+    # Path tables
+    # -------------------------------------------------------------------------
+
+    def _path_table(self, dirs: List[_Node], joliet: bool, big_endian: bool) -> bytes:
+        fmt32 = '>I' if big_endian else '<I'
+        fmt16 = '>H' if big_endian else '<H'
+        out = bytearray()
+        for d in dirs:
+            if d.parent is None:
+                ident = b'\x00'
+            elif joliet:
+                ident = _ucs2(d.joliet_name)
+            else:
+                ident = d.iso_name.encode('ascii')
+            extent = (d.joliet_extent if joliet else d.extent) + self.session_lba
+            parent = d.parent or d
+            parent_number = parent.joliet_number if joliet else parent.number
+            out += bytes([len(ident), 0]) + struct.pack(fmt32, extent) + struct.pack(fmt16, parent_number)
+            out += ident
+            if len(ident) & 1:
+                out += b'\x00'
+        return bytes(out)
+
+    @staticmethod
+    def _walk(root: _Node, joliet: bool) -> List[_Node]:
+        """Directories in path table order (by level, parent, then name)"""
+        order = [root]
+        i = 0
+        while i < len(order):
+            node = order[i]
+            children = node.joliet_children() if joliet else node.iso_children()
+            order.extend(c for c in children if c.is_dir)
+            i += 1
+        return order
+
+    # -------------------------------------------------------------------------
+    # Layout
+    # -------------------------------------------------------------------------
+
+    def layout(self) -> int:
+        """Assign all extents; returns the number of sectors in the image"""
+        if self._laid_out:
+            return self.total_sectors
+        if self.root is None:
+            self._scan()
+        assert self.root is not None
+
+        self._dirs = self._walk(self.root, False)
+        for number, d in enumerate(self._dirs, 1):
+            d.number = number
+        if self.joliet:
+            self._joliet_dirs = self._walk(self.root, True)
+            for number, d in enumerate(self._joliet_dirs, 1):
+                d.joliet_number = number
+
+        # Files in directory order, then stably by descending sort weight
+        files = []
+        for d in self._dirs:
+            files.extend(c for c in d.iso_children() if not c.is_dir)
+        files.sort(key=lambda n: -n.weight)
+        self._files = files
+
+        # Directory sizes (record sizes don't depend on extents)
+        for d in self._dirs:
+            d.dir_size = len(self._pack_records(self._dir_records(d, False, False))[0])
+            if self.joliet:
+                d.joliet_dir_size = len(self._pack_records(self._dir_records(d, True, False))[0])
+
+        self._path_table_size = len(self._path_table(self._dirs, False, False))
+        if self.joliet:
+            self._joliet_path_table_size = len(self._path_table(self._joliet_dirs, True, False))
+
+        # Volume descriptors: PVD, optional Joliet SVD, terminator
+        sector = SYSTEM_AREA_SECTORS + 1 + (1 if self.joliet else 0) + 1
+
+        self._path_table_locs = []
+        tables = [self._path_table_size] * 2
+        if self.joliet:
+            tables += [self._joliet_path_table_size] * 2
+        for size in tables:
+            self._path_table_locs.append(sector)
+            sector += _sectors(size)
+
+        for d in self._dirs:
+            d.extent = sector
+            sector += d.dir_size // SECTOR_SIZE
+        for d in self._joliet_dirs:
+            d.joliet_extent = sector
+            sector += d.joliet_dir_size // SECTOR_SIZE
+
+        # Rock Ridge continuation areas; an area never crosses a sector
+        self._ce_start = sector
+        used = 0
+        for d in self._dirs:
+            for key, (_, _, blob) in d.ce.items():
+                if used % SECTOR_SIZE + len(blob) > SECTOR_SIZE:
+                    used += -used % SECTOR_SIZE
+                d.ce[key] = (used // SECTOR_SIZE, used % SECTOR_SIZE, blob)
+                used += len(blob)
+        self._ce_sectors = _sectors(used)
+        sector += self._ce_sectors
+        self._data_start = sector
+
+        end = self._allocate_files(sector)
+        self._files.sort(key=lambda f: (f.extent, f.reserved))
+
+        self.total_sectors = end + PAD_SECTORS
+        self._laid_out = True
+        return self.total_sectors
+
+    def _allocate_files(self, data_start: int) -> int:
+        """Assign file extents from data_start on; returns the first free sector.
+
+        Files listed in the previous plan keep their extent (and reservation)
+        while they still fit in it; everything else goes first-fit into the
+        holes left behind, or after the last extent.
+        """
+        pending = list(self._files)
+        taken: List[Tuple[int, int]] = []
+        if self.plan and self.plan.get('session_lba') == self.session_lba:
+            old = {f['path']: f for f in self.plan.get('files', ())}
+            pending = []
+            for f in self._files:
+                entry = old.get(f.rel)
+                start = entry['lba'] - self.session_lba if entry else -1
+                if entry and start >= data_start and _sectors(f.size) <= entry['sectors']:
+                    f.extent = start
+                    f.reserved = entry['sectors']
+                    taken.append((start, start + f.reserved))
+                else:
+                    pending.append(f)
+            self.plan_reused = len(self._files) - len(pending)
+
+        taken.sort()
+        holes = []
+        cursor = data_start
+        for start, stop in taken:
+            if start > cursor:
+                holes.append([cursor, start])
+            cursor = max(cursor, stop)
+        end = cursor
+
+        for f in pending:
+            for hole in holes:
+                if hole[1] - hole[0] >= f.reserved:
+                    f.extent = hole[0]
+                    hole[0] += f.reserved
+                    break
+            else:
+                f.extent = end
+                end += f.reserved
+        return end
+
+    def extent_map(self) -> dict:
+        """Where everything landed, for in-place incremental updates.
+
+        Lists every directory and, for every file, its absolute extent, size,
+        mtime and the primary/Joliet directory records that describe it.
+        """
+        self.layout()
+        if not self._record_locs:
+            self.metadata()
+        assert self.root is not None
+
+        return {
+            'session_lba': self.session_lba,
+            'volume': self.volume_id,
+            'total_sectors': self.total_sectors,
+            'exclude': list(self.exclude),
+            'source_date_epoch': self.source_date_epoch,
+            'dirs': sorted(d.rel for d in self._dirs if d is not self.root),
+            'files': [{'path': f.rel, 'lba': f.extent + self.session_lba, 'size': f.size,
+                       'sectors': f.reserved, 'mtime': f.mtime,
+                       'records': [list(loc) for loc in self._record_locs.get(id(f), [])]}
+                      for f in self._files],
+        }
+
+    # -------------------------------------------------------------------------
+    # Volume descriptors
+    # -------------------------------------------------------------------------
+
+    def _volume_descriptor(self, joliet: bool) -> bytes:
+        assert self.root is not None
+        vd = bytearray(SECTOR_SIZE)
+        vd[0] = 2 if joliet else 1
+        vd[1:6] = b'CD001'
+        vd[6] = 1
+        if joliet:
+            vd[8:40] = _padded(_ucs2(''), 32, b'\x00\x20')
+            vd[40:72] = _padded(_ucs2(self.volume_id[:16]), 32, b'\x00\x20')
+            vd[88:120] = _padded(b'%/E', 32, b'\x00')
+            table_size = self._joliet_path_table_size
+            locs = self._path_table_locs[2:4]
+            root_extent, root_size = self.root.joliet_extent, self.root.joliet_dir_size
+        else:
+            vd[8:40] = _padded(b'', 32)
+            vd[40:72] = _padded(self.volume_id.encode('ascii', 'replace'), 32)
+            table_size = self._path_table_size
+            locs = self._path_table_locs[0:2]
+            root_extent, root_size = self.root.extent, self.root.dir_size
+        vd[80:88] = _both32(self.session_lba + self.total_sectors)
+        vd[120:124] = _both16(1)
+        vd[124:128] = _both16(1)
+        vd[128:132] = _both16(SECTOR_SIZE)
+        vd[132:140] = _both32(table_size)
+        vd[140:144] = struct.pack('<I', locs[0] + self.session_lba)
+        vd[148:152] = struct.pack('>I', locs[1] + self.session_lba)
+        vd[156:190] = self._record(b'\x00', root_extent + self.session_lba, root_size, True,
+                                   self._node_time(self.root))
+        fill = b'\x00\x20' if joliet else b' '
+        text = _ucs2 if joliet else (lambda s: s.encode('ascii'))
+        vd[190:318] = _padded(b'', 128, fill)
+        vd[318:446] = _padded(b'', 128, fill)
+        vd[446:574] = _padded(b'', 128, fill)
+        vd[574:702] = _padded(text('MKCDI'), 128, fill)
+        vd[702:739] = _padded(b'', 37, fill)
+        vd[739:776] = _padded(b'', 37, fill)
+        vd[776:813] = _padded(b'', 37, fill)
+        vd[813:830] = _volume_date(self.timestamp)
+        vd[830:847] = _volume_date(self.timestamp)
+        vd[847:864] = _volume_date(None)
+        vd[864:881] = _volume_date(None)
+        vd[881] = 1
+        return bytes(vd)
+
+    def tree(self) -> Tuple[List[str], Dict[str, Tuple[int, float]]]:
+        """Scan source_dir without laying it out.
+        Returns the directory paths and each file's (size, mtime), taken from
+        its override where it has one."""
+        if self.root is None:
+            self._scan()
+        assert self.root is not None
+        dirs = []
+        files = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for child in node.children:
+                if child.is_dir:
+                    dirs.append(child.rel)
+                    stack.append(child)
+                else:
+                    files[child.rel] = (child.size, child.mtime)
+        return sorted(dirs), files
+
+    def boot_area(self) -> bytes:
+        if not self.boot_file:
+            return bytes(BOOT_AREA_SIZE)
+        with open(self.boot_file, 'rb') as f:
+            data = f.read(BOOT_AREA_SIZE + 1)
+        if len(data) > BOOT_AREA_SIZE:
+            raise ValueError(f"Boot file {self.boot_file} is larger than {BOOT_AREA_SIZE} bytes")
+        return data.ljust(BOOT_AREA_SIZE, b'\x00')
+
+    def metadata(self) -> bytes:
+        """Everything in front of the first file extent"""
+        self.layout()
+        assert self.root is not None
+        out = bytearray(self.boot_area())
+        out += self._volume_descriptor(False)
+        if self.joliet:
+            out += self._volume_descriptor(True)
+        out += bytes([255]) + b'CD001\x01' + bytes(SECTOR_SIZE - 7)
+
+        tables = [self._path_table(self._dirs, False, False), self._path_table(self._dirs, False, True)]
+        if self.joliet:
+            tables += [self._path_table(self._joliet_dirs, True, False),
+                       self._path_table(self._joliet_dirs, True, True)]
+        for table in tables:
+            out += table + bytes(-len(table) % SECTOR_SIZE)
+
+        self._record_locs = {}
+        for dirs, joliet in ((self._dirs, False), (self._joliet_dirs, True)):
+            for d in dirs:
+                records = self._dir_records(d, joliet, True)
+                extent, offsets = self._pack_records(records)
+                first = (d.joliet_extent if joliet else d.extent) + self.session_lba
+                for (target, kind, rec), offset in zip(records, offsets):
+                    if kind == 'self' and not target.is_dir:
+                        self._record_locs.setdefault(id(target), []).append(
+                            (first + offset // SECTOR_SIZE, offset % SECTOR_SIZE, len(rec)))
+                out += extent
+
+        ce_area = bytearray(self._ce_sectors * SECTOR_SIZE)
+        for d in self._dirs:
+            for sector, offset, blob in d.ce.values():
+                pos = sector * SECTOR_SIZE + offset
+                ce_area[pos:pos + len(blob)] = blob
+        out += ce_area
+        return bytes(out)
+
+    # -------------------------------------------------------------------------
+    # Output
+    # -------------------------------------------------------------------------
+
+    def write(self, sink) -> int:
+        """Stream the image to sink.write_sectors(); returns sectors written"""
+        self.layout()
+        metadata = self.metadata()
+        assert len(metadata) == self._data_start * SECTOR_SIZE
+        sink.write_sectors(metadata)
+
+        buf = bytearray(READ_CHUNK_SECTORS * SECTOR_SIZE)
+        view = memoryview(buf)
+        position = self._data_start
+        for f in self._files:
+            # Plan holes and the growth slack of the previous file
+            self._write_zeros(sink, f.extent - position)
+            position = f.extent + _sectors(f.size)
+            remaining = f.size
+            with open(f.path, 'rb') as src:
+                while remaining > 0:
+                    want = min(remaining, len(buf))
+                    if _read_exact(src, view[:want]) != want:
+                        raise IOError(f"{f.path} shrank while building the image")
+                    remaining -= want
+                    # Zero the tail of a final partial sector
+                    end = want + (-want % SECTOR_SIZE)
+                    view[want:end] = bytes(end - want)
+                    sink.write_sectors(view[:end])
+
+        self._write_zeros(sink, self.total_sectors - position)
+        return self.total_sectors
+
+    @staticmethod
+    def _write_zeros(sink, count: int) -> None:
+        zeros = bytes(min(count, READ_CHUNK_SECTORS) * SECTOR_SIZE)
+        while count > 0:
+            n = min(count, READ_CHUNK_SECTORS)
+            sink.write_sectors(zeros[:n * SECTOR_SIZE])
+            count -= n
+
+
+def patch_record(record: bytearray, size: int, stamp: float) -> None:
+    """Update the data length and timestamps of a packed directory record
+    (including an inline Rock Ridge TF entry) without changing its length."""
+    record[10:18] = _both32(size)
+    date = _dir_date(stamp)
+    record[18:25] = date
+    tf = record.find(b'TF\x13\x01\x06', 33)
+    if tf != -1:
+        record[tf + 5:tf + 19] = date + date
+
+
+def _read_exact(src, view) -> int:
+    """readinto() until view is full or the file ends"""
+    got = 0
+    while got < len(view):
+        n = src.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+class IsoFileSink:
+    """Minimal sink writing plain 2048-byte sectors to an .iso file"""
+
+    def __init__(self, path: str):
+        self._file = open(path, 'wb')
+
+    def write_sectors(self, data) -> None:
+        self._file.write(data)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def parse_session(value: str) -> int:
+    """Parse mkisofs-style '-C last,next' multisession info; returns next"""
+    return int(value.split(',')[-1], 0)
+
+
+def parse_slack_rule(value: str) -> Tuple[str, str]:
+    """Parse a 'pattern=size' growth slack rule"""
+    pattern, sep, spec = value.rpartition('=')
+    if not sep or not pattern:
+        raise argparse.ArgumentTypeError(f"expected PATTERN=SIZE, got '{value}'")
+    parse_slack(spec, 0)
+    return pattern, spec
+
+
+def source_date_epoch(value: Optional[str] = None) -> Optional[int]:
+    """Pinned build time: value if given, else $SOURCE_DATE_EPOCH, else None"""
+    if value is None or value == '':
+        value = os.environ.get('SOURCE_DATE_EPOCH', '')
+    value = value.strip()
+    if not value:
+        return None
+    epoch = int(value)
+    if epoch < 0:
+        raise ValueError(f"invalid SOURCE_DATE_EPOCH: {value}")
+    return epoch
+
+
+def load_plan(path: str) -> Optional[dict]:
+    """Load a previous build's extent map, or None if it is missing/unreadable"""
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build an ISO9660 image (Joliet + Rock Ridge) without mkisofs",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  python isowriter.py -C 0,11702 -V mygame -G data/IP.BIN -x IP.BIN -o test.iso data
+  python isowriter.py -C 0,45000 -V mygame --sort sortfile.str -o test.iso data
+        """
+    )
+    parser.add_argument('source', help='Directory to put in the image')
+    parser.add_argument('-o', '--output', required=True, help='Output ISO file')
+    parser.add_argument('-C', '--session', type=parse_session, default=0,
+                        help="Multisession info 'last,next' or a start LBA (default: 0)")
+    parser.add_argument('-V', '--volume', default='CDROM', help='Volume ID')
+    parser.add_argument('-G', '--boot', help='Boot area file (IP.BIN), up to 32 KB')
+    parser.add_argument('-x', '--exclude', action='append', default=[], help='Exclude name or pattern')
+    parser.add_argument('--sort', help='mkisofs-style sort file')
+    parser.add_argument('--no-joliet', action='store_true', help='Omit Joliet extensions')
+    parser.add_argument('--no-rock', action='store_true', help='Omit Rock Ridge extensions')
+    parser.add_argument('--slack', action='append', default=[], type=parse_slack_rule,
+                        help="Growth room after matching files, e.g. 'script/*=16K' or '*.TXT=10%%'")
+    parser.add_argument('--plan', help='Extent map of a previous build to keep file positions stable')
+    parser.add_argument('--source-date-epoch', type=source_date_epoch,
+                        default=os.environ.get('SOURCE_DATE_EPOCH') or None,
+                        help='Pin all timestamps to this Unix time (default: $SOURCE_DATE_EPOCH)')
+    args = parser.parse_args()
+
+    plan = load_plan(args.plan) if args.plan else None
+    image = IsoImage(args.source, args.volume, args.session, args.boot, args.sort,
+                     tuple(args.exclude), not args.no_joliet, not args.no_rock,
+                     slack=tuple(args.slack), plan=plan, source_date_epoch=args.source_date_epoch)
+    try:
+        sink = IsoFileSink(args.output)
+        try:
+            image.write(sink)
+        finally:
+            sink.close()
+    except (OSError, ValueError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    print(f"ISO image created: {args.output} ({image.total_sectors} sectors)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+progress.py - Byte-level progress events for the image stages
+
+The CDI writer reports how many bytes of ISO data it has written so far; a
+ProgressReporter turns those reports into events (bytes done and total,
+throughput, ETA) and puts them on a thread-safe queue. Events are posted at
+most every EVENT_INTERVAL seconds plus once at the start and the end of the
+stage, so a fast writer doesn't flood the reader with them.
+
+The reader is the front end: the GUI drains the queue from the Tk thread
+to drive its progress bar, the CLI prints a self-updating line with
+print_progress(). A stage that stops reporting for STALL_AFTER seconds is
+shown as stalled.
+
+The total is unknown while an ISO is streamed from mkisofs; those events
+carry no total and no ETA.
+
+usage: progress.py <source> <destination>     copy a file with a progress line
+                                               (e.g. to check a slow disk)
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional, TextIO
+
+MB = 1024 * 1024
+
+# Seconds between two events of one stage
+EVENT_INTERVAL = 0.1
+# Seconds between two printed progress lines
+PRINT_INTERVAL = 0.5
+# Seconds without an event before a running stage is shown as stalled
+STALL_AFTER = 2.0
+# Weight of the latest interval in the throughput estimate
+RATE_SMOOTHING = 0.3
+
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds + 0.5), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+class ProgressEvent:
+    """Progress of one stage at one moment"""
+
+    def __init__(self, stage: str, done: int, total: Optional[int], rate: float,
+                 elapsed: float, finished: bool = False):
+        self.stage = stage
+        self.done = done              # bytes of ISO data written
+        self.total = total            # None while the size is unknown
+        self.rate = rate              # bytes per second (the average once finished)
+        self.elapsed = elapsed
+        self.finished = finished
+        self.time = time.monotonic()
+
+    @property
+    def fraction(self) -> Optional[float]:
+        if not self.total:
+            return None
+        return min(1.0, self.done / self.total)
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Seconds left at the current rate; None when it can't be told"""
+        if self.finished:
+            return 0.0
+        if not self.total or self.rate <= 0:
+            return None
+        return max(0, self.total - self.done) / self.rate
+
+    def format(self, now: Optional[float] = None) -> str:
+        """One line, e.g. 'iso2cdi: 312.0/700.5 MB (44%) 85.3 MB/s ETA 0:05'"""
+        if self.total:
+            text = f"{self.stage}: {self.done / MB:.1f}/{self.total / MB:.1f} MB ({self.fraction:.0%})"
+        else:
+            text = f"{self.stage}: {self.done / MB:.1f} MB"
+        text += f" {self.rate / MB:.1f} MB/s"
+        if self.finished:
+            return text + f" in {format_duration(self.elapsed)}"
+        silent = (now if now is not None else time.monotonic()) - self.time
+        if silent >= STALL_AFTER:
+            return text + f" stalled for {format_duration(silent)}"
+        if self.eta is not None:
+            text += f" ETA {format_duration(self.eta)}"
+        return text
+
+
+class ProgressReporter:
+    """Posts rate-limited ProgressEvents for one stage to a queue.
+
+    With wait set, finish() returns only once the reader has called
+    task_done() for every event (print_progress does), so the final line is
+    out before anything printed after the stage.
+    """
+
+    def __init__(self, events: queue.Queue, stage: str, interval: float = EVENT_INTERVAL,
+                 wait: bool = False):
+        self.events = events
+        self.stage = stage
+        self.interval = interval
+        self.wait = wait
+        self.total: Optional[int] = None
+        self.done = 0
+        self.rate = 0.0
+        self._start = 0.0
+        self._mark = 0.0          # time and bytes done at the last event
+        self._mark_done = 0
+
+    def start(self, total: Optional[int] = None) -> None:
+        """The stage begins; total is its size in bytes, if known"""
+        self.total = total
+        self.done = 0
+        self.rate = 0.0
+        self._start = self._mark = time.monotonic()
+        self._mark_done = 0
+        self._post(False)
+
+    def update(self, done: int) -> None:
+        """done bytes are written; posts an event if the last one is old enough"""
+        self.done = done
+        if time.monotonic() - self._mark >= self.interval:
+            self._post(False)
+
+    def finish(self) -> None:
+        self._post(True)
+        if self.wait:
+            self.events.join()
+
+    def _post(self, finished: bool) -> None:
+        now = time.monotonic()
+        span = now - self._mark
+        if finished:
+            elapsed = now - self._start
+            self.rate = self.done / elapsed if elapsed > 0 else 0.0
+        elif span > 0 and self.done > self._mark_done:
+            recent = (self.done - self._mark_done) / span
+            self.rate = recent if not self.rate else (
+                RATE_SMOOTHING * recent + (1 - RATE_SMOOTHING) * self.rate)
+        self._mark = now
+        self._mark_done = self.done
+        self.events.put(ProgressEvent(self.stage, self.done, self.total, self.rate,
+                                      now - self._start, finished))
+
+
+def print_progress(events: queue.Queue, out: Optional[TextIO] = None,
+                   interval: float = PRINT_INTERVAL) -> None:
+    """Print events from the queue as one self-updating line until None is
+    put on it. At most one line per interval, except for the final one."""
+    out = out or sys.stdout
+    last: Optional[ProgressEvent] = None
+    printed = 0.0
+    width = 0
+
+    def show(text: str) -> None:
+        nonlocal width
+        out.write('\r' + text.ljust(width))
+        out.flush()
+        width = len(text)
+
+    while True:
+        try:
+            event = events.get(timeout=interval)
+        except queue.Empty:
+            # Nothing new: refresh the line so a stall shows
+            if last is not None and not last.finished:
+                show(last.format())
+            continue
+        if event is None:
+            if width:
+                # Cut short: end the line so later output starts on its own
+                out.write('\n')
+                out.flush()
+            events.task_done()
+            break
+        last = event
+        now = time.monotonic()
+        if event.finished:
+            show(event.format())
+            out.write('\n')
+            out.flush()
+            width = 0
+        elif now - printed >= interval:
+            show(event.format(now))
+            printed = now
+        events.task_done()
+
+
+@contextmanager
+def progress_line(stage: str) -> Iterator[ProgressReporter]:
+    """A reporter whose events are printed by print_progress() while the
+    block runs; the line is complete when the block exits"""
+    events: queue.Queue = queue.Queue()
+    printer = threading.Thread(target=print_progress, args=(events,), daemon=True)
+    printer.start()
+    try:
+        yield ProgressReporter(events, stage, wait=True)
+    finally:
+        events.put(None)
+        printer.join()
+
+
+def main():
+    if len(sys.argv) != 3:
+        print("usage: progress.py <source> <destination>")
+        return 1
+    try:
+        with progress_line('copy') as reporter, \
+                open(sys.argv[1], 'rb') as src, open(sys.argv[2], 'wb') as dst:
+            reporter.start(os.fstat(src.fileno()).st_size)
+            done = 0
+            for chunk in iter(lambda: src.read(MB), b''):
+                dst.write(chunk)
+                done += len(chunk)
+                reporter.update(done)
+            reporter.finish()
+    except OSError as e:
+        print(f"\nError: {e}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+sigscan.py - Boot binary signature scanner
+
+Finds the signatures binhack cares about in one pass over a buffer (bytes,
+memoryview or mmap, so large files are never copied):
+
+  CD001              ISO9660 volume descriptor id; the LBA field of a Katana
+                     binary sits 8 bytes before it
+  WINCE_CHECK_REF    WinCE marker, stored in that LBA field instead
+  BINCON_CHECK_REF   bincon'd binaries start with it
+
+Only CD001 can appear anywhere, so only it is searched for; the other two
+markers are meaningful at fixed positions and are checked there. Every
+candidate is reported, so callers can warn when a binary is ambiguous. A
+CD001 closer than 8 bytes to the start of the file has no room for the
+LBA field; it is no candidate, but is reported as too close.
+
+usage: sigscan.py <1ST_READ.BIN> [...]
+"""
+
+import mmap
+import os
+import re
+import sys
+from contextlib import contextmanager
+from typing import BinaryIO, List
+
+BOOT_SIGN_REF = b'CD001'
+WINCE_CHECK_REF = b'\x0D\x00\x0A\x00'
+BINCON_CHECK_REF = b'\x09\x00'
+
+# The LBA (or WinCE marker) precedes the CD001 id by this many bytes
+HACK_OFFSET_DELTA = 8
+
+
+def find_all(data, pattern: bytes, start: int = 0, end: int = -1) -> List[int]:
+    """Every offset of pattern in data[start:end], overlapping matches included.
+
+    data can be any buffer (bytes, memoryview, mmap); a literal regex search
+    runs at memchr speed and, unlike bytes.find, works on all of them.
+    """
+    if end < 0:
+        end = len(data)
+    search = re.compile(re.escape(pattern)).search
+    positions = []
+    match = search(data, start, end)
+    while match:
+        pos = match.start()
+        positions.append(pos)
+        match = search(data, pos + 1, end)
+    return positions
+
+
+class BootScan:
+    """Signature offsets found in one boot binary"""
+
+    def __init__(self, size: int, signatures: List[int], candidates: List[int],
+                 wince: List[int], bincon: bool):
+        self.size = size
+        self.signatures = signatures      # offsets of CD001
+        self.candidates = candidates      # hack offsets (CD001 - 8)
+        self.wince = wince                # candidates holding the WinCE marker
+        self.bincon = bincon
+        # CD001 offsets whose LBA field would start before the file
+        self.too_close = [s for s in signatures if s < HACK_OFFSET_DELTA]
+
+    @property
+    def hack_offset(self) -> int:
+        """First candidate, as the original scanner picked; -1 if none"""
+        return self.candidates[0] if self.candidates else -1
+
+    @property
+    def is_wince(self) -> bool:
+        return self.hack_offset in self.wince
+
+    @property
+    def ambiguous(self) -> bool:
+        return len(self.candidates) > 1
+
+    def describe(self) -> str:
+        offsets = ', '.join(f"0x{c:x}" for c in self.candidates) or 'none'
+        kind = 'WinCE' if self.is_wince else 'Katana'
+        return (f"{kind} binary, {self.size} bytes, hack offset candidates: {offsets}"
+                f"{', bincon' if self.bincon else ''}"
+                f"{''.join(f', CD001 at 0x{s:x} too close to the file start' for s in self.too_close)}")
+
+
+def scan_boot_binary(data, size: int = -1) -> BootScan:
+    """Scan the first size bytes of data (all of it by default)"""
+    if size < 0 or size > len(data):
+        size = len(data)
+    signatures = find_all(data, BOOT_SIGN_REF, 0, size)
+    candidates = [s - HACK_OFFSET_DELTA for s in signatures if s >= HACK_OFFSET_DELTA]
+    wince = [c for c in candidates
+             if data[c:c + len(WINCE_CHECK_REF)] == WINCE_CHECK_REF]
+    bincon = data[:len(BINCON_CHECK_REF)] == BINCON_CHECK_REF
+    return BootScan(size, signatures, candidates, wince, bincon)
+
+
+@contextmanager
+def file_buffer(f: BinaryIO):
+    """Zero-copy view of a file object: BytesIO buffer, mmap, or read() as a fallback"""
+    getbuffer = getattr(f, 'getbuffer', None)
+    if getbuffer is not None:
+        view = getbuffer()
+        try:
+            yield view
+        finally:
+            view.release()
+        return
+
+    m = None
+    try:
+        fileno = f.fileno()
+        if os.fstat(fileno).st_size > 0:
+            m = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    except (AttributeError, OSError, ValueError):
+        m = None
+    if m is None:
+        pos = f.tell()
+        f.seek(0)
+        data = f.read()
+        f.seek(pos)
+        yield data
+        return
+    try:
+        yield m
+    finally:
+        m.close()
+
+
+def scan_file(path: str) -> BootScan:
+    with open(path, 'rb') as f:
+        with file_buffer(f) as data:
+            return scan_boot_binary(data)
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("usage: sigscan.py <binary> [...]")
+        return 1
+    status = 0
+    for path in sys.argv[1:]:
+        try:
+            scan = scan_file(path)
+        except OSError as e:
+            print(f"{path}: {e}")
+            status = 1
+            continue
+        print(f"{path}: {scan.describe()}")
+        if scan.ambiguous:
+            print(f"{path}: warning: {len(scan.candidates)} CD001 signatures, using the first")
+        for s in scan.too_close:
+            print(f"{path}: warning: CD001 at 0x{s:x} is too close to the file start, ignored")
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
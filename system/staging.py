@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+staging.py - Copy-on-write staging overlay for the build
+
+The build patches a handful of files: the boot binary, IP.BIN and whatever
+other executables hack4 finds something to unprotect in. Instead of being
+patched in data/, they are copied to a small stage directory and patched
+there. The image writer then reads the merged view: staged copies in place
+of their originals, every other file straight from data/. data/ itself is
+never written, so a clean rebuild needs nothing re-extracted.
+
+Copies are reflinks where the filesystem supports them (see
+binhack.copy_boot_binary), never hardlinks: a patched hardlink would patch
+the original. A manifest records the inputs the stage was made from (size
+and mtime of each) and the settings it was patched with; while none of
+them change, the patched copies are reused as they are.
+
+usage: staging.py <stage directory>     list the staged files
+"""
+
+import json
+import os
+import sys
+from typing import Dict, Iterable, Optional
+
+import binhack
+
+MANIFEST_FILE = 'stage.json'
+
+
+class StagingOverlay:
+    """Patched copies of a few files of source_dir, kept in stage_dir"""
+
+    def __init__(self, source_dir: str, stage_dir: str):
+        self.source_dir = source_dir
+        self.stage_dir = stage_dir
+        self.manifest_path = os.path.join(stage_dir, MANIFEST_FILE)
+        self.manifest = self._load()
+
+    def _load(self) -> dict:
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        return manifest if isinstance(manifest, dict) else {}
+
+    def path(self, rel: str) -> str:
+        """Where the staged copy of rel (relative to source_dir) lives"""
+        return os.path.join(self.stage_dir, *rel.split('/'))
+
+    @staticmethod
+    def fingerprint(inputs: Iterable[str], settings: dict) -> dict:
+        """Size and mtime of every input file plus the patch settings.
+        Missing inputs are recorded as such, so adding one restages too."""
+        files = {}
+        for path in sorted(set(inputs)):
+            try:
+                st = os.stat(path)
+                files[path.replace('\\', '/')] = [st.st_size, st.st_mtime_ns]
+            except OSError:
+                files[path.replace('\\', '/')] = None
+        # Round-trip through JSON so it compares equal to the saved manifest
+        return json.loads(json.dumps({'inputs': files, 'settings': settings}, sort_keys=True))
+
+    def is_current(self, fingerprint: dict) -> bool:
+        """The stage was committed for exactly these inputs and is still complete"""
+        if self.manifest.get('fingerprint') != fingerprint:
+            return False
+        return all(os.path.isfile(self.path(rel)) for rel in self.manifest.get('files', {}))
+
+    def clear(self) -> None:
+        """Drop the manifest and every staged copy"""
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        for rel in self.manifest.get('files', {}):
+            path = self.path(rel)
+            if os.path.isfile(path):
+                os.remove(path)
+        self.manifest = {}
+
+    def stage(self, sources: Dict[str, str]) -> Dict[str, str]:
+        """Copy sources ({relative path in the image: file to copy}) into the
+        stage, replacing whatever was staged before. The copies are not
+        current until commit(). Returns {relative path: copy method}.
+        """
+        self.clear()
+        os.makedirs(self.stage_dir, exist_ok=True)
+        methods = {}
+        for rel, source in sorted(sources.items()):
+            staged = self.path(rel)
+            os.makedirs(os.path.dirname(staged), exist_ok=True)
+            methods[rel] = binhack.copy_boot_binary(source, staged)
+        self.manifest = {'files': {rel: source.replace('\\', '/') for rel, source in sources.items()}}
+        return methods
+
+    def commit(self, fingerprint: dict) -> None:
+        """Record that the staged copies are fully patched for fingerprint"""
+        self.manifest['fingerprint'] = fingerprint
+        temp = self.manifest_path + '.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(temp, self.manifest_path)
+
+    def files(self) -> Dict[str, str]:
+        """Staged copies: {relative path in the image: staged file}"""
+        return {rel: self.path(rel) for rel in sorted(self.manifest.get('files', {}))}
+
+    def overrides(self) -> Dict[str, str]:
+        """Staged copies that shadow a file of source_dir, for the image writer"""
+        return {rel: path for rel, path in self.files().items()
+                if os.path.isfile(os.path.join(self.source_dir, *rel.split('/')))}
+
+    def lookup(self, rel: str, default: Optional[str] = None) -> Optional[str]:
+        """The staged copy of rel, or default when it isn't staged"""
+        return self.files().get(rel, default)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("usage: staging.py <stage directory>")
+        return 1
+    overlay = StagingOverlay('', sys.argv[1])
+    if not overlay.manifest:
+        print(f"Nothing staged in {sys.argv[1]}")
+        return 0
+    state = 'patched' if 'fingerprint' in overlay.manifest else 'incomplete'
+    for rel, source in sorted(overlay.manifest.get('files', {}).items()):
+        print(f"{rel}: staged from {source}")
+    print(f"{len(overlay.manifest.get('files', {}))} file(s) staged, {state}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
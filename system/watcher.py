@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+watcher.py - Wait for a directory tree to change and settle
+
+Used by mkcdi's watch mode to rebuild when data/ changes. Editors save in
+bursts (temp file, rename, attribute update), so changes are collected
+until the tree has been quiet for the debounce interval and reported as
+one set of paths.
+
+On Linux the tree is watched with inotify (through ctypes, every directory
+watched, new ones added as they appear). Elsewhere, or when inotify is not
+available, a (size, mtime) snapshot of the tree is polled instead.
+
+usage: watcher.py <directory> [--debounce SECONDS] [--poll]
+"""
+
+import argparse
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional, Set, Tuple
+
+# inotify event masks (linux/inotify.h)
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO
+              | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# struct inotify_event: int wd; uint32 mask, cookie, len; char name[len]
+EVENT_HEADER = struct.Struct('iIII')
+
+DEFAULT_DEBOUNCE = 0.5
+DEFAULT_POLL_INTERVAL = 1.0
+
+
+class InotifyBackend:
+    """Change notifications for a whole tree from one inotify descriptor"""
+
+    name = 'inotify'
+
+    def __init__(self, root: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.root = root
+        self.dirs: Dict[int, str] = {}
+        self._watch_tree(root)
+
+    def _watch_tree(self, top: str) -> None:
+        for dirpath, _, _ in os.walk(top):
+            wd = self._add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd >= 0:
+                self.dirs[wd] = dirpath
+
+    def read(self, timeout: float) -> Set[str]:
+        """Paths changed within timeout seconds (empty if nothing happened)"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        changed = set()
+        try:
+            buf = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return changed
+        pos = 0
+        while pos + EVENT_HEADER.size <= len(buf):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(buf, pos)
+            name = buf[pos + EVENT_HEADER.size:pos + EVENT_HEADER.size + length].rstrip(b'\0')
+            pos += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                # Events were dropped; all we know is that something changed
+                changed.add(self.root)
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            directory = self.dirs.get(wd)
+            if directory is None:
+                continue
+            path = os.path.join(directory, os.fsdecode(name)) if name else directory
+            changed.add(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watch_tree(path)
+        return changed
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingBackend:
+    """Compares (size, mtime) snapshots of the tree every interval seconds"""
+
+    name = 'polling'
+
+    def __init__(self, root: str, interval: float = DEFAULT_POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self) -> Dict[str, Tuple[int, int]]:
+        snapshot = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for name in dirnames + filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_size, st.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout: float) -> Set[str]:
+        wait = max(0.0, self._next_scan - time.monotonic())
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(wait)
+        self._next_scan = time.monotonic() + self.interval
+        snapshot = self._scan()
+        old = self.snapshot
+        self.snapshot = snapshot
+        return {p for p in set(old) | set(snapshot) if old.get(p) != snapshot.get(p)}
+
+    def close(self) -> None:
+        pass
+
+
+class DirectoryWatcher:
+    """Reports settled bursts of changes below root"""
+
+    def __init__(self, root: str, debounce: float = DEFAULT_DEBOUNCE,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL, polling: bool = False):
+        self.root = root
+        self.debounce = debounce
+        self.backend = None
+        if not polling and sys.platform.startswith('linux'):
+            try:
+                self.backend = InotifyBackend(root)
+            except (OSError, AttributeError):
+                self.backend = None
+        if self.backend is None:
+            self.backend = PollingBackend(root, poll_interval)
+
+    def wait(self, stop: Optional[threading.Event] = None,
+             on_change: Optional[Callable[[Set[str]], None]] = None,
+             tick: float = 0.2) -> Set[str]:
+        """Block until something changes and the tree has then been quiet for
+        the debounce interval; returns every path changed in that burst.
+
+        on_change is called with the first changes as soon as they are seen,
+        before the burst settles (e.g. to cancel a build that is now stale).
+        Returns an empty set when stop is set.
+        """
+        changed: Set[str] = set()
+        last = 0.0
+        while not (stop and stop.is_set()):
+            timeout = tick if not changed else max(0.0, min(tick, last + self.debounce - time.monotonic()))
+            events = self.backend.read(timeout)
+            if events:
+                if not changed and on_change:
+                    on_change(events)
+                changed |= events
+                last = time.monotonic()
+            elif changed and time.monotonic() - last >= self.debounce:
+                return changed
+        return set()
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Print each settled burst of changes below a directory')
+    parser.add_argument('directory', help='Directory to watch')
+    parser.add_argument('--debounce', type=float, default=DEFAULT_DEBOUNCE,
+                        help=f'Quiet time that ends a burst, in seconds (default: {DEFAULT_DEBOUNCE})')
+    parser.add_argument('--poll', action='store_true', help='Poll instead of using inotify')
+    args = parser.parse_args()
+
+    watcher = DirectoryWatcher(args.directory, args.debounce, polling=args.poll)
+    print(f"Watching {args.directory} ({watcher.backend.name}), Ctrl+C to stop")
+    try:
+        while True:
+            changed = sorted(watcher.wait())
+            more = ' ...' if len(changed) > 10 else ''
+            print(f"{len(changed)} change(s): {', '.join(changed[:10])}{more}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,89 @@
+"""In-place CDI updates must give way to a full rebuild when the layout changes"""
+
+import os
+import sys
+from contextlib import nullcontext
+
+import pytest
+
+SYSTEM_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'system')
+sys.path.insert(0, SYSTEM_DIR)
+import builder
+import cdiupdate
+import iso2cdi
+
+KATANA_IP_BIN = os.path.join(SYSTEM_DIR, 'precon', 'katana.bin')
+
+
+def make_data(root):
+    data = root / 'data'
+    (data / 'sub').mkdir(parents=True)
+    (data / '1ST_READ.BIN').write_bytes(b'\x09\x00' * 4096)
+    (data / 'sub' / 'ASSET.DAT').write_bytes(b'asset' * 1000)
+    return data
+
+
+def make_settings(lba):
+    return {
+        'lba': str(lba),
+        'volume': 'mygame',
+        'binary': '1ST_READ.BIN',
+        'ip_bin': KATANA_IP_BIN,
+        'iso_builder': 'native',
+        'incremental': '1',
+        'slack': [],
+        'source_date_epoch': 1700000000,
+        'build': '20231114',
+    }
+
+
+@pytest.mark.parametrize('field, value', [
+    ('session_lba', 12000),
+    ('volume', 'other'),
+    ('source_date_epoch', None),
+])
+def test_update_cdi_refuses_other_layout(tmp_path, field, value):
+    data = make_data(tmp_path)
+    cdi = str(tmp_path / 'image.cdi')
+    image = iso2cdi.create_cdi_from_directory(str(data), cdi, 11702, 'mygame', boot_file=KATANA_IP_BIN,
+                                              source_date_epoch=1700000000)
+    cdiupdate.save_extent_map(image, cdiupdate.map_path_for(cdi))
+    (data / 'sub' / 'ASSET.DAT').write_bytes(b'ASSET' * 1000)
+    with open(cdi, 'rb') as f:
+        before = f.read()
+
+    layout = {'session_lba': 11702, 'volume': 'mygame', 'source_date_epoch': 1700000000}
+    layout[field] = value
+    with pytest.raises(cdiupdate.LayoutChanged):
+        cdiupdate.update_cdi(cdi, str(data), KATANA_IP_BIN, layout=layout)
+    with open(cdi, 'rb') as f:
+        assert f.read() == before
+    assert os.path.exists(cdiupdate.map_path_for(cdi))
+
+
+def test_lba_change_between_incremental_builds_rebuilds(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    data = make_data(tmp_path)
+    log = []
+    image_builder = builder.ImageBuilder(log=log.append, progress_line=lambda stage: nullcontext())
+
+    settings = make_settings(11702)
+    assert image_builder.build_image_native(settings) == (True, '')
+    published = image_builder.publish_image(settings)
+
+    # Same layout: updated in place
+    (data / 'sub' / 'ASSET.DAT').write_bytes(b'ASSET' * 1000)
+    settings = make_settings(11702)
+    assert image_builder.build_image_native(settings) == (True, '')
+    assert any(line.startswith('Updated 1 file(s)') for line in log)
+    image_builder.publish_image(settings)
+
+    # New LBA: the session has to be written from scratch
+    log.clear()
+    (data / 'sub' / 'ASSET.DAT').write_bytes(b'asset' * 1000)
+    settings = make_settings(12000)
+    assert image_builder.build_image_native(settings) == (True, '')
+    assert any(line.startswith('Full rebuild needed: session_lba changed') for line in log)
+    assert not any(line.startswith('Updated') for line in log)
+    image_builder.publish_image(settings)
+    assert cdiupdate.load_extent_map(cdiupdate.map_path_for(published))['session_lba'] == 12000